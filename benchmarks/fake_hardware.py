@@ -0,0 +1,176 @@
+""" fake_hardware.py
+
+This module contains stand-ins for the blinka `board`, `busio` and `digitalio` modules, so the
+Nightlight playback path can be run and benchmarked on any Linux box with no board attached.
+
+FakeSPI records every buffer written to it and can optionally simulate the time the bytes
+would take on the wire at the configured baudrate. FakeDigitalInOut records the data bits
+clocked out by the bit-banged transport (transports.BitbangTransport). FakeTransport stands in
+for a whole transport, eg one spidev device per chain of a layout.
+
+Call install() before importing anything from nightlight that touches the hardware. The fakes
+replace any real modules, so benchmarks never drive a strip that happens to be attached.
+
+"""
+import importlib.abc
+import importlib.util
+import sys
+import time
+import types
+
+
+class FakeSPI:
+    """ Stand-in for busio.SPI
+
+    :param clock: Clock pin (ignored).
+    :param MOSI: Data pin (ignored).
+    :param MISO: Unused.
+    """
+    simulate_wire_time = False
+    fail = False
+
+    def __init__(self, clock, MOSI=None, MISO=None):
+        if FakeSPI.fail:
+            raise NotImplementedError('Hardware SPI disabled by fake_hardware')
+        self.baudrate = 100000
+        self.writes = []
+        self.record = True
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def configure(self, baudrate=100000, polarity=0, phase=0, bits=8):
+        self.baudrate = baudrate
+
+    def write(self, buf, start=0, end=None):
+        # Blinka's Linux SPI.write() starts like this too, so buffers it can't take (eg NumPy
+        # arrays, whose truth value is ambiguous) fail here as they would on the board.
+        if not buf:
+            return
+        data = bytes(buf[start:end])
+        if self.record:
+            self.writes.append(data)
+        if FakeSPI.simulate_wire_time:
+            wait_until(time.perf_counter() + len(data) * 8 / self.baudrate)
+
+    def deinit(self):
+        pass
+
+
+class FakeTransport:
+    """ Stand-in for a nightlight.transports transport, eg a spidev device
+
+    Records every buffer written to it, like FakeSPI. The simulated wire time is slept rather
+    than busy-waited, because a blocking write to a spidev device releases the GIL, so writes to
+    several of these from different threads overlap as they would on separate SPI buses.
+
+    :param int baudrate: SPI clock rate in Hz, for the simulated wire time.
+    """
+
+    def __init__(self, baudrate=4000000):
+        self.baudrate = baudrate
+        self.writes = []
+        self.record = True
+        self.closed = False
+
+    def write(self, buf):
+        data = bytes(buf)
+        if self.record:
+            self.writes.append(data)
+        if FakeSPI.simulate_wire_time:
+            time.sleep(len(data) * 8 / self.baudrate)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDigitalInOut:
+    """ Stand-in for digitalio.DigitalInOut that records clocked-out data bits
+
+    The data pin records its value on every rising edge of the clock pin, so the bytes sent
+    by transports.BitbangTransport can be reconstructed with clocked_bytes().
+    """
+    data_pin = None
+
+    def __init__(self, pin):
+        self.pin = pin
+        self.direction = None
+        self._value = False
+        self.bits = []
+        if pin == 'MOSI':
+            FakeDigitalInOut.data_pin = self
+
+    @property
+    def value(self):
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        if self.pin == 'SCK' and value and not self._value and FakeDigitalInOut.data_pin:
+            # DotStar raises the clock before setting the data bit, so open a slot for the bit
+            # and fill it in when the data pin is set.
+            FakeDigitalInOut.data_pin.bits.append(None)
+        elif self.pin == 'MOSI' and self.bits and self.bits[-1] is None:
+            self.bits[-1] = 1 if value else 0
+        self._value = value
+
+    def clocked_bytes(self):
+        """ Reassemble the recorded data bits into bytes """
+        bits = [b or 0 for b in self.bits]
+        return bytes(int(''.join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits) - 7, 8))
+
+    def deinit(self):
+        pass
+
+
+def wait_until(deadline):
+    """ Busy-wait until a perf_counter() deadline, like a blocking SPI transfer would """
+    while time.perf_counter() < deadline:
+        pass
+
+
+def _init_board(module):
+    module.SCK = 'SCK'
+    module.MOSI = 'MOSI'
+
+
+def _init_busio(module):
+    module.SPI = FakeSPI
+
+
+def _init_digitalio(module):
+    module.DigitalInOut = FakeDigitalInOut
+    module.Direction = types.SimpleNamespace(INPUT=0, OUTPUT=1)
+
+
+FAKE_MODULES = {'board': _init_board, 'busio': _init_busio, 'digitalio': _init_digitalio}
+
+
+class FakeModuleFinder(importlib.abc.MetaPathFinder, importlib.abc.Loader):
+    """ Import hook that provides the fake modules when they are imported """
+
+    def find_spec(self, name, path, target=None):
+        if name in FAKE_MODULES:
+            return importlib.util.spec_from_loader(name, self)
+        return None
+
+    def create_module(self, spec):
+        return None
+
+    def exec_module(self, module):
+        FAKE_MODULES[module.__name__](module)
+
+
+def install():
+    """ Make the fake modules importable, in place of any real ones
+
+    Like the real modules, each fake is only created when something imports it, so it's still
+    possible to tell which modules a piece of code imports.
+    """
+    for name in FAKE_MODULES:
+        sys.modules.pop(name, None)
+    if not any(isinstance(x, FakeModuleFinder) for x in sys.meta_path):
+        sys.meta_path.insert(0, FakeModuleFinder())
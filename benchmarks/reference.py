@@ -0,0 +1,111 @@
+""" reference.py
+
+This module contains straightforward reference implementations of the hot paths that have
+since been optimized, as they were originally written. The benchmarks check that the optimized
+paths produce byte-identical output to these.
+
+"""
+import json
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from nightlight import adafruit_dotstar
+
+
+def scaled_buffer(dotstar):
+    """ Apply a DotStar's global brightness to its buffer one byte at a time
+
+    :param dotstar: adafruit_dotstar.DotStar.
+    :return: bytearray that DotStar.show() should write.
+    """
+    buf = dotstar._buf
+    if dotstar.brightness < 1.0:
+        buf = bytearray(dotstar._buf)
+        for i in range(adafruit_dotstar.START_HEADER_SIZE):
+            buf[i] = 0x00
+        for i in range(adafruit_dotstar.START_HEADER_SIZE, dotstar.end_header_index):
+            buf[i] = dotstar._buf[i] if i % 4 == 0 else int(dotstar._buf[i] * dotstar._brightness)
+        for i in range(dotstar.end_header_index, len(buf)):
+            buf[i] = 0xff
+    return bytes(buf)
+
+
+def write_frame(board, frame):
+    """ Write a frame to a Nightlight one pixel at a time
+
+    :param board: base.Nightlight.
+    :param frame: Nested list or array of shape (height, width, 3).
+    """
+    for y, row in enumerate(frame):
+        for x, pixel in enumerate(row):
+            board._write_pixel(x, y, tuple(int(c) for c in pixel))
+
+
+def get_rgb_map_from_image(img_obj):
+    """ Parse the RGB value for each pixel in a Pillow Image object with getpixel()
+
+    :param img_obj: Pillow Image object.
+    :return: List of rows of RGB tuples.
+    """
+    rgb_map = []
+    width, height = img_obj.size
+    for y in range(height):
+        row_rgb_map = []
+        for x in range(width):
+            row_rgb_map.append(img_obj.getpixel((x, y)))
+        rgb_map.append(row_rgb_map)
+    return rgb_map
+
+
+def json_file_contents(rgb_array):
+    """ Get the contents of a JSON Nightlight file as originally written with json.dump()
+
+    :param rgb_array: Nested list of frames.
+    :return: str.
+    """
+    return json.dumps(rgb_array)
+
+
+def quantize(frames, bins=2):
+    """ Quantize a noise pattern in place one frame at a time
+
+    :param frames: uint8 noise pattern array.
+    :param bins: Number of bins to quantize to.
+    :return: frames.
+    """
+    w = frames.max() / bins
+    for i in range(frames.shape[0]):
+        frames[i, :, :] -= (frames[i, :, :] - (frames[i, :, :] // w) * w).astype('uint8')
+    return frames
+
+
+def colourize(frames, colourmap='gist_rainbow'):
+    """ Colour a noise pattern by calling the colour map on each frame
+
+    :param frames: uint8 noise pattern array.
+    :param colourmap: Matplotlib colour map to use.
+    :return: uint8 array of RGBA colours.
+    """
+    cm = plt.get_cmap(colourmap)
+    frames = frames.astype('float64')
+    frames *= 1/frames.max()
+    return np.stack([np.uint8(cm(frame) * 255) for frame in frames])
+
+
+def add_padding(frames, n=1):
+    """ Insert n rows and columns of zeros between each row and column of each frame
+
+    :param frames: Array of pattern frames.
+    :param n: Number of rows/columns of zeros to insert.
+    :return: Padded frames.
+    """
+    zeros_shape = [frames.shape[0],
+                   ((n + 1) * frames.shape[1] - n),
+                   ((n + 1) * frames.shape[2] - n)]
+    if len(frames.shape) == 4:
+        zeros_shape.append(frames.shape[3])
+    new_frames = np.zeros(tuple(zeros_shape), dtype=frames.dtype)
+    for i, f in enumerate(frames):
+        new_frames[i][::n + 1, ::n + 1] = f
+    return new_frames
@@ -0,0 +1,953 @@
+""" run.py
+
+Benchmarks for the Nightlight playback and conversion paths. They run on any Linux box with no
+board attached, using the stand-in SPI bus from fake_hardware.py.
+
+Usage, from the repository root:
+
+    python -m benchmarks.run                  # Run every benchmark
+    python -m benchmarks.run -k show          # Only run benchmarks with 'show' in their name
+    python -m benchmarks.run --save 0.1.0     # Store the results in results/0.1.0.json
+    python -m benchmarks.run --compare 0.1.0  # Flag benchmarks that are slower than in 0.1.0
+    python -m benchmarks.run --wire_time      # Include the simulated SPI wire time
+
+Before anything is timed, each optimized path is checked against the reference implementations
+in reference.py to make sure it writes exactly the same bytes. The exit status is 1 if a check
+fails or a benchmark has regressed.
+
+Benchmarks that need ffmpeg are skipped when it isn't on the system path.
+
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+
+from benchmarks import fake_hardware
+
+fake_hardware.install()
+
+import numpy as np  # noqa: E402
+from PIL import Image, ImageSequence  # noqa: E402
+
+from benchmarks import reference  # noqa: E402
+from benchmarks.fake_hardware import FakeDigitalInOut, FakeSPI, FakeTransport  # noqa: E402
+from nightlight import base, compiler, converter, formats, layout, sources, transports  # noqa: E402
+from nightlight.pattern_generators import perlin  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+WIDTH = 30
+HEIGHT = 18
+FRAMES = 30
+# Fast enough that the scheduler never sleeps, so playback benchmarks time the work alone.
+UNPACED_FRAME_RATE = 1e9
+DEFAULT_REPEAT = 5
+DEFAULT_TOLERANCE = 0.25
+# Chains of different sizes, to check that each is mapped and written on its own.
+CHECK_REGIONS = ((0, 0, 18, 10), (18, 0, 12, 10), (0, 10, 30, 8))
+# A wall four times the size of the benchmark board, as one chain or as four of WIDTH x HEIGHT.
+WALL_REGIONS = ((0, 0, WIDTH, HEIGHT), (WIDTH, 0, WIDTH, HEIGHT), (0, HEIGHT, WIDTH, HEIGHT),
+                (WIDTH, HEIGHT, WIDTH, HEIGHT))
+
+BENCHMARKS = {}
+CHECKS = {}
+
+
+def benchmark(name, requires=None):
+    """ Register a benchmark
+
+    The decorated function takes a Workspace and returns a tuple of (function to time, number
+    of items it processes, name of the item), eg (play, 30, 'frame').
+
+    :param str name: Benchmark name.
+    :param str requires: Name of an executable the benchmark needs on the system path.
+    """
+    def decorator(function):
+        BENCHMARKS[name] = (function, requires)
+        return function
+    return decorator
+
+
+def check(name):
+    """ Register a check that an optimized path matches its reference implementation
+
+    The decorated function takes a Workspace and returns None if the outputs match, or a
+    string describing the difference.
+
+    :param str name: Check name.
+    """
+    def decorator(function):
+        CHECKS[name] = function
+        return function
+    return decorator
+
+
+class Workspace:
+    """ Test data shared by the benchmarks, in a temporary directory
+
+    :param str directory: Directory to write test files to.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        rng = np.random.default_rng(0)
+        self.frames = rng.integers(0, 256, size=(FRAMES, HEIGHT, WIDTH, 3), dtype=np.uint8)
+        self.frame_list = self.frames.tolist()
+        self.images = [Image.fromarray(frame, mode='RGB') for frame in self.frames]
+
+        self.frames_dir = self.path('frames')
+        os.mkdir(self.frames_dir)
+        for i, image in enumerate(self.images):
+            image.save(os.path.join(self.frames_dir, '{}.png'.format(i + 1)))
+
+        self.binary_file = self.path('pattern.nl')
+        formats.write_binary(self.frames, self.binary_file)
+
+        # Random frames are the worst case for delta compression, so the compressed format is
+        # measured on a smooth animation: gradients that scroll a little each frame.
+        y, x = np.mgrid[0:HEIGHT, 0:WIDTH]
+        self.smooth_frames = np.stack([
+            np.stack([x * 8 + t, y * 14 + 2 * t, x + y + t // 3], axis=-1) % 256
+            for t in range(FRAMES)]).astype(np.uint8)
+        self.compressed_file = self.path('compressed.nl')
+        formats.write_compressed(self.smooth_frames, self.compressed_file, keyframe_interval=8)
+
+        self.video = None
+        if shutil.which('ffmpeg'):
+            self.video = self.path('video.mp4')
+            subprocess.check_call(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i',
+                                   'testsrc=size=320x180:rate=30', '-t', '1', '-pix_fmt',
+                                   'yuv420p', self.video])
+
+    def path(self, *parts):
+        """ Get a path inside the workspace
+
+        :param parts: Path components.
+        :return: Path.
+        """
+        return os.path.join(self.directory, *parts)
+
+
+def make_board(max_brightness=1.0, brightness=1.0, bitbang=False, keep_alive=None):
+    """ Create a Nightlight on the fake SPI bus
+
+    :param float max_brightness: Nightlight max_brightness.
+    :param float brightness: DotStar global brightness.
+    :param bool bitbang: If True, make hardware SPI unavailable so DotStar bit-bangs the pins.
+    :param float keep_alive: Nightlight keep_alive. By default every frame is written, even if
+                             it is unchanged.
+    :return: Tuple of (board, FakeSPI or the data FakeDigitalInOut pin).
+    """
+    FakeSPI.fail = bitbang
+    try:
+        board = base.Nightlight(WIDTH, HEIGHT, max_brightness=max_brightness,
+                                default_frame_rate=UNPACED_FRAME_RATE, late_policy='catch_up',
+                                keep_alive=keep_alive)
+    finally:
+        FakeSPI.fail = False
+    board._leds.brightness = brightness
+    bus = FakeDigitalInOut.data_pin if bitbang else board._leds.transport._spi
+    return board, bus
+
+
+def make_layout_board(regions):
+    """ Create a Nightlight whose frames are split across chains on FakeTransports
+
+    :param regions: (x, y, width, height) of each chain.
+    :return: Tuple of (board, list of FakeTransport, one per chain).
+    """
+    chain_transports = [FakeTransport() for _ in regions]
+    chains = [layout.Chain(*region, transport=transport)
+              for region, transport in zip(regions, chain_transports)]
+    board = base.Nightlight(layout=layout.Layout(chains), default_frame_rate=UNPACED_FRAME_RATE,
+                            late_policy='catch_up', keep_alive=None)
+    return board, chain_transports
+
+
+def quiet(function):
+    """ Wrap a function so that anything it prints is discarded """
+    def wrapper():
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+    return wrapper
+
+
+# Checks
+
+
+@check('play_pattern writes the reference bytes')
+def check_play_pattern(workspace):
+    frames = workspace.frames[:4]
+    for max_brightness, brightness in ((1.0, 1.0), (0.5, 1.0), (1.0, 0.5), (0.3, 0.25)):
+        board, spi = make_board(max_brightness, brightness)
+        for frame in frames:
+            reference.write_frame(board, frame)
+            spi.writes.append(reference.scaled_buffer(board._leds))
+        expected = spi.writes
+
+        compiled = compiler.compile_pattern(frames, WIDTH, HEIGHT, max_brightness,
+                                            brightness=brightness,
+                                            cache_dir=workspace.path('compiled'))
+        patterns = {'list': frames.tolist(), 'array': frames, 'compiled': compiled,
+                    'pipelined': frames}
+        for name, pattern in patterns.items():
+            board, spi = make_board(max_brightness, brightness)
+            board.pipeline_depth = 2 if name == 'pipelined' else 0
+            board.play_pattern(pattern)
+            if spi.writes != expected:
+                return '{} pattern differs at max_brightness={}, brightness={}'.format(
+                    name, max_brightness, brightness)
+    return None
+
+
+@check('unchanged frames are skipped and kept alive')
+def check_unchanged_frames(workspace):
+    first, second = workspace.frames[:2]
+    pattern = [first, first, first.copy(), second, second]
+    board, spi = make_board(keep_alive=base.DEFAULT_KEEP_ALIVE)
+    board.play_pattern(pattern)
+    if spi.writes != [spi.writes[0], spi.writes[-1]] or spi.writes[0] == spi.writes[-1]:
+        return 'unchanged frames were written ({} writes)'.format(len(spi.writes))
+    board, spi = make_board(keep_alive=base.DEFAULT_KEEP_ALIVE)
+    board._leds.keep_alive = 1e-9
+    board.play_pattern(pattern)
+    if len(spi.writes) != len(pattern):
+        return 'unchanged frames were not kept alive ({} writes)'.format(len(spi.writes))
+
+    path = workspace.path('held.nl')
+    formats.write_compressed(pattern * 3, path, keyframe_interval=8)
+    held = formats.CompressedPattern(path)
+    frames = list(held)
+    if not (frames[0] is frames[1] is frames[2] and frames[3] is frames[4]):
+        return 'compressed file frames are not held'
+    if not np.array_equal(np.stack(frames), np.stack(pattern * 3)):
+        return 'held frames differ'
+    if any(not np.array_equal(held[i], (pattern * 3)[i]) for i in (9, 2, 6, 14, 13, 0)):
+        return 'held frames differ after seeking'
+    streamed = list(sources.FileFrameSource(path))
+    if not (streamed[0] is streamed[1] and np.array_equal(np.stack(streamed), np.stack(frames))):
+        return 'streamed frames are not held'
+    return None
+
+
+@check('playlists play in order, with optional blanks')
+def check_playlist(workspace):
+    patterns = [workspace.frames[:3], workspace.frames[3:5]]
+    board, spi = make_board()
+    board.write_colour((0, 0, 0))
+    blank_frame = spi.writes[-1]
+    expected_frames = []
+    for pattern in patterns:
+        expected_frames.append([])
+        for frame in pattern:
+            reference.write_frame(board, frame)
+            expected_frames[-1].append(reference.scaled_buffer(board._leds))
+
+    for blank in (True, False):
+        expected = []
+        for _ in range(2):
+            for frames in expected_frames:
+                expected += ([blank_frame] if blank else []) + frames
+        for precompile in (False, True):
+            board, spi = make_board()
+            board.compile_cache_dir = workspace.path('compiled')
+            # The playlist loops until it is stopped, so stop it once it has been round twice.
+            player = threading.Thread(target=board.play_patterns, args=(patterns, precompile),
+                                      kwargs={'blank': blank})
+            player.start()
+            while len(spi.writes) < len(expected) and player.is_alive():
+                time.sleep(0.001)
+            board.send_command('exit')
+            player.join()
+            if spi.writes[:len(expected)] != expected:
+                return 'frames differ with blank={}, precompile={}'.format(blank, precompile)
+    return None
+
+
+@check('DotStar.show scales brightness like the reference')
+def check_show(workspace):
+    for brightness in (1.0, 0.75, 0.5, 0.1):
+        board, spi = make_board(brightness=brightness)
+        for frame in workspace.frames[:3]:
+            board._write_frame(frame)
+            board._leds.show()
+            if spi.writes[-1] != reference.scaled_buffer(board._leds):
+                return 'brightness={} differs'.format(brightness)
+    return None
+
+
+@check('DotStar.show after show_buffer repeats the buffer')
+def check_show_after_buffer(workspace):
+    frames = workspace.frames[:2]
+    for brightness in (1.0, 0.5):
+        board, spi = make_board(brightness=brightness)
+        compiled = compiler.compile_pattern(frames, WIDTH, HEIGHT, brightness=brightness,
+                                            cache_dir=workspace.path('compiled'))
+        board._write_frame(frames[0])
+        board._leds.show()
+        board._leds.show_buffer(compiled[1])
+        board._leds.show()
+        if spi.writes[-1] != spi.writes[-2]:
+            return 'brightness={} shows the frame before the buffer'.format(brightness)
+    return None
+
+
+@check('bit-banged transport clocks out the buffer')
+def check_bitbang(workspace):
+    board, pin = make_board(brightness=0.5, bitbang=True)
+    board._write_frame(workspace.frames[0])
+    board._leds.show()
+    if pin.clocked_bytes() != reference.scaled_buffer(board._leds):
+        return 'bit-banged bytes differ from the buffer'
+    return None
+
+
+@check('file transport records every frame')
+def check_file_transport(workspace):
+    # Write through a pipe in small chunks, as the spidev transport writes to its device.
+    path = workspace.path('transport.fifo')
+    os.mkfifo(path)
+    received = []
+    reader = threading.Thread(target=lambda: received.append(open(path, 'rb').read()))
+    reader.start()
+    board = base.Nightlight(WIDTH, HEIGHT, default_frame_rate=UNPACED_FRAME_RATE,
+                            late_policy='catch_up',
+                            transport=transports.FileTransport(path, chunk_size=100))
+    board.play_pattern(workspace.frames[:3])
+    board._leds.transport.close()
+    reader.join()
+
+    expected = []
+    reference_board, spi = make_board()
+    for frame in workspace.frames[:3]:
+        reference.write_frame(reference_board, frame)
+        expected.append(reference.scaled_buffer(reference_board._leds))
+    if received != [b''.join(expected)]:
+        return 'recorded bytes differ'
+    return None
+
+
+@check('layouts split frames across their chains')
+def check_layout(workspace):
+    frames = workspace.frames[:3]
+    max_brightness, brightness = 0.5, 0.5
+    # Each chain should get the bytes a board of its own would, showing its part of the frame.
+    expected = []
+    for x, y, width, height in CHECK_REGIONS:
+        chain_board = base.Nightlight(width, height, max_brightness=max_brightness,
+                                      transport=FakeTransport())
+        chain_board._leds.brightness = brightness
+        expected.append([])
+        for frame in frames:
+            reference.write_frame(chain_board, frame[y:y + height, x:x + width])
+            expected[-1].append(reference.scaled_buffer(chain_board._leds))
+
+    for name in ('list', 'array', 'pipelined', 'compiled'):
+        board, chain_transports = make_layout_board(CHECK_REGIONS)
+        board._max_brightness = max_brightness
+        board._leds.brightness = brightness
+        board.pipeline_depth = 2 if name == 'pipelined' else 0
+        board.compile_cache_dir = workspace.path('compiled')
+        pattern = frames.tolist() if name == 'list' else frames
+        if name == 'compiled':
+            pattern = board.compile_pattern(frames)
+        board.play_pattern(pattern)
+        board._leds.transport.close()
+        if [x.writes for x in chain_transports] != expected:
+            return '{} pattern differs'.format(name)
+        if not all(x.closed for x in chain_transports):
+            return 'chain transports were not closed'
+    return None
+
+
+@check('get_rgb_map_from_image matches getpixel()')
+def check_rgb_map(workspace):
+    for image in workspace.images[:3]:
+        expected = [[list(pixel) for pixel in row]
+                    for row in reference.get_rgb_map_from_image(image)]
+        if converter.get_rgb_map_from_image(image) != expected:
+            return 'RGB maps differ'
+    return None
+
+
+@check('JSON files match json.dump()')
+def check_json_file(workspace):
+    outfile = workspace.path('check.json')
+    converter.write_rgb_array_to_file(workspace.frame_list, outfile)
+    with open(outfile) as fin:
+        if fin.read() != reference.json_file_contents(workspace.frame_list):
+            return 'write_rgb_array_to_file output differs'
+    converter.convert_frames_to_file(workspace.frames_dir, outfile)
+    with open(outfile) as fin:
+        if fin.read() != reference.json_file_contents(workspace.frame_list):
+            return 'convert_frames_to_file output differs'
+    return None
+
+
+@check('binary files round-trip')
+def check_binary_file(workspace):
+    pattern = formats.BinaryPattern(workspace.binary_file)
+    try:
+        if not np.array_equal(pattern.frames, workspace.frames):
+            return 'frames differ'
+    finally:
+        pattern.close()
+    return None
+
+
+@check('compressed files round-trip and seek')
+def check_compressed_file(workspace):
+    pattern = formats.CompressedPattern(workspace.compressed_file)
+    try:
+        if not np.array_equal(np.stack(list(pattern)), workspace.smooth_frames):
+            return 'frames differ'
+        for index in (FRAMES - 1, 3, 17, 8, 9, 0):
+            if not np.array_equal(pattern[index], workspace.smooth_frames[index]):
+                return 'frame {} differs after seeking'.format(index)
+    finally:
+        pattern.close()
+    frames = list(sources.FileFrameSource(workspace.compressed_file))
+    if not np.array_equal(np.stack(frames), workspace.smooth_frames):
+        return 'streamed frames differ'
+    return None
+
+
+@check('gifs show the padded and scaled frames')
+def check_gif(workspace):
+    # Few enough colours to fit in the palette, so every pixel should come back exactly. Frames
+    # 3 and 4 are held, and frame 6 only changes in one place.
+    frames = workspace.frames[:8] // 64 * 85
+    frames[4] = frames[3]
+    frames[6] = frames[5]
+    frames[6, 2, 3] = 255
+    outfile = workspace.path('check.gif')
+    scale, padding, fps = 3, 1, 30
+    converter.write_rgb_array_to_gif((frame for frame in frames), outfile, scale=scale,
+                                     fps=fps, padding=padding)
+    expected = reference.add_padding(frames, padding).repeat(scale, 1).repeat(scale, 2)
+    with Image.open(outfile) as image:
+        gif_frames = [(np.asarray(frame.convert('RGB')), frame.info['duration'])
+                      for frame in ImageSequence.Iterator(image)]
+    shown = [0, 1, 2, 3, 5, 6, 7]
+    if len(gif_frames) != len(shown):
+        return 'expected {} gif frames, got {}'.format(len(shown), len(gif_frames))
+    for i, (frame, duration) in zip(shown, gif_frames):
+        if not np.array_equal(frame, expected[i]):
+            return 'gif frame for frame {} differs'.format(i)
+    if sum(duration for frame, duration in gif_frames) != round(len(frames) * 1000 / fps, -1):
+        return 'gif frame durations do not add up to the pattern length'
+    return None
+
+
+@check('greyscale and many-colour gifs export')
+def check_gif_modes(workspace):
+    grey = workspace.frames[:8, ..., 0]
+    outfile = workspace.path('grey.gif')
+    converter.write_rgb_array_to_gif(grey, outfile, colour_mode='L', scale=1)
+    with Image.open(outfile) as image:
+        gif_frames = [np.asarray(frame.convert('L')) for frame in ImageSequence.Iterator(image)]
+    for i, frame in enumerate(gif_frames):
+        if not np.array_equal(frame, grey[i]):
+            return 'greyscale gif frame {} differs'.format(i)
+    # More colours than fit in the palette, so every frame is quantized to the shared palette.
+    outfile = workspace.path('colours.gif')
+    converter.write_rgb_array_to_gif(workspace.frames[:8], outfile, scale=1)
+    with Image.open(outfile) as image:
+        shape = np.asarray(image.convert('RGB')).shape
+    if shape != workspace.frames.shape[1:]:
+        return 'quantized gif has shape {}, expected {}'.format(shape, workspace.frames.shape[1:])
+    return None
+
+
+@check('simplex noise matches noise.snoise4()')
+def check_simplex_noise(workspace):
+    for octaves in (1, 3):
+        patterns = [perlin._simplex_noise4d((WIDTH, HEIGHT, 8), (0.07, 0.11, 0.1), octaves,
+                                            backend=backend, cache_dir=None)
+                    for backend in perlin.NOISE_BACKENDS]
+        if not all(np.array_equal(patterns[0], x) for x in patterns[1:]):
+            return 'backends differ with octaves={}'.format(octaves)
+    return None
+
+
+@check('quantize and colourize match the per-frame versions')
+def check_colourize(workspace):
+    noise = perlin._simplex_noise4d((HEIGHT, WIDTH, FRAMES), (0.1, 0.1, 0.1), cache_dir=None)
+    for bins in (2, 3, 5):
+        if not np.array_equal(perlin._quantize(noise.copy(), bins),
+                              reference.quantize(noise.copy(), bins)):
+            return 'quantize differs with bins={}'.format(bins)
+    for frames in (noise, perlin._quantize(noise.copy(), 3)):
+        if not np.array_equal(perlin._colourize(frames),
+                              reference.colourize(frames)[..., :3]):
+            return 'colourize differs'
+    return None
+
+
+# Playback
+
+
+@benchmark('play_pattern[list]')
+def bench_play_list(workspace):
+    board, spi = make_board()
+    spi.record = False
+    return lambda: board.play_pattern(workspace.frame_list), FRAMES, 'frame'
+
+
+@benchmark('play_pattern[array]')
+def bench_play_array(workspace):
+    board, spi = make_board()
+    spi.record = False
+    return lambda: board.play_pattern(workspace.frames), FRAMES, 'frame'
+
+
+@benchmark('play_pattern[binary]')
+def bench_play_binary(workspace):
+    board, spi = make_board()
+    spi.record = False
+    pattern = formats.BinaryPattern(workspace.binary_file)
+    return lambda: board.play_pattern(pattern), FRAMES, 'frame'
+
+
+@benchmark('play_pattern[compressed]')
+def bench_play_compressed(workspace):
+    board, spi = make_board()
+    spi.record = False
+    pattern = formats.CompressedPattern(workspace.compressed_file)
+    return lambda: board.play_pattern(pattern), FRAMES, 'frame'
+
+
+@benchmark('play_pattern[unchanged]')
+def bench_play_unchanged(workspace):
+    board, spi = make_board(keep_alive=base.DEFAULT_KEEP_ALIVE)
+    spi.record = False
+    pattern = [workspace.frames[0].copy() for _ in range(FRAMES)]
+    return lambda: board.play_pattern(pattern), FRAMES, 'frame'
+
+
+@benchmark('play_pattern[held]')
+def bench_play_held(workspace):
+    board, spi = make_board(keep_alive=base.DEFAULT_KEEP_ALIVE)
+    spi.record = False
+    pattern = [workspace.frames[0]] * FRAMES
+    return lambda: board.play_pattern(pattern), FRAMES, 'frame'
+
+
+@benchmark('play_pattern[pipelined]')
+def bench_play_pipelined(workspace):
+    board, spi = make_board()
+    spi.record = False
+    board.pipeline_depth = 3
+    return lambda: board.play_pattern(workspace.frames), FRAMES, 'frame'
+
+
+@benchmark('play_pattern[wall, 1 chain]')
+def bench_play_wall(workspace):
+    board = base.Nightlight(WIDTH * 2, HEIGHT * 2, default_frame_rate=UNPACED_FRAME_RATE,
+                            late_policy='catch_up', keep_alive=None, transport=FakeTransport())
+    board._leds.transport.record = False
+    frames = np.tile(workspace.frames, (1, 2, 2, 1))
+    return lambda: board.play_pattern(frames), FRAMES, 'frame'
+
+
+@benchmark('play_pattern[wall, 4 chains]')
+def bench_play_wall_chains(workspace):
+    board, chain_transports = make_layout_board(WALL_REGIONS)
+    for transport in chain_transports:
+        transport.record = False
+    frames = np.tile(workspace.frames, (1, 2, 2, 1))
+    return lambda: board.play_pattern(frames), FRAMES, 'frame'
+
+
+@benchmark('play_pattern[compiled]')
+def bench_play_compiled(workspace):
+    board, spi = make_board()
+    spi.record = False
+    pattern = compiler.compile_pattern(workspace.frames, WIDTH, HEIGHT,
+                                       cache_dir=workspace.path('compiled'))
+    return lambda: board.play_pattern(pattern), FRAMES, 'frame'
+
+
+@benchmark('compile_frame')
+def bench_compile_frame(workspace):
+    order = compiler.serpentine_order(WIDTH, HEIGHT)
+    out = np.empty(compiler.frame_size(WIDTH * HEIGHT), dtype=np.uint8)
+
+    def compile_frames():
+        for frame in workspace.frames:
+            compiler.compile_frame(frame, order, out=out)
+    return compile_frames, FRAMES, 'frame'
+
+
+@benchmark('DotStar.show[brightness=1.0]')
+def bench_show(workspace):
+    board, spi = make_board()
+    spi.record = False
+    board._write_frame(workspace.frames[0])
+    return board._leds.show, 1, 'frame'
+
+
+@benchmark('DotStar.show[brightness=0.5]')
+def bench_show_scaled(workspace):
+    board, spi = make_board(brightness=0.5)
+    spi.record = False
+    board._write_frame(workspace.frames[0])
+    leds = board._leds
+
+    def show():
+        # Mark the pixels as changed, as they would be on every frame during playback.
+        leds._dirty = True
+        leds.show()
+    return show, 1, 'frame'
+
+
+@benchmark('BitbangTransport.write')
+def bench_bitbang(workspace):
+    board, pin = make_board(bitbang=True)
+    leds = board._leds
+    board._write_frame(workspace.frames[0])
+
+    def write():
+        pin.bits.clear()
+        leds.transport.write(leds._buf)
+    return write, len(leds._buf), 'byte'
+
+
+@benchmark('FileTransport.write[chunked]')
+def bench_file_transport(workspace):
+    board, spi = make_board()
+    board._write_frame(workspace.frames[0])
+    buf = bytes(board._leds._buf)
+    transport = transports.FileTransport(os.devnull,
+                                         chunk_size=transports.DEFAULT_SPIDEV_BUFSIZ // 4)
+    return lambda: transport.write(buf), len(buf), 'byte'
+
+
+# Conversion
+
+
+@benchmark('converter.get_rgb_map_from_image')
+def bench_rgb_map(workspace):
+    def convert():
+        for image in workspace.images:
+            converter.get_rgb_map_from_image(image)
+    return convert, FRAMES, 'frame'
+
+
+@benchmark('converter.read_rgb_array_from_file')
+def bench_read_frames(workspace):
+    paths = [os.path.join(workspace.frames_dir, '{}.png'.format(i + 1)) for i in range(FRAMES)]
+
+    def read():
+        for frame in converter.ordered_map(converter.read_rgb_array_from_file, paths):
+            pass
+    return read, FRAMES, 'frame'
+
+
+@benchmark('converter.convert_frames_to_file[json]')
+def bench_convert_frames_json(workspace):
+    outfile = workspace.path('frames.json')
+    return (lambda: converter.convert_frames_to_file(workspace.frames_dir, outfile),
+            FRAMES, 'frame')
+
+
+@benchmark('converter.convert_frames_to_file[binary]')
+def bench_convert_frames_binary(workspace):
+    outfile = workspace.path('frames.nl')
+    return (lambda: converter.convert_frames_to_file(workspace.frames_dir, outfile,
+                                                     file_format='binary'),
+            FRAMES, 'frame')
+
+
+@benchmark('converter.write_rgb_array_to_file[json]')
+def bench_write_json(workspace):
+    outfile = workspace.path('write.json')
+    return (lambda: converter.write_rgb_array_to_file(workspace.frame_list, outfile),
+            FRAMES, 'frame')
+
+
+@benchmark('converter.write_rgb_array_to_file[pretty]')
+def bench_write_pretty(workspace):
+    outfile = workspace.path('write.txt')
+    return (lambda: converter.write_rgb_array_to_file(workspace.frame_list, outfile,
+                                                      pretty=True),
+            FRAMES, 'frame')
+
+
+@benchmark('converter.write_rgb_array_to_file[binary]')
+def bench_write_binary(workspace):
+    outfile = workspace.path('write.nl')
+    return (lambda: converter.write_rgb_array_to_file(workspace.frames, outfile,
+                                                      file_format='binary'),
+            FRAMES, 'frame')
+
+
+@benchmark('converter.write_rgb_array_to_file[compressed]')
+def bench_write_compressed(workspace):
+    outfile = workspace.path('write-compressed.nl')
+    return (lambda: converter.write_rgb_array_to_file(workspace.smooth_frames, outfile,
+                                                      file_format='compressed'),
+            FRAMES, 'frame')
+
+
+@benchmark('converter.write_rgb_array_to_gif')
+def bench_write_gif(workspace):
+    outfile = workspace.path('pattern.gif')
+    return (lambda: converter.write_rgb_array_to_gif(workspace.frames, outfile, padding=1),
+            FRAMES, 'frame')
+
+
+@benchmark('converter.write_rgb_array_to_gif[streamed]')
+def bench_write_gif_streamed(workspace):
+    # A generator can't be sampled across its length or measured, so this is the path taken
+    # when exporting generated patterns.
+    outfile = workspace.path('streamed.gif')
+    return (lambda: converter.write_rgb_array_to_gif(iter(workspace.smooth_frames), outfile,
+                                                     padding=1),
+            FRAMES, 'frame')
+
+
+@benchmark('converter.stream_video_frames', requires='ffmpeg')
+def bench_stream_video(workspace):
+    def stream():
+        for frame in converter.stream_video_frames(workspace.video):
+            pass
+    return quiet(stream), 30, 'frame'
+
+
+@benchmark('converter.convert_video[stream]', requires='ffmpeg')
+def bench_convert_video(workspace):
+    outdir = workspace.path('converted')
+    return (quiet(lambda: converter.convert_video(workspace.video, outdir, cache_dir=None)),
+            30, 'frame')
+
+
+@benchmark('converter.convert_video[intermediate]', requires='ffmpeg')
+def bench_convert_video_intermediate(workspace):
+    def convert():
+        # ffmpeg won't overwrite the frame images, so each run needs a fresh directory.
+        outdir = tempfile.mkdtemp(dir=workspace.directory)
+        converter.convert_video(workspace.video, outdir, keep_intermediate=True)
+    return quiet(convert), 30, 'frame'
+
+
+# Pattern generators
+
+
+@benchmark('perlin._simplex_noise4d')
+def bench_simplex_noise(workspace):
+    return (lambda: perlin._simplex_noise4d((WIDTH, HEIGHT, FRAMES), (0.1, 0.1, 0.1),
+                                            cache_dir=None),
+            FRAMES, 'frame')
+
+
+@benchmark('perlin._simplex_noise4d[snoise4]')
+def bench_simplex_noise_snoise4(workspace):
+    return (lambda: perlin._simplex_noise4d((WIDTH, HEIGHT, FRAMES), (0.1, 0.1, 0.1),
+                                            backend='snoise4', cache_dir=None),
+            FRAMES, 'frame')
+
+
+@benchmark('perlin._simplex_noise4d[cached]')
+def bench_simplex_noise_cached(workspace):
+    cache_dir = workspace.path('noise')
+    perlin._simplex_noise4d((WIDTH, HEIGHT, FRAMES), (0.1, 0.1, 0.1), cache_dir=cache_dir)
+    return (lambda: perlin._simplex_noise4d((WIDTH, HEIGHT, FRAMES), (0.1, 0.1, 0.1),
+                                            cache_dir=cache_dir),
+            FRAMES, 'frame')
+
+
+@benchmark('perlin._quantize')
+def bench_quantize(workspace):
+    noise = perlin._simplex_noise4d((HEIGHT, WIDTH, FRAMES), (0.1, 0.1, 0.1), cache_dir=None)
+    return lambda: perlin._quantize(noise.copy(), 3), FRAMES, 'frame'
+
+
+@benchmark('perlin._colourize')
+def bench_colourize(workspace):
+    noise = perlin._simplex_noise4d((HEIGHT, WIDTH, FRAMES), (0.1, 0.1, 0.1), cache_dir=None)
+    return lambda: perlin._colourize(noise), FRAMES, 'frame'
+
+
+def run_checks(workspace, selected=None):
+    """ Run the byte-identity checks
+
+    :param workspace: Workspace.
+    :param selected: Names of the checks to run, or None for all of them.
+    :return: Dict mapping each check name to None if it passed or a description of the failure.
+    """
+    results = {}
+    for name, function in CHECKS.items():
+        if selected is not None and name not in selected:
+            continue
+        results[name] = function(workspace)
+        print('{:<55} {}'.format(name, 'ok' if results[name] is None else
+                                 'FAILED: ' + results[name]))
+    return results
+
+
+def run_benchmark(workspace, name, repeat=DEFAULT_REPEAT):
+    """ Time a single benchmark
+
+    The number of calls per measurement is chosen so each measurement takes at least 0.2 s.
+
+    :param workspace: Workspace.
+    :param str name: Benchmark name.
+    :param int repeat: Number of measurements to take.
+    :return: Dict with the median and minimum time per call in seconds, or the reason the
+             benchmark was skipped.
+    """
+    function, requires = BENCHMARKS[name]
+    if requires is not None and shutil.which(requires) is None:
+        return {'skipped': '{} not found'.format(requires)}
+    timed, items, unit = function(workspace)
+    timer = timeit.Timer(timed)
+    number, _ = timer.autorange()
+    times = sorted(x / number for x in timer.repeat(repeat, number))
+    return {'median_s': times[len(times) // 2], 'min_s': times[0], 'number': number,
+            'repeat': repeat, 'items': items, 'unit': unit}
+
+
+def format_result(name, result, baseline=None):
+    """ Format a benchmark result as a table row
+
+    :param str name: Benchmark name.
+    :param dict result: Result from run_benchmark().
+    :param dict baseline: Result of the same benchmark from an earlier run, if any.
+    :return: str.
+    """
+    if 'skipped' in result:
+        return '{:<45} skipped ({})'.format(name, result['skipped'])
+    line = '{:<45} {:>10.3f} ms {:>10.2f} us/{}'.format(
+        name, result['median_s'] * 1e3, result['median_s'] * 1e6 / result['items'],
+        result['unit'])
+    if baseline and 'median_s' in baseline:
+        line += '  {:>6.2f}x'.format(baseline['median_s'] / result['median_s'])
+    return line
+
+
+def find_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """ Find the benchmarks that are slower than in an earlier run
+
+    :param dict results: Benchmark results of this run.
+    :param dict baseline: Benchmark results of the earlier run.
+    :param float tolerance: Fraction a benchmark may slow down by before it counts as a
+                            regression.
+    :return: List of (name, slowdown) tuples, where slowdown is the ratio of the new to the old
+             median time.
+    """
+    regressions = []
+    for name, result in results.items():
+        old = baseline.get(name, {})
+        if 'median_s' not in result or 'median_s' not in old:
+            continue
+        slowdown = result['median_s'] / old['median_s']
+        if slowdown > 1 + tolerance:
+            regressions.append((name, slowdown))
+    return regressions
+
+
+def results_path(label):
+    """ Get the path of a stored results file
+
+    :param str label: Results label (eg a release number), or a path to a .json file.
+    :return: Path.
+    """
+    if label.endswith('.json'):
+        return label
+    return os.path.join(RESULTS_DIR, '{}.json'.format(label))
+
+
+def save_results(results, path):
+    """ Write results to a JSON file atomically
+
+    :param dict results: Results to write.
+    :param str path: Output file path.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fout:
+        json.dump(results, fout, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Nightlight playback and '
+                                                 'conversion paths')
+    parser.add_argument('-k', '--keyword', action='append',
+                        help='Only run benchmarks whose name contains this string. May be '
+                             'given more than once.')
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT,
+                        help='Number of measurements to take of each benchmark.')
+    parser.add_argument('--save', metavar='LABEL',
+                        help='Store the results as results/LABEL.json, eg for a release.')
+    parser.add_argument('--compare', metavar='LABEL',
+                        help='Compare the results to a stored run (a label or a path) and fail '
+                             'if any benchmark has regressed.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Fraction a benchmark may slow down by before it counts as a '
+                             'regression.')
+    parser.add_argument('--wire_time', action='store_true',
+                        help='Make the fake SPI bus take as long as a real transfer would at '
+                             'the board\'s baudrate.')
+    parser.add_argument('--no_checks', action='store_true',
+                        help='Skip the byte-identity checks.')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(results_path(args.compare)) as fin:
+            baseline = json.load(fin)
+
+    names = [x for x in BENCHMARKS
+             if not args.keyword or any(keyword in x for keyword in args.keyword)]
+    with tempfile.TemporaryDirectory(prefix='nightlight-bench-') as directory:
+        workspace = Workspace(directory)
+        failures = {}
+        if not args.no_checks:
+            print('Checks')
+            failures = {name: error for name, error in run_checks(workspace).items() if error}
+            print()
+
+        FakeSPI.simulate_wire_time = args.wire_time
+        print('{:<45} {:>13} {:>13}'.format('Benchmark', 'median', 'per item'))
+        results = {}
+        for name in names:
+            results[name] = run_benchmark(workspace, name, args.repeat)
+            print(format_result(name, results[name],
+                                baseline['benchmarks'].get(name) if baseline else None))
+        FakeSPI.simulate_wire_time = False
+
+    run = {'timestamp': time.time(), 'python': platform.python_version(),
+           'platform': platform.platform(), 'machine': platform.machine(),
+           'numpy': np.__version__, 'wire_time': args.wire_time, 'checks_failed': failures,
+           'benchmarks': results}
+    if args.save:
+        save_results(dict(run, label=args.save), results_path(args.save))
+        print('\nSaved results to {}'.format(results_path(args.save)))
+
+    status = 0
+    if failures:
+        print('\n{} check(s) failed.'.format(len(failures)))
+        status = 1
+    if baseline is not None:
+        regressions = find_regressions(results, baseline['benchmarks'], args.tolerance)
+        for name, slowdown in regressions:
+            print('REGRESSION: {} is {:.2f}x slower than in {}'.format(name, slowdown,
+                                                                     args.compare))
+        if regressions:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+""" startup.py
+
+Benchmarks how long each `nightlight` command takes to import what it needs, in a fresh
+interpreter each time, and which heavy dependencies it pulls in.
+
+Usage, from the repository root:
+
+    python -m benchmarks.startup                  # Time every command
+    python -m benchmarks.startup --save 0.1.0     # Store the results in results/0.1.0-startup.json
+    python -m benchmarks.startup --compare 0.1.0  # Flag commands that start slower than in 0.1.0
+    python -m benchmarks.startup --detail play    # Show the slowest imports of a command
+
+The exit status is 1 if a command imports a heavy dependency it shouldn't, or has regressed.
+
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.run import DEFAULT_TOLERANCE, find_regressions, results_path, save_results
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The modules each command imports when it runs (see nightlight.cli.main()), on top of
+# nightlight.cli itself.
+COMMANDS = {
+    'cache': [],
+    'clear': ['nightlight.base'],
+    'control': ['nightlight.control'],
+    'convert': ['nightlight.converter'],
+    'play': ['nightlight.control', 'nightlight.player'],
+}
+HEAVY_MODULES = ('numpy', 'PIL', 'matplotlib', 'noise', 'board', 'busio', 'digitalio',
+                 'asyncio')
+# Heavy modules each command must not import. Board detection only happens when a Nightlight
+# is created, and no command needs the pattern generators' dependencies.
+FORBIDDEN = {
+    'cache': HEAVY_MODULES,
+    'clear': ('PIL', 'matplotlib', 'noise', 'board', 'busio', 'digitalio', 'asyncio'),
+    'control': ('numpy', 'PIL', 'matplotlib', 'noise', 'board', 'busio', 'digitalio'),
+    'convert': ('matplotlib', 'noise', 'board', 'busio', 'digitalio', 'asyncio'),
+    'play': ('PIL', 'matplotlib', 'noise', 'board', 'busio', 'digitalio'),
+}
+DEFAULT_RUNS = 10
+
+IMPORT_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+from benchmarks import fake_hardware
+fake_hardware.install()
+import nightlight.cli
+for name in {modules!r}:
+    __import__(name)
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'heavy': [x for x in {heavy!r} if x in sys.modules]}}))
+'''
+
+
+def time_command(command, runs=DEFAULT_RUNS):
+    """ Time the imports of a command in fresh interpreters
+
+    :param str command: Command name, one of COMMANDS.
+    :param int runs: Number of interpreters to start.
+    :return: Dict with the median and minimum import time and process time in seconds, and
+             the heavy modules that were imported.
+    """
+    script = IMPORT_SCRIPT.format(modules=COMMANDS[command], heavy=HEAVY_MODULES)
+    import_times = []
+    process_times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT)
+        process_times.append(time.perf_counter() - start)
+        result = json.loads(output.decode('utf-8').splitlines()[-1])
+        import_times.append(result['seconds'])
+    return {'median_s': statistics.median(import_times), 'min_s': min(import_times),
+            'process_median_s': statistics.median(process_times), 'runs': runs,
+            'heavy': result['heavy']}
+
+
+def time_interpreter(runs=DEFAULT_RUNS):
+    """ Time how long a bare interpreter takes to start, for reference
+
+    :param int runs: Number of interpreters to start.
+    :return: Median time in seconds.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable, '-c', 'pass'])
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def show_detail(command, count=15):
+    """ Print the slowest imports of a command, from python -X importtime
+
+    :param str command: Command name, one of COMMANDS.
+    :param int count: Number of imports to show.
+    """
+    script = IMPORT_SCRIPT.format(modules=COMMANDS[command], heavy=HEAVY_MODULES)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', script], cwd=ROOT,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True,
+                             universal_newlines=True)
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), name.rstrip()))
+    print('Slowest imports of {} (cumulative):'.format(command))
+    for cumulative, name in sorted(imports, reverse=True)[:count]:
+        print('{:>10.1f} ms  {}'.format(cumulative / 1000, name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the start up time of each '
+                                                 'nightlight command')
+    parser.add_argument('commands', nargs='*', metavar='COMMAND',
+                        help='Commands to time, out of {} (default: all).'.format(
+                            ', '.join(COMMANDS)))
+    parser.add_argument('-n', '--runs', type=int, default=DEFAULT_RUNS,
+                        help='Number of interpreters to start per command.')
+    parser.add_argument('--save', metavar='LABEL',
+                        help='Store the results as results/LABEL-startup.json.')
+    parser.add_argument('--compare', metavar='LABEL',
+                        help='Compare the results to a stored run and fail if any command '
+                             'starts slower.')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Fraction a command may slow down by before it counts as a '
+                             'regression.')
+    parser.add_argument('--detail', metavar='COMMAND', choices=list(COMMANDS),
+                        help='Show the slowest imports of a command instead.')
+    args = parser.parse_args(argv)
+    for command in args.commands:
+        if command not in COMMANDS:
+            parser.error('unknown command {!r}'.format(command))
+
+    if args.detail:
+        show_detail(args.detail)
+        return 0
+
+    baseline = None
+    if args.compare:
+        with open(results_path(startup_label(args.compare))) as fin:
+            baseline = json.load(fin)
+
+    interpreter = time_interpreter(args.runs)
+    print('Bare interpreter start: {:.1f} ms\n'.format(interpreter * 1e3))
+    print('{:<10} {:>11} {:>11}  {}'.format('command', 'imports', 'process', 'heavy modules'))
+    results = {}
+    violations = []
+    for command in args.commands or COMMANDS:
+        results[command] = result = time_command(command, args.runs)
+        line = '{:<10} {:>8.1f} ms {:>8.1f} ms  {}'.format(
+            command, result['median_s'] * 1e3, result['process_median_s'] * 1e3,
+            ', '.join(result['heavy']) or '-')
+        old = baseline['benchmarks'].get(command) if baseline else None
+        if old:
+            line += '  {:.2f}x'.format(old['median_s'] / result['median_s'])
+        print(line)
+        violations.extend((command, x) for x in result['heavy'] if x in FORBIDDEN[command])
+
+    run = {'timestamp': time.time(), 'python': platform.python_version(),
+           'platform': platform.platform(), 'machine': platform.machine(),
+           'interpreter_s': interpreter, 'benchmarks': results}
+    if args.save:
+        path = results_path(startup_label(args.save))
+        save_results(dict(run, label=args.save), path)
+        print('\nSaved results to {}'.format(path))
+
+    status = 0
+    for command, module in violations:
+        print('\n{} imports {}, which it should not need'.format(command, module))
+        status = 1
+    if baseline is not None:
+        for name, slowdown in find_regressions(results, baseline['benchmarks'], args.tolerance):
+            print('REGRESSION: {} starts {:.2f}x slower than in {}'.format(name, slowdown,
+                                                                         args.compare))
+            status = 1
+    return status
+
+
+def startup_label(label):
+    """ Get the label startup results are stored under
+
+    :param str label: Results label, or a path to a .json file.
+    :return: Label or path.
+    """
+    return label if label.endswith('.json') else '{}-startup'.format(label)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -28,8 +28,11 @@
 
 * Author(s): Damien P. George, Limor Fried & Scott Shawcroft
 """
-import busio
-import digitalio
+import time
+
+import numpy as np
+
+from nightlight import transports
 
 __version__ = "0.0.0-auto.0"
 __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_DotStar.git"
@@ -46,6 +49,30 @@ BRG = (2, 0, 1)
 BGR = (2, 1, 0)
 
 
+def serpentine_order(width, height):
+    """
+    Map each pixel number of a chain wired in an "S" pattern to its position in
+    a row-major (height, width) frame. Pixel numbers run left to right on even
+    rows and right to left on odd rows.
+
+    Returns an array where element i is the flat (y * width + x) index of pixel i.
+    """
+    order = np.arange(width * height).reshape(height, width)
+    order[1::2] = order[1::2, ::-1]
+    return order.ravel()
+
+
+def brightness_bytes(brightness):
+    """
+    Vectorized version of the per-pixel brightness handling in DotStar._set_item:
+    converts an array of brightness values (0-1) to LED start bytes, three "1"
+    bits followed by 5 brightness bits.
+    """
+    # same as math.ceil(brightness * 31) & 0b00011111, with int() truncation
+    level = (32 - np.trunc(32 - np.asarray(brightness) * 31).astype(np.int64)) & 0b00011111
+    return (level | LED_START).astype(np.uint8)
+
+
 class DotStar:
     """
     A sequence of dotstars.
@@ -64,6 +91,9 @@ class DotStar:
         using 'soft' SPI). This is only a recommendation; the actual clock
         rate may be slightly different depending on what the system hardware
         can provide.
+    :param transport: Object to write frame buffers to the strip with (see
+        nightlight.transports). By default hardware SPI is used, falling back
+        to bit-banging the pins.
 
 
     Example for Gemma M0:
@@ -82,20 +112,10 @@ class DotStar:
     """
 
     def __init__(self, clock, data, n, *, brightness=1.0, auto_write=True,
-                 pixel_order=BGR, baudrate=4000000):
-        self._spi = None
-        try:
-            self._spi = busio.SPI(clock, MOSI=data)
-            while not self._spi.try_lock():
-                pass
-            self._spi.configure(baudrate=baudrate)
-
-        except (NotImplementedError, ValueError):
-            self.dpin = digitalio.DigitalInOut(data)
-            self.cpin = digitalio.DigitalInOut(clock)
-            self.dpin.direction = digitalio.Direction.OUTPUT
-            self.cpin.direction = digitalio.Direction.OUTPUT
-            self.cpin.value = False
+                 pixel_order=BGR, baudrate=4000000, transport=None):
+        if transport is None:
+            transport = transports.open_transport('auto', clock, data, baudrate)
+        self.transport = transport
         self._n = n
         # Supply one extra clock cycle for each two pixels in the strip.
         self.end_header_size = n // 16
@@ -113,7 +133,27 @@ class DotStar:
         # 0xff bytes at the end.
         for i in range(self.end_header_index, len(self._buf)):
             self._buf[i] = 0xff
+        # Writable (n, 4) view of the pixel data in _buf, used by set_frame.
+        self._pixels = np.frombuffer(self._buf, dtype=np.uint8)[
+            START_HEADER_SIZE:self.end_header_index].reshape(n, 4)
+        self._frame_orders = {}
+        # Optional nightlight.instrumentation.FrameTimings to record show() timings in.
+        self.timings = None
+        # If set, writes of a buffer identical to the one last written (and so already
+        # latched on the strip) are skipped, unless keep_alive seconds have passed since it
+        # was written. None writes every buffer.
+        self.keep_alive = None
+        self.skipped_writes = 0
+        # Copy of the last buffer written, preallocated so checking for unchanged frames
+        # allocates nothing. Only meaningful while _latched_valid is True.
+        self._latched = bytearray(len(self._buf))
+        self._latched_valid = False
+        self._latched_at = 0.0
+        # Brightness-scaled copy of _buf sent by show(), rebuilt only when _dirty.
+        self._scaled_buf = None
+        self._dirty = True
         self._brightness = 1.0
+        self._brightness_table = bytes(range(256))
         # Set auto_write to False temporarily so brightness setter does _not_
         # call show() while in __init__.
         self.auto_write = False
@@ -126,12 +166,10 @@ class DotStar:
         for i in range(START_HEADER_SIZE, self.end_header_index):
             if i % 4 != 0:
                 self._buf[i] = 0
+        self._dirty = True
+        self._latched_valid = False
         self.show()
-        if self._spi:
-            self._spi.deinit()
-        else:
-            self.dpin.deinit()
-            self.cpin.deinit()
+        self.transport.close()
 
     def __enter__(self):
         return self
@@ -180,6 +218,7 @@ class DotStar:
         self._buf[offset + 1] = rgb[self.pixel_order[0]]
         self._buf[offset + 2] = rgb[self.pixel_order[1]]
         self._buf[offset + 3] = rgb[self.pixel_order[2]]
+        self._dirty = True
 
     def __setitem__(self, index, val):
         if isinstance(index, slice):
@@ -199,6 +238,45 @@ class DotStar:
         if self.auto_write:
             self.show()
 
+    def set_frame(self, frame, brightness=None, serpentine=True, order=None):
+        """
+        Set every pixel at once from a (height, width, 3) array of RGB values,
+        where height * width is the number of pixels in the chain. An alpha
+        channel (height, width, 4) is ignored.
+
+        brightness, if specified, is a (height, width) array of per-pixel
+        brightness values between 0 and 1, as in _set_item. Otherwise every
+        pixel uses the maximum per-pixel brightness.
+
+        If serpentine is True, the chain is assumed to be wired in an "S"
+        pattern (see serpentine_order), otherwise pixels are taken in row-major
+        order. The pixel permutation is computed once per frame size. order, if
+        specified, is the permutation to use instead: element i is the flat
+        (y * width + x) index of pixel i.
+        """
+        frame = np.asarray(frame)
+        height, width = frame.shape[:2]
+        if height * width != self._n:
+            raise ValueError("Frame has {} pixels but the chain has {}."
+                             .format(height * width, self._n))
+        if order is None:
+            key = (width, height, serpentine)
+            order = self._frame_orders.get(key)
+            if order is None:
+                order = serpentine_order(width, height) if serpentine else np.arange(self._n)
+                self._frame_orders[key] = order
+
+        pixels = frame.reshape(self._n, frame.shape[2])[order]
+        if brightness is None:
+            self._pixels[:, 0] = LED_START | 0b00011111
+        else:
+            self._pixels[:, 0] = brightness_bytes(np.reshape(brightness, self._n)[order])
+        self._pixels[:, 1:] = pixels[:, self.pixel_order]
+        self._dirty = True
+
+        if self.auto_write:
+            self.show()
+
     def __getitem__(self, index):
         if isinstance(index, slice):
             out = []
@@ -225,6 +303,9 @@ class DotStar:
     @brightness.setter
     def brightness(self, brightness):
         self._brightness = min(max(brightness, 0.0), 1.0)
+        # Lookup table mapping each colour byte to its scaled value, for bytes.translate().
+        self._brightness_table = bytes(int(i * self._brightness) for i in range(256))
+        self._dirty = True
         if self.auto_write:
             self.show()
 
@@ -238,35 +319,75 @@ class DotStar:
             self.show()
         self.auto_write = auto_write
 
-    def _ds_writebytes(self, buf):
-        for b in buf:
-            for _ in range(8):
-                self.cpin.value = True
-                self.dpin.value = (b & 0x80)
-                self.cpin.value = False
-                b = b << 1
-
     def show(self):
         """Shows the new colors on the pixels themselves if they haven't already
         been autowritten.
 
         The colors may or may not be showing after this function returns because
-        it may be done asynchronously."""
-        # Create a second output buffer if we need to compute brightness
+        it may be done asynchronously. If keep_alive is set, nothing is written when
+        the strip is already showing these colors."""
+        timings = self.timings
+        if timings is not None:
+            start = timings.clock()
+        # Use a second output buffer if we need to compute brightness. It is only rebuilt
+        # when the pixels or the brightness have changed since the last call.
         buf = self._buf
-        if self.brightness < 1.0:
-            buf = bytearray(self._buf)
-            # Four empty bytes to start.
-            for i in range(START_HEADER_SIZE):
-                buf[i] = 0x00
-            for i in range(START_HEADER_SIZE, self.end_header_index):
-                buf[i] = self._buf[i] if i % 4 == 0 else int(self._buf[i] * self._brightness)
-            # Four 0xff bytes at the end.
-            for i in range(self.end_header_index, len(buf)):
-                buf[i] = 0xff
-
-        if self._spi:
-            self._spi.write(buf)
+        if self._brightness < 1.0:
+            if self._dirty or self._scaled_buf is None:
+                self._scaled_buf = self._buf.translate(self._brightness_table)
+                # The start header is all zeros, so only the LED start bytes and the end
+                # header need restoring after scaling.
+                self._scaled_buf[START_HEADER_SIZE:self.end_header_index:4] = \
+                    self._buf[START_HEADER_SIZE:self.end_header_index:4]
+                self._scaled_buf[self.end_header_index:] = self._buf[self.end_header_index:]
+                self._dirty = False
+            buf = self._scaled_buf
+
+        if timings is not None:
+            scaled = timings.clock()
+            timings.record('scale', scaled - start)
+        self._write(buf)
+        if timings is not None:
+            timings.record('spi', timings.clock() - scaled)
+
+    def show_buffer(self, buf):
+        """Writes a complete, precompiled frame buffer (start header, pixel data and end
+        header, with any brightness scaling already applied) straight to the strip.
+
+        The buffer also becomes the pixel values held by this object, so a later show(),
+        brightness change or partial update starts from the frame the strip is showing. Its
+        colours are already scaled, so with brightness below 1.0 they are scaled again if the
+        pixels or brightness change before the next whole frame is set. If keep_alive is set,
+        nothing is written when the strip is already showing this buffer."""
+        if len(buf) != len(self._buf):
+            raise ValueError("Buffer must be {} bytes, got {}.".format(len(self._buf), len(buf)))
+        timings = self.timings
+        if timings is not None:
+            start = timings.clock()
+        self._write(buf)
+        if timings is not None:
+            timings.record('spi', timings.clock() - start)
+        self._buf[:] = memoryview(buf).cast('B')
+        if self._brightness < 1.0:
+            # show() sends the buffer again as it is until the pixels or brightness change.
+            if self._scaled_buf is None:
+                self._scaled_buf = bytearray(len(self._buf))
+            self._scaled_buf[:] = self._buf
+            self._dirty = False
         else:
-            self._ds_writebytes(buf)
-            self.cpin.value = False
+            self._dirty = True
+
+    def _write(self, buf):
+        if self.keep_alive is not None:
+            # Comparing against a copy of the last buffer is a memcmp, far cheaper than the
+            # write it saves.
+            view = memoryview(buf).cast('B')
+            now = time.monotonic()
+            if self._latched_valid and self._latched == view and \
+                    now - self._latched_at < self.keep_alive:
+                self.skipped_writes += 1
+                return
+            self._latched[:] = view
+            self._latched_valid = True
+            self._latched_at = now
+        self.transport.write(buf)
@@ -6,80 +6,440 @@ associated methods for writing pixels and playing patterns.
 """
 from __future__ import annotations
 
-import time
-from multiprocessing import Queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from typing import Tuple
 
-try:
-    import board
-except NotImplementedError:
-    # If you try to import 'board' on a PC, it will fail to detect a recognized board and raise
-    # an exception. If this happens, create a mock board object so that at least the converter
-    # module can be run.
-    print('WARNING: No valid board (Raspberry Pi, Arduino, etc.) detected. You will not'
-          ' be able to play anything.')
-    from unittest.mock import Mock
-    board = Mock(['SCK', 'MOSI'])
+import numpy as np
 
-from nightlight import adafruit_dotstar
+from nightlight import adafruit_dotstar, compiler, pipeline, sources, transports
+from nightlight.instrumentation import FrameTimings
+from nightlight.scheduler import FrameScheduler
+
+# Seconds after which an unchanged frame is written to the strip again anyway.
+DEFAULT_KEEP_ALIVE = 1.0
+
+
+def get_board():
+    """ Import the 'board' module, which detects the board (Raspberry Pi, Arduino, etc.)
+
+    Board detection is slow on small boards, so it is only done when a Nightlight is created.
+
+    :return: The board module, or a mock board if no valid board was detected.
+    """
+    try:
+        import board
+    except NotImplementedError:
+        # If you try to import 'board' on a PC, it will fail to detect a recognized board and
+        # raise an exception. If this happens, create a mock board object so that at least the
+        # converter module can be run.
+        print('WARNING: No valid board (Raspberry Pi, Arduino, etc.) detected. You will not'
+              ' be able to play anything.')
+        from unittest.mock import Mock
+        board = Mock(['SCK', 'MOSI'])
+    return board
 
 
 class Nightlight:
 
-    def __init__(self, width=30, height=18, clock_pin=board.SCK, data_pin=board.MOSI,
+    def __init__(self, width=30, height=18, clock_pin=None, data_pin=None,
                  baudrate=4000000, max_brightness=1.0, default_frame_rate=30,
-                 queue: Queue = Queue()):
+                 late_policy='drop', keep_alive=DEFAULT_KEEP_ALIVE, pipeline_depth=0,
+                 transport='auto', device=None, layout=None):
+        # transport is a name from transports.TRANSPORTS, with the spidev device or output
+        # file in device, or a transport object. Only the blinka transports need the pins.
+        # A layout (see layout.py) splits the frame across several chains, each with its own
+        # transport, and sets the width and height.
+        if layout is not None:
+            width, height = layout.width, layout.height
+            transport = layout.open_transport(baudrate,
+                                              get_board() if layout.needs_pins() else None)
+        elif isinstance(transport, str):
+            if transports.needs_pins(transport) and (clock_pin is None or data_pin is None):
+                board = get_board()
+                clock_pin = board.SCK if clock_pin is None else clock_pin
+                data_pin = board.MOSI if data_pin is None else data_pin
+            transport = transports.open_transport(transport, clock_pin, data_pin, baudrate,
+                                                  device)
         self._width = width
         self._height = height
         self._max_brightness = max_brightness
         self._default_frame_rate = default_frame_rate
         self._leds = adafruit_dotstar.DotStar(clock_pin, data_pin, n=(self._width * self._height),
                                               baudrate=baudrate, pixel_order=adafruit_dotstar.RGB,
-                                              auto_write=False)
-        self.queue = queue
+                                              auto_write=False, transport=transport)
+        # Frames identical to the one already latched on the strip are only re-sent this often.
+        self._leds.keep_alive = keep_alive or None
+        # The frame object last composed into the DotStar buffer, so held frames are skipped.
+        self._composed = None
+        # Number of frames to compose ahead on a producer thread (see pipeline.py), or 0 to
+        # compose each frame on the render thread.
+        self.pipeline_depth = pipeline_depth
+        self.layout = layout
+        # Frame index (y * width + x) of each pixel number, and the pixel number of each index.
+        self._order = compiler.serpentine_order(width, height) if layout is None else layout.order
+        self._pixel_numbers = np.argsort(self._order)
+        # Directory precompiled patterns are cached in.
+        self.compile_cache_dir = compiler.COMPILED_CACHE_DIR
+        # Commands are handed to the render loop through a deque (append and popleft are
+        # atomic), so checking for them on each frame costs no more than a length check.
+        self.commands = deque()
+        self._wakeup = threading.Event()
+        self._playlist = []
+        self._pattern_index = 0
+        self._next_index = None
+        self._paused = False
+        self._stopped = False
+        self.scheduler = FrameScheduler(default_frame_rate, late_policy=late_policy)
+        self.timings = None
 
-    def play_patterns(self, patterns: list[list[list[int]]]):
-        while True:
-            for pattern in patterns:
-                self.write_colour((0, 0, 0))
-                self.play_pattern(pattern)
+    def enable_timings(self, window=None):
+        """ Start timing each stage of the playback hot path (see instrumentation.py)
+
+        :param window: Number of recent frames to keep timings for.
+        :return: The instrumentation.FrameTimings object that timings are recorded in.
+        """
+        self.timings = FrameTimings() if window is None else FrameTimings(window)
+        self._leds.timings = self.timings
+        return self.timings
 
-    def play_pattern(self, pattern, frame_rate=None):
+    def play_patterns(self, patterns: list[list[list[int]]], precompile=False, blank=True):
+        """ Play a list of patterns on a loop
+
+        While each pattern plays, the next one in the playlist is prepared on a background
+        thread - its first frames are read (and decoded or generated), or it is compiled if
+        precompile is set - so it starts on the first frame deadline after the current pattern
+        ends instead of stalling playback.
+
+        :param patterns: Nightlight patterns to play. Each pattern may be any re-iterable
+                         sequence of frames, such as a nested list, a formats.BinaryPattern,
+                         a sources.FileFrameSource that streams its frames from disk, or a
+                         sources.GeneratorSource that generates its frames as they are played.
+        :param precompile: If True, compile each pattern to SPI wire frames (see compiler.py)
+                           before playing it. Compiled patterns are cached on disk, so each
+                           pattern is only compiled once for a given brightness. Brightness
+                           changes take effect from the next pattern. Generated patterns are
+                           always played live.
+        :param blank: If True, turn the board off between patterns. If False, the last frame
+                      of each pattern stays up until the first frame of the next is due.
+        """
+        # All patterns share one timeline, so a long playlist stays locked to the clock.
+        self._playlist = list(patterns)
+        self._pattern_index = 0
+        self._stopped = False
+        self.scheduler.start()
+        # (playlist, index, compile settings, future, stop event) of the pattern being prepared.
+        prefetched = None
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='nightlight-prefetch')
+        try:
+            while not self._stopped:
+                if not self._playlist:
+                    self._wait_for_commands()
+                    continue
+                playlist = self._playlist
+                settings = self._compile_settings()
+                pattern = None
+                if prefetched is not None:
+                    if prefetched[0] is playlist and prefetched[1] == self._pattern_index and \
+                            (not precompile or prefetched[2] == settings):
+                        if not self._wait_for_prefetch(prefetched[3]):
+                            # Stopped, or moved to another pattern, while waiting for it.
+                            if self._next_index is not None and self._playlist:
+                                self._pattern_index = self._next_index % len(self._playlist)
+                            continue
+                        try:
+                            pattern = prefetched[3].result()
+                        except Exception:
+                            # Prepare it again below, so the error is raised here.
+                            pass
+                    else:
+                        # The playlist, position or brightness changed, so the prefetched
+                        # pattern isn't wanted. Stop preparing it before preparing another, so
+                        # the two don't compete for the CPU.
+                        self._cancel_prefetch(prefetched)
+                if pattern is None:
+                    pattern = self._prepare_pattern(playlist[self._pattern_index], precompile,
+                                                    settings)
+                next_index = (self._pattern_index + 1) % len(playlist)
+                stop = threading.Event()
+                prefetched = (playlist, next_index, settings, executor.submit(
+                    self._prepare_pattern, playlist[next_index], precompile, settings, stop),
+                              stop)
+
+                if blank:
+                    self.write_colour((0, 0, 0))
+                self._next_index = None
+                self.play_pattern(pattern, restart=False)
+                if self._next_index is None:
+                    self._next_index = self._pattern_index + 1
+                if self._playlist:
+                    self._pattern_index = self._next_index % len(self._playlist)
+        finally:
+            # Don't wait for a pattern that is still being prepared: abort it and return.
+            if prefetched is not None:
+                prefetched[4].set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _wait_for_prefetch(self, future):
+        """ Wait for a pattern being prepared in the background, applying commands meanwhile
+
+        :param future: Future of the pattern being prepared.
+        :return: True if the pattern is ready, or False if a command stopped playback or moved
+                 to another pattern first.
+        """
+        future.add_done_callback(lambda _: self._wakeup.set())
+        self._next_index = None
+        while not future.done():
+            self._wakeup.wait()
+            self._process_commands()
+            if self._stopped or self._next_index is not None:
+                return False
+        return True
+
+    @staticmethod
+    def _cancel_prefetch(prefetched):
+        """ Stop preparing a prefetched pattern and wait for the worker to finish with it
+
+        :param tuple prefetched: (playlist, index, settings, future, stop event) from
+                                 play_patterns().
+        """
+        prefetched[4].set()
+        if not prefetched[3].cancel():
+            wait([prefetched[3]])
+
+    def _compile_settings(self):
+        """ Get the brightness settings patterns are compiled with
+
+        :return: Tuple of (max_brightness, DotStar brightness).
+        """
+        return self._max_brightness, self._leds.brightness
+
+    def _prepare_pattern(self, pattern, precompile, settings, stop=None):
+        """ Get a pattern ready to play, possibly on a background thread
+
+        :param pattern: Nightlight pattern from the playlist.
+        :param bool precompile: If True, compile the pattern, unless it is generated.
+        :param tuple settings: Brightness settings from _compile_settings() to compile with.
+        :param stop: Optional threading.Event that aborts compiling when set.
+        :return: compiler.CompiledPattern, or a single-use sources.PrefetchedSource with the
+                 pattern's first frames already read.
+        """
+        if precompile and not isinstance(pattern, sources.GeneratorSource):
+            max_brightness, brightness = settings
+            return compiler.compile_pattern(pattern, self._width, self._height,
+                                            max_brightness=max_brightness,
+                                            pixel_order=self._leds.pixel_order,
+                                            brightness=brightness,
+                                            cache_dir=self.compile_cache_dir,
+                                            layout=self.layout, stop=stop)
+        return sources.PrefetchedSource(pattern)
+
+    def compile_pattern(self, pattern):
+        """ Compile a pattern to SPI wire frames for this board
+
+        :param pattern: Nightlight pattern to compile.
+        :return: compiler.CompiledPattern that can be passed to play_pattern().
+        """
+        return compiler.compile_pattern(pattern, self._width, self._height,
+                                        max_brightness=self._max_brightness,
+                                        pixel_order=self._leds.pixel_order,
+                                        brightness=self._leds.brightness,
+                                        cache_dir=self.compile_cache_dir,
+                                        layout=self.layout)
+
+    def play_pattern(self, pattern, frame_rate=None, restart=True):
         """ Write a pattern to the Nightlight
 
-        :param pattern: Nightlight pattern to write.
+        Frames are shown at absolute deadlines kept by self.scheduler, so slow frames don't
+        push later frames back. Late frames are handled according to the scheduler's late
+        frame policy (see scheduler.py). A frame that is the same object as the previous frame
+        (a hold, see sources.py) is not composed again, and frames identical to what the strip
+        is already showing are not written, except to keep it alive.
+
+        If self.pipeline_depth is set, frames are decoded and composed that many frames ahead
+        on a producer thread (see pipeline.py), and this loop only writes them.
+
+        :param pattern: Nightlight pattern to write, or a compiler.CompiledPattern.
         :param frame_rate: Frame rate in frames per second.
+        :param restart: If True, start a new timeline with the first frame due now. If False,
+                        continue the scheduler's current timeline.
         """
         if frame_rate is None:
             frame_rate = self._default_frame_rate
-        time_per_frame = 1.0 / frame_rate
+        self.scheduler.frame_rate = frame_rate
+        if restart:
+            self.scheduler.start()
+
+        compiled = isinstance(pattern, compiler.CompiledPattern)
+        if self.pipeline_depth and not compiled:
+            pattern = pipeline.RenderPipeline(pattern, self._compose_buffer,
+                                              compiler.frame_size(len(self._order)),
+                                              self.pipeline_depth, self.timings)
+            compiled = True
+            try:
+                self._play_frames(pattern, compiled)
+            finally:
+                pattern.close()
+        else:
+            self._play_frames(pattern, compiled)
 
-        last_frame = time.time()
+    def _play_frames(self, pattern, compiled):
+        """ Play frames at the scheduler's deadlines
+
+        :param pattern: Iterable of frames, or of wire frame buffers if compiled.
+        :param bool compiled: True if the frames are wire frame buffers.
+        """
         for frame in pattern:
-            if not self.queue.empty():
-                command = self.queue.get()
-                if command.startswith("brightness"):
-                    brightness_value = float(command.split("brightness")[1].strip())
-                    print(f"Updating brightness to {brightness_value}")
-                    self._max_brightness = brightness_value
-
-            for y, row in enumerate(frame):
-                for x, pixel in enumerate(row):
-                    self._write_pixel(x, y, pixel)
-            self._leds.show()
-            self._sleep_frame(last_frame, time_per_frame)
-            last_frame = time.time()
-
-    def _sleep_frame(self, last_frame, time_per_frame):
-        """ Sleep between frames to write to the board at a correct frame rate
-
-        :param last_frame: Timestamp of when the last frame was written.
-        :param time_per_frame: The total time to wait on each frame.
-        """
-        time_elapsed = time.time() - last_frame
-        time_to_wait = time_per_frame - time_elapsed
-        if time_to_wait > 0:
-            time.sleep(time_to_wait)
+            if self.commands or self._paused:
+                self._process_commands()
+                if self._next_index is not None or self._stopped:
+                    break
+            if not self.scheduler.next_frame():
+                continue
+
+            timings = self.timings
+            if timings is not None:
+                timings.frame_started()
+                start = timings.clock()
+            if not compiled and frame is not self._composed:
+                self._composed = frame
+                if isinstance(frame, np.ndarray):
+                    self._write_frame(frame)
+                else:
+                    for y, row in enumerate(frame):
+                        for x, pixel in enumerate(row):
+                            self._write_pixel(x, y, pixel)
+            if timings is not None:
+                composed = timings.clock()
+                if not compiled:
+                    timings.record('compose', composed - start)
+            self.scheduler.wait()
+            if timings is not None:
+                timings.record('sleep', timings.clock() - composed)
+
+            if compiled:
+                self._leds.show_buffer(frame)
+            else:
+                self._leds.show()
+
+    def _compose_buffer(self, frame, out):
+        """ Compose a frame into a wire frame buffer with the current brightness settings
+
+        :param frame: Frame of shape (height, width, 3), nested list or array.
+        :param out: uint8 array of compiler.frame_size() bytes to fill.
+        """
+        compiler.compile_frame(frame, self._order, self._max_brightness,
+                               self._leds.pixel_order, self._leds.brightness, out=out)
+
+    def send_command(self, command, **kwargs):
+        """ Queue a command for the render loop
+
+        Commands take effect at the next frame boundary (or straight away when paused). This
+        method is thread-safe and never blocks.
+
+        Commands:
+            brightness value=<float>   Set the maximum global brightness.
+            pause / resume             Freeze or continue playback.
+            next / previous            Skip to the next or previous pattern in the playlist.
+            load patterns=<list>       Replace the playlist and start playing it.
+            stats                      Get playback statistics.
+            exit                       Stop playback.
+
+        :param str command: Command name.
+        :param kwargs: Command arguments.
+        :return: concurrent.futures.Future resolved with the command's result.
+        """
+        future = Future()
+        self.commands.append((command, kwargs, future))
+        self._wakeup.set()
+        return future
+
+    def _process_commands(self):
+        """ Apply any queued commands, blocking while playback is paused """
+        was_paused = self._paused
+        while True:
+            self._wakeup.clear()
+            while self.commands:
+                command, kwargs, future = self.commands.popleft()
+                try:
+                    future.set_result(self._apply_command(command, **kwargs))
+                except Exception as err:
+                    future.set_exception(err)
+            if not self._paused or self._stopped or self._next_index is not None:
+                break
+            was_paused = True
+            self._wakeup.wait()
+        if was_paused and not self._paused:
+            # Don't try to make up for the time spent paused.
+            self.scheduler.start()
+            if self.timings is not None:
+                self.timings.interrupt()
+
+    def _wait_for_commands(self):
+        """ Block until a command arrives and apply it """
+        self._wakeup.wait()
+        self._process_commands()
+
+    def _apply_command(self, command, **kwargs):
+        """ Apply a single command on the render thread
+
+        :param str command: Command name, see send_command().
+        :param kwargs: Command arguments.
+        :return: The command's result.
+        """
+        if command == 'brightness':
+            if kwargs.get('value') is None:
+                raise ValueError('brightness requires a value')
+            brightness_value = float(kwargs['value'])
+            print(f"Updating brightness to {brightness_value}")
+            self._max_brightness = brightness_value
+            self._composed = None
+        elif command == 'pause':
+            self._paused = True
+        elif command == 'resume':
+            self._paused = False
+        elif command == 'next':
+            self._next_index = self._pattern_index + 1
+        elif command == 'previous':
+            self._next_index = self._pattern_index - 1
+        elif command == 'load':
+            if kwargs.get('patterns') is None:
+                raise ValueError('load requires a list of patterns')
+            self._playlist = list(kwargs['patterns'])
+            self._next_index = 0
+            self._pattern_index = 0
+        elif command == 'stats':
+            return self.stats()
+        elif command == 'exit':
+            self._stopped = True
+        else:
+            raise ValueError('Unknown command {!r}'.format(command))
+        return None
+
+    def stats(self):
+        """ Get playback statistics
+
+        :return: Dict of playback state and frame timing statistics.
+        """
+        result = {'pattern_index': self._pattern_index, 'patterns': len(self._playlist),
+                  'paused': self._paused, 'max_brightness': self._max_brightness,
+                  'skipped_writes': self._leds.skipped_writes}
+        result.update(self.scheduler.stats())
+        if self.timings is not None:
+            result['timings'] = self.timings.summary()
+        return result
+
+    def _write_frame(self, frame: np.ndarray):
+        """ Write a whole frame to the board in one step
+
+        Equivalent to calling _write_pixel() for every pixel of the frame, but the serpentine
+        mapping and brightness calculation are done on the whole array at once.
+
+        :param frame: Array of shape (height, width, 3) of RGB values.
+        """
+        self._leds.set_frame(frame, compiler.pixel_brightness(frame, self._max_brightness),
+                             order=self._order)
 
     def _write_pixel(self, x: int, y: int, colour: Tuple[int, int, int]):
         """ Write a single pixel to its x and y coordinate
@@ -93,13 +453,14 @@ class Nightlight:
                > > > > > > ↓
                   ...
 
+        With a layout, each chain is wired this way within its own rectangle, and pixel
+        numbers run through each chain in turn.
+
         :param x: The x coordinate of the pixel to write.
         :param y: The y coordinate of the pixel to write
         :param colour: RGB tuple of colour to write.
         """
-        if y % 2:
-            x = self._width - x - 1
-        pixel_number = y * self._width + x
+        pixel_number = int(self._pixel_numbers[y * self._width + x])
         pixel = self._calculate_pixel(colour)
         self._leds[pixel_number] = pixel
 
@@ -133,5 +494,6 @@ class Nightlight:
 
         :param colour: RGB colour to write to the board.
         """
+        self._composed = None
         self._leds.fill(colour)
         self._leds.show()
@@ -0,0 +1,188 @@
+""" cache.py
+
+This module contains a simple on-disk cache used to keep the results of expensive steps
+(such as compiling a pattern to SPI frames) between runs.
+
+Entries are plain files named after their key, written atomically so a crash or a concurrent
+run never leaves a half-written entry behind. A cache can be given a size limit, in which case
+the least recently used entries are evicted whenever a new entry takes it over the limit.
+
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                                os.path.join(os.path.expanduser('~'), '.cache')),
+                                 'nightlight')
+CONVERTED_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, 'converted')
+# The conversion cache is opt-in, and kept small since it usually lives on an SD card.
+CONVERTED_CACHE_SIZE = 256 * 1024 ** 2
+COMPILED_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, 'compiled')
+NOISE_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, 'noise')
+
+
+CacheEntry = namedtuple('CacheEntry', ['key', 'path', 'size', 'last_used'])
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """ Compute the SHA-256 digest of a file's contents
+
+    :param str path: Path to the file to hash.
+    :param int chunk_size: Number of bytes to read at a time.
+    :return: Hex digest of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def make_key(*parts):
+    """ Build a cache key from any number of parameters
+
+    :param parts: Values that together identify a cache entry. Their repr() is hashed, so
+                  they should be simple types (str, int, float, tuple).
+    :return: Hex digest identifying the parameters.
+    """
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    """ A directory of cached files, one per key
+
+    :param str directory: Directory to store entries in. Created on first write.
+    :param str suffix: File extension to use for entries.
+    :param int max_size: Maximum total size of all entries in bytes, or None for no limit.
+    """
+
+    def __init__(self, directory, suffix='', max_size=None):
+        self.directory = directory
+        self.suffix = suffix
+        self.max_size = max_size
+
+    def path(self, key):
+        """ Get the path an entry is (or would be) stored at
+
+        :param str key: Cache key.
+        :return: Path to the entry.
+        """
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """ Look up an entry, marking it as recently used
+
+        :param str key: Cache key.
+        :return: Path to the cached file, or None if there is no entry for the key.
+        """
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, write):
+        """ Create an entry atomically
+
+        :param str key: Cache key, or None if the key depends on the contents, in which case
+                        write returns it.
+        :param write: Callable that takes a file path and writes the entry's contents to it.
+        :return: Path to the new entry.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            written_key = write(tmp_path)
+            if key is None:
+                key = written_key
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if self.max_size is not None:
+            self.prune(self.max_size, keep=(key,))
+        return self.path(key)
+
+    def put_file(self, key, path):
+        """ Create an entry by copying an existing file
+
+        :param str key: Cache key.
+        :param str path: Path of the file to copy into the cache.
+        :return: Path to the new entry.
+        """
+        return self.put(key, lambda tmp_path: shutil.copyfile(path, tmp_path))
+
+    def remove(self, key):
+        """ Delete an entry if it exists
+
+        :param str key: Cache key.
+        """
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def keys(self, prefix=''):
+        """ List the keys of all entries
+
+        :param str prefix: Only return keys starting with this prefix.
+        :return: List of cache keys.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return [x[:len(x) - len(self.suffix)] for x in os.listdir(self.directory)
+                if x.startswith(prefix) and x.endswith(self.suffix) and not x.endswith('.tmp')]
+
+    def entries(self):
+        """ List all entries, least recently used first
+
+        :return: List of CacheEntry tuples.
+        """
+        entries = []
+        for key in self.keys():
+            path = self.path(key)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append(CacheEntry(key, path, stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda x: x.last_used)
+
+    def size(self):
+        """ Get the total size of all entries
+
+        :return: Size in bytes.
+        """
+        return sum(x.size for x in self.entries())
+
+    def prune(self, max_size, keep=()):
+        """ Evict least recently used entries until the cache fits in max_size
+
+        :param int max_size: Maximum total size of all entries in bytes.
+        :param keep: Keys that must not be evicted.
+        :return: List of the CacheEntry tuples that were evicted.
+        """
+        entries = self.entries()
+        total = sum(x.size for x in entries)
+        evicted = []
+        for entry in entries:
+            if total <= max_size:
+                break
+            if entry.key in keep:
+                continue
+            self.remove(entry.key)
+            total -= entry.size
+            evicted.append(entry)
+        return evicted
+
+    def clear(self):
+        """ Remove every entry
+
+        :return: List of the CacheEntry tuples that were removed.
+        """
+        return self.prune(0)
@@ -1,9 +1,22 @@
 """ cli.py
 
+Each command imports the modules it needs when it runs, so that starting a command never pays
+for the heavy dependencies of another (numpy, PIL, matplotlib, board detection...). Only
+modules with no heavy imports of their own are imported at the top of this module. See
+benchmarks/startup.py.
+
 """
 import argparse
+import json
+import os
+import sys
+
+from nightlight import cache, scheduler, transports
 
-from nightlight import base, converter, player
+MEGABYTE = 1024 * 1024
+CACHES = {'converted': (cache.CONVERTED_CACHE_DIR, '.nl'),
+          'compiled': (cache.COMPILED_CACHE_DIR, '.apa102'),
+          'noise': (cache.NOISE_CACHE_DIR, '.npy')}
 
 
 def main():
@@ -15,17 +28,84 @@ def main():
     configure_clear_parser(subparsers)
     configure_convert_parser(subparsers)
     configure_play_parser(subparsers)
+    configure_cache_parser(subparsers)
+    configure_control_parser(subparsers)
 
     args = parser.parse_args()
     if args.command == 'clear':
-        base.Nightlight().write_colour((0, 0, 0))
+        from nightlight import base
+        base.Nightlight(transport=args.transport, device=args.device,
+                        layout=get_layout(args)).write_colour((0, 0, 0))
     if args.command == 'convert':
-        converter.process_video(args.path, args.outdir, resolution=(args.width, args.height),
-                                fps=args.fps, scale_method=args.scale_method,
-                                contrast=args.contrast, brightness=args.brightness,
-                                saturation=args.saturation, gamma=args.gamma)
+        from nightlight import converter
+        if args.format not in converter.FILE_FORMATS:
+            parser.error('argument --format: invalid choice: {!r} (choose from {})'.format(
+                args.format, ', '.join(map(repr, converter.FILE_FORMATS))))
+        results = converter.process_video(args.path, args.outdir,
+                                          resolution=(args.width, args.height), fps=args.fps,
+                                          file_format=args.format,
+                                          keep_intermediate=args.keep_intermediate,
+                                          jobs=args.jobs,
+                                          cache_dir=args.cache_dir if args.cache else None,
+                                          cache_size=int(args.cache_size * MEGABYTE),
+                                          scale_method=args.scale_method,
+                                          contrast=args.contrast, brightness=args.brightness,
+                                          saturation=args.saturation, gamma=args.gamma)
+        if None in results.values():
+            sys.exit(1)
     elif args.command == 'play':
-        player.play_nightlight_files(args.path, args.max_brightness, args.frame_rate)
+        from nightlight import control, player
+        player.play_nightlight_files(args.path, args.max_brightness, args.frame_rate,
+                                     precompile=args.precompile, late_policy=args.late_policy,
+                                     socket_path=None if args.no_socket else
+                                     args.socket or control.DEFAULT_SOCKET_PATH,
+                                     stats=args.stats, stats_file=args.stats_file,
+                                     stats_interval=args.stats_interval,
+                                     keep_alive=args.keep_alive,
+                                     pipeline_depth=args.pipeline_depth,
+                                     blank=not args.no_blank, transport=args.transport,
+                                     device=args.device, layout=get_layout(args))
+    elif args.command == 'cache':
+        run_cache_command(args)
+    elif args.command == 'control':
+        from nightlight import control
+        kwargs = {}
+        if args.value is not None:
+            if args.control_command == 'load':
+                kwargs['path'] = os.path.abspath(args.value)
+            else:
+                kwargs['value'] = args.value
+        response = control.send_command(args.control_command,
+                                        args.socket or control.DEFAULT_SOCKET_PATH, **kwargs)
+        print(json.dumps(response.get('result') if response['ok'] else response, indent=2))
+        if not response['ok']:
+            sys.exit(1)
+
+
+def run_cache_command(args):
+    """ List, prune or clear the on-disk caches
+
+    :param args: Parsed 'cache' arguments.
+    """
+    names = list(CACHES) if args.name == 'all' else [args.name]
+    for name in names:
+        directory, suffix = CACHES[name]
+        disk_cache = cache.DiskCache(directory, suffix=suffix)
+        if args.action == 'list':
+            entries = disk_cache.entries()
+            print('{} cache ({}): {} entries, {:.1f} MB'.format(
+                name, directory, len(entries), sum(x.size for x in entries) / MEGABYTE))
+            for entry in reversed(entries):
+                print('  {}  {:10.1f} MB'.format(entry.key, entry.size / MEGABYTE))
+        else:
+            if args.action == 'clear':
+                removed = disk_cache.clear()
+            elif args.max_size is None:
+                raise SystemExit('prune requires --max_size')
+            else:
+                removed = disk_cache.prune(int(args.max_size * MEGABYTE))
+            print('{} cache: removed {} entries ({:.1f} MB)'.format(
+                name, len(removed), sum(x.size for x in removed) / MEGABYTE))
 
 
 def configure_clear_parser(subparsers):
@@ -34,6 +114,38 @@ def configure_clear_parser(subparsers):
     :param subparsers: The argparse subparsers object to add the arguments to.
     """
     clear_parser = subparsers.add_parser('clear', help='Turn off all the lights.')
+    add_transport_arguments(clear_parser)
+
+
+def add_transport_arguments(parser):
+    """ Add the arguments that choose how to write to the strip to a parser
+
+    :param parser: The argparse parser to add the arguments to.
+    """
+    parser.add_argument('-t', '--transport', choices=transports.TRANSPORTS, default='auto',
+                        help='How to write to the strip: hardware SPI through blinka (busio),'
+                        ' bit-banged pins (bitbang), a Linux spidev device (spidev), or a file'
+                        ' or pipe (file). auto uses busio, falling back to bitbang.')
+    parser.add_argument('--device', default=None,
+                        help='spidev device for the spidev transport (default: {}), or the'
+                        ' file or pipe to write to for the file transport.'.format(
+                            transports.DEFAULT_SPIDEV))
+    parser.add_argument('--layout', default=None,
+                        help='JSON file that splits the board across several chains, each with'
+                        ' its own transport and device (see nightlight/layout.py). Overrides'
+                        ' --transport and --device.')
+
+
+def get_layout(args):
+    """ Load the layout file given with --layout
+
+    :param args: Parsed arguments.
+    :return: layout.Layout, or None if no layout file was given.
+    """
+    if args.layout is None:
+        return None
+    from nightlight import layout
+    return layout.load_layout(args.layout)
 
 
 def configure_convert_parser(subparsers):
@@ -52,6 +164,26 @@ def configure_convert_parser(subparsers):
                                 help='Height in pixels to scale video to.')
     convert_parser.add_argument('-f', '--fps', type=int, default=30,
                                 help='Frames per second to use when converting the video to frames')
+    convert_parser.add_argument('--format', default='json',
+                                help='Nightlight file format to write: json, binary (fastest to'
+                                ' play) or compressed (smallest, for smooth animations).')
+    convert_parser.add_argument('--keep_intermediate', action='store_true',
+                                help='Save the scaled video and frame images alongside the'
+                                ' Nightlight file instead of piping frames straight from ffmpeg.')
+    convert_parser.add_argument('-j', '--jobs', type=int, default=1,
+                                help='Number of videos to convert in parallel.')
+    convert_parser.add_argument('--cache', action='store_true',
+                                help='Cache converted files, so converting the same video with'
+                                ' the same settings again just copies the cached file. Off by'
+                                ' default, since the cache takes extra disk space.')
+    convert_parser.add_argument('--cache_dir', default=cache.CONVERTED_CACHE_DIR,
+                                help='Directory to cache converted files in with --cache'
+                                ' (default: %(default)s).')
+    convert_parser.add_argument('--cache_size', type=float,
+                                default=cache.CONVERTED_CACHE_SIZE / MEGABYTE,
+                                help='Maximum size of the conversion cache in MB (default:'
+                                ' %(default)g). Least recently used files are evicted when it is'
+                                ' exceeded.')
     convert_parser.add_argument('-s', '--scale_method', default='bicubic',
                                 help='Scaling method to use (bicubic, neighbor, gauss, etc.)')
     convert_parser.add_argument('-c', '--contrast', type=float, default=1.0, help='-1000.0 to 1000.0')
@@ -67,7 +199,73 @@ def configure_play_parser(subparsers):
     """
     play_parser = subparsers.add_parser('play', help='Play Nightlight files on a board.')
     play_parser.add_argument('path', help='Path to a Nightlight file or directory of Nightlight files.')
+    add_transport_arguments(play_parser)
     play_parser.add_argument('-b', '--max_brightness', type=float, default=0.5,
                              help='The maximum global brightness to use (0.0 to 1.0).')
     play_parser.add_argument('-f', '--frame_rate', type=int, default=30,
                              help='Frame rate in frames-per-second.')
+    play_parser.add_argument('-l', '--late_policy', choices=scheduler.LATE_POLICIES,
+                             default='drop',
+                             help='What to do with frames that miss their deadline: drop them to'
+                             ' stay in sync with the clock, catch up by playing them back to'
+                             ' back, or stretch the timeline.')
+    play_parser.add_argument('--socket', default=None,
+                             help='Unix domain socket to serve control commands on (default:'
+                             ' $XDG_RUNTIME_DIR/nightlight.sock).')
+    play_parser.add_argument('--no_socket', action='store_true',
+                             help='Do not start the control server.')
+    play_parser.add_argument('--stats', action='store_true',
+                             help='Time each stage of playback and print a summary (fps, dropped'
+                             ' frames, p50/p95/p99 stage times) every --stats_interval seconds.')
+    play_parser.add_argument('--stats_file', default=None,
+                             help='Write playback statistics to this file as JSON every'
+                             ' --stats_interval seconds.')
+    play_parser.add_argument('--stats_interval', type=float, default=5.0,
+                             help='Seconds between statistics reports.')
+    play_parser.add_argument('--keep_alive', type=float, default=1.0,
+                             help='Frames the strip is already showing are skipped, and only'
+                             ' written again after this many seconds. 0 writes every frame.')
+    play_parser.add_argument('--pipeline_depth', type=int, default=3,
+                             help='Number of frames to decode and compose ahead on a separate'
+                             ' thread, so slow frames do not delay the write. 0 composes each'
+                             ' frame just before it is shown.')
+    play_parser.add_argument('--no_blank', action='store_true',
+                             help='Go straight from one pattern to the next instead of turning'
+                             ' the lights off in between.')
+    play_parser.add_argument('--precompile', action='store_true',
+                             help='Compile patterns to SPI frames before playing them. Compiled'
+                             ' patterns are cached, so playback after the first loop is cheaper.')
+
+
+def configure_cache_parser(subparsers):
+    """ Add the 'cache' arguments to an ArgumentParser object's subparsers
+
+    :param subparsers: The argparse subparsers object to add the arguments to.
+    """
+    cache_parser = subparsers.add_parser('cache', help='Inspect and prune the on-disk caches.')
+    cache_parser.add_argument('action', choices=['list', 'prune', 'clear'],
+                              help='List cache entries, evict least recently used entries down to'
+                              ' --max_size, or remove every entry.')
+    cache_parser.add_argument('name', nargs='?', choices=list(CACHES) + ['all'], default='all',
+                              help='Which cache to act on (default: all).')
+    cache_parser.add_argument('-m', '--max_size', type=float, default=None,
+                              help='Size in MB to prune the cache down to.')
+
+
+def configure_control_parser(subparsers):
+    """ Add the 'control' arguments to an ArgumentParser object's subparsers
+
+    :param subparsers: The argparse subparsers object to add the arguments to.
+    """
+    control_parser = subparsers.add_parser('control', help='Send a command to a running player.')
+    control_parser.add_argument('control_command', metavar='command',
+                                choices=['brightness', 'pause', 'resume', 'next', 'previous',
+                                         'load', 'stats', 'exit'],
+                                help='brightness, pause, resume, next, previous, load, stats or'
+                                ' exit.')
+    control_parser.add_argument('value', nargs='?', default=None,
+                                help='Brightness value for brightness, or a path to a Nightlight'
+                                ' file or directory for load.')
+    control_parser.add_argument('--socket', default=None,
+                                help='Unix domain socket of the running player (default:'
+                                ' $XDG_RUNTIME_DIR/nightlight.sock).')
@@ -0,0 +1,252 @@
+""" compiler.py
+
+This module contains functions for compiling Nightlight patterns into finished APA102 wire
+frames - the exact bytes DotStar.show() would send over SPI for each frame, with the
+serpentine pixel mapping, start header, 5-bit per-pixel brightness, pixel order and end
+header already applied. Playing a compiled pattern is then a single SPI write per frame.
+
+Compiled patterns are cached on disk, keyed by the pattern's file (or, for in-memory patterns,
+its contents), the board geometry and the brightness settings, so patterns played from files
+only need to be compiled once.
+
+"""
+import hashlib
+import mmap
+import os
+
+import numpy as np
+
+from nightlight import adafruit_dotstar
+from nightlight.cache import COMPILED_CACHE_DIR, DiskCache, make_key
+
+# Bump this whenever the output of compile_frame() changes so stale cache entries are ignored.
+COMPILER_VERSION = 1
+
+
+class CompileCancelled(Exception):
+    """ Raised by compile_pattern() when it is stopped before it finishes """
+
+
+def frame_size(n):
+    """ Get the size in bytes of an APA102 wire frame
+
+    :param int n: Number of pixels in the chain.
+    :return: Number of bytes in a frame, including start and end headers.
+    """
+    return n * 4 + adafruit_dotstar.START_HEADER_SIZE + (n + 15) // 16
+
+
+serpentine_order = adafruit_dotstar.serpentine_order
+
+
+def pixel_brightness(frame, max_brightness):
+    """ Calculate the per-pixel brightness of every pixel in a frame
+
+    Vectorized equivalent of Nightlight._calculate_pixel(), including the way DotStar treats
+    RGBA colours as having full brightness.
+
+    :param frame: Array of shape (..., 3) or (..., 4) of RGB(A) values.
+    :param float max_brightness: Global brightness of the board.
+    :return: Float array of shape frame.shape[:-1].
+    """
+    if frame.shape[-1] == 4:
+        # RGBA colours become a 5-tuple once brightness is appended, which DotStar treats as
+        # having no per-pixel brightness (full brightness).
+        return np.ones(frame.shape[:-1])
+    return (0.2126 * frame[..., 0] +
+            0.7152 * frame[..., 1] +
+            0.0722 * frame[..., 2]) / (100 * max_brightness)
+
+
+def brightness_bytes(frame, max_brightness):
+    """ Calculate the APA102 brightness byte of every pixel in a frame
+
+    :param frame: Array of shape (..., 3) or (..., 4) of RGB(A) values.
+    :param float max_brightness: Global brightness of the board.
+    :return: uint8 array of shape frame.shape[:-1].
+    """
+    return adafruit_dotstar.brightness_bytes(pixel_brightness(frame, max_brightness))
+
+
+def compile_frame(frame, order, max_brightness=1.0, pixel_order=adafruit_dotstar.RGB,
+                  brightness=1.0, out=None):
+    """ Compile a single frame into an APA102 wire frame
+
+    :param frame: Frame of shape (height, width, 3) (or 4 with alpha), nested list or array.
+    :param order: Serpentine pixel order from serpentine_order().
+    :param float max_brightness: Global brightness of the board (Nightlight max_brightness).
+    :param tuple pixel_order: Pixel order of the strip, eg adafruit_dotstar.RGB.
+    :param float brightness: DotStar global brightness (scales the colour bytes).
+    :param out: Optional preallocated uint8 array of frame_size(len(order)) bytes to fill.
+    :return: uint8 array holding the wire frame.
+    """
+    n = len(order)
+    frame = np.asarray(frame)
+    pixels = frame.reshape(-1, frame.shape[-1])[order]
+    if out is None:
+        out = np.empty(frame_size(n), dtype=np.uint8)
+    start = adafruit_dotstar.START_HEADER_SIZE
+    end = start + n * 4
+    out[:start] = 0x00
+    out[end:] = 0xff
+    body = out[start:end].reshape(n, 4)
+    body[:, 0] = brightness_bytes(pixels, max_brightness)
+    colours = pixels[:, list(pixel_order)]
+    if brightness < 1.0:
+        colours = colours * brightness
+    body[:, 1:] = colours.astype(np.uint8)
+    return out
+
+
+class CompiledPattern:
+    """ A pattern compiled to APA102 wire frames, memory-mapped from the compile cache
+
+    Iterating yields one buffer per frame, ready to be passed to DotStar.show_buffer().
+
+    :param str path: Path to a compiled pattern file.
+    :param int n: Number of pixels the pattern was compiled for.
+    """
+
+    def __init__(self, path, n):
+        self.path = path
+        self.n = n
+        if os.path.getsize(path) == 0:
+            self.frames = np.empty((0, frame_size(n)), dtype=np.uint8)
+            return
+        with open(path, 'rb') as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self.frames = np.frombuffer(self._mmap, dtype=np.uint8).reshape(-1, frame_size(n))
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+
+def pattern_key(pattern):
+    """ Identify a pattern stored in a file, without reading it
+
+    :param pattern: A pattern with a `path` attribute (eg sources.FileFrameSource) or an
+                    in-memory pattern.
+    :return: Tuple of (hex digest of the file's path, tuple of its size and modification
+             time), or None for an in-memory pattern, which can only be identified by
+             hashing its frames.
+    """
+    path = getattr(pattern, 'path', None)
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return make_key(os.path.realpath(path)), (stat.st_size, stat.st_mtime_ns)
+
+
+def _hash_frame(digest, array):
+    """ Add a frame to a pattern's content hash
+
+    :param digest: hashlib hash object.
+    :param array: C-contiguous array of the frame.
+    """
+    digest.update(repr((array.shape, str(array.dtype))).encode('utf-8'))
+    digest.update(array)
+
+
+def content_key(pattern):
+    """ Identify an in-memory pattern by hashing its frames
+
+    :param pattern: A pattern to identify.
+    :return: Hex digest of the pattern's frames, or None if the pattern isn't a list, tuple or
+             array of frames held in memory, and so can't be iterated more than once.
+    """
+    if not isinstance(pattern, (list, tuple, np.ndarray)):
+        return None
+    digest = hashlib.sha256()
+    for frame in pattern:
+        _hash_frame(digest, np.ascontiguousarray(frame))
+    return digest.hexdigest()
+
+
+def compile_pattern(pattern, width, height, max_brightness=1.0,
+                    pixel_order=adafruit_dotstar.RGB, brightness=1.0,
+                    cache_dir=COMPILED_CACHE_DIR, layout=None, stop=None):
+    """ Compile a pattern to APA102 wire frames, reusing a cached copy if one exists
+
+    Frames are compiled one at a time straight into the cache file, so compiling a streamed
+    pattern never holds more than one frame in memory. Held frames (the same frame object
+    repeated, see sources.py) are only compiled once.
+
+    Patterns stored in files are looked up by path, size and modification time, so a cached
+    pattern is found without reading the file. In-memory patterns (lists, tuples and arrays of
+    frames) are looked up by hashing their frames first. Other patterns, such as generated
+    sources, can only be iterated once, so their frames are hashed as they are compiled, and
+    they are compiled on every call.
+
+    :param pattern: Any iterable of frames (nested list, formats.BinaryPattern,
+                    sources.FileFrameSource...).
+    :param int width: Board width in pixels.
+    :param int height: Board height in pixels.
+    :param float max_brightness: Global brightness of the board (Nightlight max_brightness).
+    :param tuple pixel_order: Pixel order of the strip, eg adafruit_dotstar.RGB.
+    :param float brightness: DotStar global brightness.
+    :param str cache_dir: Directory to cache compiled patterns in.
+    :param layout: layout.Layout of the board's chains, or None for a single chain. Frames are
+                   compiled for the chains joined into one, as layout.ChainTransport
+                   expects.
+    :param stop: Optional threading.Event. If it is set while the pattern is being compiled,
+                 compiling stops, nothing is cached and CompileCancelled is raised.
+    :return: CompiledPattern.
+    """
+    cache = DiskCache(cache_dir, suffix='.apa102')
+    params = (COMPILER_VERSION, width, height, float(max_brightness), tuple(pixel_order),
+              float(brightness))
+    if layout is not None:
+        params += (layout.regions,)
+    file_key = pattern_key(pattern)
+    if file_key is not None:
+        # The file's version is part of the settings, so entries for older versions of the
+        # file are pruned below like entries with other settings.
+        pattern_hash = file_key[0][:32]
+        params += file_key[1:]
+    else:
+        pattern_hash = content_key(pattern)
+        pattern_hash = None if pattern_hash is None else pattern_hash[:32]
+    params_key = make_key(*params)[:32]
+
+    path = None
+    if pattern_hash is not None:
+        path = cache.get('{}-{}'.format(pattern_hash, params_key))
+    if path is None:
+        hash_frames = pattern_hash is None
+        order = serpentine_order(width, height) if layout is None else layout.order
+
+        def write(tmp_path):
+            nonlocal pattern_hash
+            buf = np.empty(frame_size(width * height), dtype=np.uint8)
+            digest = hashlib.sha256()
+            previous = None
+            with open(tmp_path, 'wb') as fout:
+                for frame in pattern:
+                    if stop is not None and stop.is_set():
+                        raise CompileCancelled('Compiling was stopped')
+                    if frame is not previous:
+                        previous = frame
+                        array = np.ascontiguousarray(frame)
+                        compile_frame(array, order, max_brightness, pixel_order, brightness,
+                                      out=buf)
+                    if hash_frames:
+                        _hash_frame(digest, array)
+                    fout.write(buf.data)
+            if hash_frames:
+                pattern_hash = digest.hexdigest()[:32]
+            return '{}-{}'.format(pattern_hash, params_key)
+
+        path = cache.put(None, write)
+        key = '{}-{}'.format(pattern_hash, params_key)
+        # Entries compiled from the same pattern with other settings are now stale.
+        for stale_key in cache.keys(prefix=pattern_hash):
+            if stale_key != key:
+                cache.remove(stale_key)
+
+    return CompiledPattern(path, width * height)
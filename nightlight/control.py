@@ -0,0 +1,176 @@
+""" control.py
+
+This module contains a control server for a playing Nightlight, and a client for sending it
+commands.
+
+The server listens on a Unix domain socket from an asyncio event loop on a background thread,
+so it never touches the render loop directly. Each request is a single line, either JSON:
+
+    {"command": "brightness", "value": 0.3}
+
+or plain text, for convenience with tools like socat:
+
+    brightness 0.3
+
+and is answered with a single JSON line, eg {"ok": true, "result": null}. Commands are handed
+to the render loop with Nightlight.send_command() and take effect at the next frame boundary.
+See Nightlight.send_command() for the available commands; 'load' takes a 'path' to a
+Nightlight file or directory instead of a list of patterns.
+
+"""
+import asyncio
+import json
+import os
+import socket
+import threading
+
+DEFAULT_SOCKET_PATH = os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'), 'nightlight.sock')
+COMMAND_TIMEOUT = 5.0
+
+
+def parse_request(line):
+    """ Parse a single request line
+
+    :param str line: JSON object or plain text command such as 'brightness 0.3'.
+    :return: Tuple of (command, kwargs).
+    """
+    line = line.strip()
+    if line.startswith('{'):
+        request = json.loads(line)
+        command = request.pop('command')
+        return command, request
+    parts = line.split(None, 1)
+    if not parts:
+        raise ValueError('Empty command')
+    command = parts[0]
+    if len(parts) == 1:
+        return command, {}
+    if command == 'load':
+        return command, {'path': parts[1]}
+    return command, {'value': parts[1]}
+
+
+class ControlServer:
+    """ Serve control commands for a Nightlight on a Unix domain socket
+
+    :param board: The base.Nightlight to control.
+    :param str path: Path of the Unix domain socket to listen on.
+    :param open_patterns: Function that takes a path and returns a list of patterns, used for
+                          the 'load' command. Called on the server thread, so the render loop
+                          never waits for the file system.
+    """
+
+    def __init__(self, board, path=DEFAULT_SOCKET_PATH, open_patterns=None):
+        self.board = board
+        self.path = path
+        self.open_patterns = open_patterns
+        self._loop = None
+        self._stop = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._error = None
+
+    def start(self):
+        """ Start serving on a background thread
+
+        Raises the error if the server could not be started, eg because another server is
+        already listening on the socket.
+        """
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='nightlight-control',
+                                        daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        if self._error is not None:
+            self._thread.join()
+            raise self._error
+
+    def stop(self):
+        """ Stop serving and remove the socket """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop.set)
+            self._thread.join()
+
+    def _run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        try:
+            remove_stale_socket(self.path)
+            server = await asyncio.start_unix_server(self._handle_client, path=self.path)
+            self._loop = asyncio.get_running_loop()
+            self._stop = asyncio.Event()
+        except Exception as err:
+            self._error = err
+            return
+        finally:
+            # Never leave start() waiting, whether or not the server started.
+            self._ready.set()
+        try:
+            async with server:
+                await self._stop.wait()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                response = await self._handle_request(line.decode('utf-8'))
+                writer.write((json.dumps(response) + '\n').encode('utf-8'))
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _handle_request(self, line):
+        try:
+            command, kwargs = parse_request(line)
+            if command == 'load':
+                if self.open_patterns is None:
+                    raise ValueError('This server cannot load playlists')
+                kwargs = {'patterns': await self._loop.run_in_executor(
+                    None, self.open_patterns, kwargs['path'])}
+            future = self.board.send_command(command, **kwargs)
+            result = await asyncio.wait_for(asyncio.wrap_future(future), COMMAND_TIMEOUT)
+        except Exception as err:
+            return {'ok': False, 'error': str(err) or type(err).__name__}
+        return {'ok': True, 'result': result}
+
+
+def remove_stale_socket(path):
+    """ Remove a socket left behind by a server that is no longer running
+
+    :param str path: Path of the Unix domain socket.
+    :raises RuntimeError: If a server is still listening on the socket.
+    """
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            # Nothing is accepting connections, so the socket is stale.
+            os.remove(path)
+            return
+    raise RuntimeError('Another player is already listening on {}'.format(path))
+
+
+def send_command(command, socket_path=DEFAULT_SOCKET_PATH, timeout=COMMAND_TIMEOUT, **kwargs):
+    """ Send a command to a running control server
+
+    :param str command: Command name, eg 'brightness'.
+    :param str socket_path: Path of the server's Unix domain socket.
+    :param float timeout: Seconds to wait for a response.
+    :param kwargs: Command arguments, eg value=0.3.
+    :return: Decoded response dict.
+    """
+    request = dict(kwargs, command=command)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as response:
+            return json.loads(response.readline())
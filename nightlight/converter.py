@@ -5,41 +5,83 @@ which store the RGB values for each pixel in each frame of a video. These files
 read by the Nightlight.
 
 """
+import itertools
 import json
 import os
+import shutil
 import subprocess
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from typing import List, Optional, Tuple
 
 import numpy as np
-from PIL import Image
+from PIL import GifImagePlugin, Image
+
+from nightlight import formats
+from nightlight.cache import CONVERTED_CACHE_SIZE, DiskCache, hash_file, make_key
 
 DEFAULT_RESOLUTION = (30, 18)
+FILE_FORMATS = tuple(formats.WRITERS)
+DEFAULT_CACHE_SIZE = CONVERTED_CACHE_SIZE
+# Number of frames sampled to make a gif's palette, and the palette index kept for black.
+GIF_PALETTE_SAMPLES = 64
+GIF_BLACK_INDEX = 255
 
 
-def convert_frames_to_file(frames, outfile):
+def convert_frames_to_file(frames, outfile, file_format='json', fps=30, workers=None):
     """ Convert a collection of video frames to a Nightlight file
 
+    Frames are converted to arrays in bulk and streamed to the output file one at a time.
+    When reading a directory, images are decoded by a pool of worker threads, with at most
+    a few frames per worker held in memory at once.
+
     :param frames: Either a path to a directory of images or a list of Pillow Image objects. If
                    frames is a path, the frame order is expected to match the alphanumeric
                    order of the filenames (eg 1.png, 2.png etc.). If frames is a list, the frame
                    order is expected to match the order of the list elements.
     :param outfile: Output file path.
+    :param file_format: Nightlight file format to write (one of FILE_FORMATS).
+    :param fps: Frame rate of the frames, recorded in binary and compressed files.
+    :param workers: Number of threads to decode images with. Defaults to the number of CPUs.
     """
     valid_extensions = ['.png', '.jpg']
     if isinstance(frames, str) and os.path.isdir(frames):
         files = [x for x in os.listdir(frames) if x.endswith(tuple(valid_extensions))]
         files.sort(key=lambda x: int(x.split('.')[0]))
-        rgb_map = [get_rgb_map_from_image(Image.open(os.path.join(frames, x))) for x in files]
+        paths = [os.path.join(frames, x) for x in files]
+        rgb_frames = ordered_map(read_rgb_array_from_file, paths, workers)
 
     elif isinstance(frames, list):
         if not all(isinstance(x, Image.Image) for x in frames):
             raise TypeError('frames must be a directory or a list of Pillow Image objects.')
-        rgb_map = [get_rgb_map_from_image(x) for x in frames]
+        rgb_frames = (get_rgb_array_from_image(x) for x in frames)
 
     else:
         raise TypeError('frames must be a directory or a list of Pillow Image objects.')
 
-    write_rgb_array_to_file(rgb_map, outfile)
+    write_rgb_array_to_file(rgb_frames, outfile, file_format=file_format, fps=fps)
+
+
+def ordered_map(function, items, workers=None):
+    """ Apply a function to items in a thread pool, yielding results in order
+
+    Unlike Executor.map(), only a bounded number of items are submitted ahead of the one
+    being consumed, so memory use does not grow with the number of items.
+
+    :param function: Function to apply to each item.
+    :param items: Iterable of items.
+    :param workers: Number of threads to use. Defaults to the number of CPUs.
+    :return: Generator of results in the same order as items.
+    """
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def convert_video_to_frames(video_file, outdir, fps=30):
@@ -81,41 +123,132 @@ def get_rgb_map_from_image(img_obj):
     :return: List where each element is a list of RGB values representing one row
              of the image.
     """
-    rgb_map = []
-    width, height = img_obj.size
-    for y in range(height):
-        row_rgb_map = []
-        for x in range(width):
-            row_rgb_map.append(img_obj.getpixel((x, y)))
-        rgb_map.append(row_rgb_map)
+    return get_rgb_array_from_image(img_obj).tolist()
+
 
-    return rgb_map
+def get_rgb_array_from_image(img_obj):
+    """ Convert a Pillow Image object to an array of pixel values
+
+    :param img_obj: Pillow Image object.
+    :return: Array of shape (height, width, channels) for multi-band images (eg RGB) or
+             (height, width) for single-band images.
+    """
+    return np.asarray(img_obj)
+
+
+def read_rgb_array_from_file(path):
+    """ Decode an image file into an array of pixel values
+
+    :param str path: Path to an image file.
+    :return: Array of shape (height, width, channels), see get_rgb_array_from_image().
+    """
+    with Image.open(path) as img_obj:
+        return get_rgb_array_from_image(img_obj)
 
 
-def process_video(path, outdir=None, resolution=DEFAULT_RESOLUTION, fps=30, **kwargs):
+def convert_video(video, outdir=None, resolution=DEFAULT_RESOLUTION, fps=30, file_format='json',
+                  keep_intermediate=False, cache_dir=None,
+                  cache_size=DEFAULT_CACHE_SIZE, **kwargs):
+    """ Process a single video into Nightlight format
+
+    See process_video() for a description of the arguments.
+
+    :param str video: Input video file path.
+    :return: Path to the Nightlight file that was written.
+    """
+    basename = os.path.splitext(os.path.basename(video))[0]
+    if outdir is None:
+        video_outdir = os.path.join(os.path.dirname(video), basename)
+    else:
+        video_outdir = os.path.join(outdir, basename)
+    if not os.path.exists(video_outdir):
+        os.makedirs(video_outdir, exist_ok=True)
+    nightlight_file = os.path.join(video_outdir, '{}.nl'.format(basename))
+
+    if not keep_intermediate:
+        cache = key = None
+        if cache_dir is not None:
+            cache = DiskCache(cache_dir, suffix='.nl', max_size=cache_size)
+            key = get_conversion_key(video, resolution, fps, file_format, **kwargs)
+            cached_file = cache.get(key)
+            if cached_file is not None:
+                print('Using cached conversion of {}'.format(video))
+                tmp_path = '{}.{}.tmp'.format(nightlight_file, os.getpid())
+                shutil.copyfile(cached_file, tmp_path)
+                os.replace(tmp_path, nightlight_file)
+                return nightlight_file
+
+        with formats.open_writer(nightlight_file, file_format, fps=fps) as writer:
+            for frame in stream_video_frames(video, resolution, fps, **kwargs):
+                writer.write_frame(frame)
+        if cache is not None:
+            cache.put_file(key, nightlight_file)
+        return nightlight_file
+
+    # Scale the video.
+    scaled_filename = '{}_({}x{}){}'.format(basename, resolution[0], resolution[1],
+                                             os.path.splitext(video)[1])
+    scaled_video = os.path.join(video_outdir, scaled_filename)
+    scale_video(video, scaled_video, resolution, **kwargs)
+
+    # Convert the video to frames.
+    frames_outdir = os.path.join(video_outdir, 'frames')
+    convert_video_to_frames(scaled_video, frames_outdir, fps)
+
+    # Convert the frames to a Nightlight file.
+    convert_frames_to_file(frames_outdir, nightlight_file, file_format=file_format, fps=fps)
+    return nightlight_file
+
+
+def get_conversion_key(video, resolution=DEFAULT_RESOLUTION, fps=30, file_format='json',
+                       scale_method='bicubic', contrast=1.0, brightness=0.0, saturation=1.0,
+                       gamma=1.0):
+    """ Build the conversion cache key for a video and a set of conversion settings
+
+    :param str video: Input video file path.
+    :return: Cache key identifying the video's contents and every setting that affects the
+             converted Nightlight file.
+    """
+    return make_key(hash_file(video), tuple(resolution), fps, file_format, scale_method,
+                    float(contrast), float(brightness), float(saturation), float(gamma))
+
+
+def process_video(path, outdir=None, resolution=DEFAULT_RESOLUTION, fps=30, file_format='json',
+                  keep_intermediate=False, jobs=1, cache_dir=None,
+                  cache_size=DEFAULT_CACHE_SIZE, **kwargs):
     """ Fully process a video or directory of videos into Nightlight format
 
     Scale the video to the appropriate resolution, convert it to frames, and then parse the RGB
     values from each frame.
 
+    By default this is done in a single ffmpeg pass (see stream_video_frames()) with frames
+    piped straight into the Nightlight file. If keep_intermediate is True, the scaled video and
+    a directory of frame images are written next to the Nightlight file instead.
+
+    If cache_dir is set (eg to cache.CONVERTED_CACHE_DIR), converted files are cached, keyed on
+    the contents of the input video and the conversion settings, so converting the same video
+    with the same settings again just copies the cached file. Intermediate-file conversions
+    bypass the cache.
+
+    A directory of videos can be converted concurrently by setting jobs > 1. A video that fails
+    to convert is reported and skipped without affecting the others, and its Nightlight file
+    is never left half-written.
+
     :param str path: Either a path to an input video file or a directory of video files.
     :param str outdir: Output directory path. If None, output will be saved to the input
                        directory.
     :param tuple resolution: Resolution in pixels to scale the video to (width, height).
     :param int fps: Frames per second to use.
+    :param str file_format: Nightlight file format to write (one of FILE_FORMATS).
+    :param bool keep_intermediate: If True, save the scaled video and frame images to disk.
+    :param int jobs: Number of videos to convert at the same time.
+    :param str cache_dir: Conversion cache directory, or None (the default) to not cache.
+    :param int cache_size: Maximum size of the conversion cache in bytes. Least recently used
+                           entries are evicted when it is exceeded.
     :param kwargs: Any valid arguments to scale_video().
+    :return: Dict mapping each input video to the path of its Nightlight file, or None if the
+             video failed to convert.
     """
-    def create_outdir(video, outdir):
-        basedir = os.path.dirname(video)
-        basename = os.path.basename(video)
-        if outdir is None:
-            video_outdir = os.path.join(basedir, os.path.splitext(basename)[0])
-        else:
-            video_outdir = os.path.join(outdir, os.path.splitext(basename)[0])
-        if not os.path.exists(video_outdir):
-            os.makedirs(video_outdir)
-        return video_outdir
-
     def validate_input(path):
         valid_extensions = get_ffmpeg_supported_formats()
         if isinstance(path, str) and os.path.isdir(path):
@@ -129,24 +262,41 @@ def process_video(path, outdir=None, resolution=DEFAULT_RESOLUTION, fps=30, **kw
                              ' ({})'.format(valid_extensions))
         return videos
 
-    videos = validate_input(path)
-    for video in videos:
-        video_outdir = create_outdir(video, outdir)
-        video_filename = os.path.basename(video)
-
-        # Scale the video.
-        scaled_filename = '{}_({}x{}){}'.format(os.path.splitext(video_filename)[0], resolution[0],
-                                                 resolution[1], os.path.splitext(video_filename)[1])
-        scaled_video = os.path.join(video_outdir, scaled_filename)
-        scale_video(video, scaled_video, resolution, **kwargs)
+    videos = sorted(validate_input(path))
+    convert_kwargs = dict(outdir=outdir, resolution=resolution, fps=fps, file_format=file_format,
+                          keep_intermediate=keep_intermediate, cache_dir=cache_dir,
+                          cache_size=cache_size, **kwargs)
+    results = {}
 
-        # Convert the video to frames.
-        frames_outdir = os.path.join(video_outdir, 'frames')
-        convert_video_to_frames(scaled_video, frames_outdir, fps)
+    def report(video, result=None, error=None):
+        results[video] = result
+        if error is None:
+            print('[{}/{}] Converted {} -> {}'.format(len(results), len(videos), video, result))
+        else:
+            print('[{}/{}] Failed to convert {}: {}'.format(len(results), len(videos), video,
+                                                           error))
+
+    if jobs > 1 and len(videos) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(convert_video, video, **convert_kwargs): video
+                       for video in videos}
+            for future in as_completed(futures):
+                try:
+                    report(futures[future], result=future.result())
+                except Exception as err:
+                    report(futures[future], error=err)
+    else:
+        for video in videos:
+            try:
+                report(video, result=convert_video(video, **convert_kwargs))
+            except Exception as err:
+                report(video, error=err)
 
-        # Convert the frames to a Nightlight file.
-        nightlight_filename = '{}.nl'.format(os.path.splitext(video_filename)[0])
-        convert_frames_to_file(frames_outdir, os.path.join(video_outdir, nightlight_filename))
+    failed = [video for video in videos if results[video] is None]
+    print('Converted {} of {} videos.'.format(len(videos) - len(failed), len(videos)))
+    for video in failed:
+        print('  Failed: {}'.format(video))
+    return {video: results[video] for video in videos}
 
 
 def scale_video(infile, outfile, resolution=DEFAULT_RESOLUTION, scale_method='bicubic',
@@ -171,28 +321,91 @@ def scale_video(infile, outfile, resolution=DEFAULT_RESOLUTION, scale_method='bi
     :param float saturation: Saturation adjustment factor (0.0 to 3.0).
     :param float gamma: Gamma adjustment factor (0.1 to 10.0).
     """
-    cmd = (f'ffmpeg -i {infile} -vf scale={resolution[0]}:{resolution[1]}:flags={scale_method},'
-           f'eq=contrast={contrast}:brightness={brightness}:saturation={saturation}:gamma={gamma}'
-           f' -y {outfile}')
+    video_filter = get_video_filter(resolution, scale_method, contrast, brightness, saturation,
+                                    gamma)
+    cmd = f'ffmpeg -i {infile} -vf {video_filter} -y {outfile}'
     print(cmd)
     output = subprocess.check_output(cmd.split())
     print(output)
 
 
-def write_rgb_array_to_file(rgb_array, outfile, pretty=False):
-    """ Write an array of RGB values to a text file
+def get_video_filter(resolution=DEFAULT_RESOLUTION, scale_method='bicubic', contrast=1.0,
+                     brightness=0.0, saturation=1.0, gamma=1.0, fps=None):
+    """ Build the ffmpeg filtergraph used to scale and equalize videos
+
+    :param tuple resolution: Resolution in pixels to scale the video to (width, height).
+    :param str scale_method: Scaling method to use. Some examples are 'bicubic' and 'neighbor'.
+    :param float contrast: Contrast adjustment factor (-1000.0 to 1000.0).
+    :param float brightness: Brightness adjustment factor (-1.0 to 1.0).
+    :param float saturation: Saturation adjustment factor (0.0 to 3.0).
+    :param float gamma: Gamma adjustment factor (0.1 to 10.0).
+    :param int fps: If supplied, resample the video to this frame rate before scaling.
+    :return: ffmpeg -vf argument.
+    """
+    video_filter = (f'scale={resolution[0]}:{resolution[1]}:flags={scale_method},'
+                    f'eq=contrast={contrast}:brightness={brightness}:saturation={saturation}'
+                    f':gamma={gamma}')
+    if fps is not None:
+        video_filter = f'fps={fps},{video_filter}'
+    return video_filter
+
+
+def stream_video_frames(infile, resolution=DEFAULT_RESOLUTION, fps=30, **kwargs):
+    """ Decode, resample, scale and equalize a video in a single ffmpeg pass
+
+    ffmpeg writes raw RGB frames to a pipe, which are read straight into NumPy arrays, so
+    nothing is written to disk.
+
+    This function requires that ffmpeg by available on the system path.
+
+    :param str infile: Input video file path.
+    :param tuple resolution: Resolution in pixels to scale the video to (width, height).
+    :param int fps: Frames per second to use.
+    :param kwargs: Any valid arguments to scale_video() (scale_method, contrast, etc.).
+    :return: Generator of uint8 arrays of shape (height, width, 3).
+    """
+    width, height = resolution
+    frame_size = width * height * 3
+    video_filter = get_video_filter(resolution, fps=fps, **kwargs)
+    cmd = ['ffmpeg', '-v', 'error', '-i', infile, '-vf', video_filter,
+           '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-']
+    print(' '.join(cmd))
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            yield np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def write_rgb_array_to_file(rgb_array, outfile, pretty=False, file_format='json', fps=30):
+    """ Write an array of RGB values to a Nightlight file
 
     :param rgb_array: RGB array - nested list where 1st level = frames of a video,
                     2nd level = rows of a frame, 3rd level = RGB values of a row.
     :param outfile: Output file path.
     :param pretty: If True, write the RGB map to the file using newlines to separate each row of
-                   each frame.
+                   each frame. Only applies to the 'json' format.
+    :param file_format: 'json' to write a text file, 'binary' to write a packed binary file
+                        that the player can memory-map, or 'compressed' to write a much
+                        smaller keyframe and delta compressed file (see formats.py).
+    :param fps: Frame rate recorded in binary and compressed files.
     """
-    if pretty:
+    if file_format not in FILE_FORMATS:
+        raise ValueError('Unknown Nightlight file format {!r} (expected one of {})'
+                         .format(file_format, FILE_FORMATS))
+    if pretty and file_format == 'json':
         write_rgb_array_to_file_pretty(rgb_array, outfile)
     else:
-        with open(outfile, 'w') as fout:
-            json.dump(rgb_array, fout)
+        with formats.open_writer(outfile, file_format, fps=fps) as writer:
+            for frame in rgb_array:
+                writer.write_frame(frame)
 
 
 def write_rgb_array_to_file_pretty(rgb_array, outfile):
@@ -224,50 +437,146 @@ def write_rgb_array_to_gif(rgb_array: np.ndarray, outfile: str,
                            fps: int = 30, padding: Optional[int] = None):
     """ Write an array of RGB values to a gif file
 
+    Frames are streamed to the file one at a time, so memory use does not depend on the length
+    of the pattern. All frames share one palette, made from a sample of frames spread across
+    the pattern, so colours don't flicker from frame to frame. Frames that don't change are
+    merged into the previous frame, and only the part of each frame that changed is stored.
+
     :param rgb_array: RGB array data structure - nested list where 1st level = frames
                       of a video, 2nd level = rows of a frame, 3rd level = RGB values
-                      of a row.
+                      of a row. Any iterable of frames, such as a formats.BinaryPattern
+                      or a generator, can be used.
     :param outfile: Output file path.
     :param colour_mode: 'L' if values in `rgb_array` are single uint8 / black and white
                         values from 0-255. 'RGB' if values in `rgb_array` are uint8 RGB
                         tuples (0-255, 0-255, 0-255).
-    :param scale: Scaling factor to apply.
+    :param scale: Scaling factor to apply. Each pixel becomes a scale x scale block.
     :param fps: Frames per second to use in exported gif.
     :param padding: If supplied, insert this many pixels of black space between each
                     pixel to simulate the appearance of patterns on the board.
     """
+    sample, frames = sample_frames(rgb_array, GIF_PALETTE_SAMPLES)
+    if not sample:
+        raise ValueError('Cannot write a gif of a pattern with no frames')
+    if colour_mode == 'L':
+        # Grey levels index a grey palette directly, so level 0 is black.
+        palette = [level for level in range(256) for _ in range(3)]
+        black = 0
+    else:
+        palette = get_gif_palette(sample)
+        black = GIF_BLACK_INDEX
+    palette_image = Image.new('P', (1, 1))
+    palette_image.putpalette(palette)
+
+    height, width = np.shape(sample[0])[:2]
+    rows = get_gif_index_map(height, scale, padding or 0)
+    columns = get_gif_index_map(width, scale, padding or 0)
+    # Palette indices of the current frame, with a row and column of black for the padding
+    # and scaling maps to point at.
+    indices = np.full((height + 1, width + 1), black, dtype=np.uint8)
+
+    with open(outfile, 'wb') as fout:
+        header_image = Image.new('P', (len(columns), len(rows)))
+        header_image.putpalette(palette)
+        header, _ = GifImagePlugin.getheader(header_image, info={'duration': 1000 / fps})
+        fout.write(b''.join(header))
+
+        previous = None
+        pending = None
+        pending_start = 0
+        for i, frame in enumerate(frames):
+            frame = np.asarray(frame, dtype=np.uint8)
+            if colour_mode == 'L':
+                indices[:height, :width] = frame
+            else:
+                image = Image.fromarray(np.ascontiguousarray(frame[..., :3]), mode='RGB')
+                # dither=0 means no dithering. Image.Dither only exists from Pillow 9.1.
+                indices[:height, :width] = np.asarray(
+                    image.quantize(palette=palette_image, dither=0))
+            scaled = indices[rows[:, None], columns]
+            if pending is not None and np.array_equal(scaled, pending):
+                continue
+            if pending is not None:
+                write_gif_frame(fout, pending, previous, fps, pending_start, i)
+                previous = pending
+            pending, pending_start = scaled, i
+        write_gif_frame(fout, pending, previous, fps, pending_start, i + 1)
+        fout.write(b';')
+
+
+def sample_frames(pattern, count):
+    """ Take a sample of a pattern's frames without reading the whole pattern into memory
+
+    Patterns that support len() and indexing are sampled evenly from start to end. Other
+    iterables are sampled from their first frames, which are kept to be iterated again.
+
+    :param pattern: Nightlight pattern - any iterable of frames.
+    :param int count: Largest number of frames to sample.
+    :return: Tuple of (list of sampled frames as arrays, iterable of all the frames).
+    """
+    if hasattr(pattern, '__len__') and hasattr(pattern, '__getitem__'):
+        if len(pattern) == 0:
+            return [], pattern
+        indices = np.unique(np.linspace(0, len(pattern) - 1, min(count, len(pattern)))
+                            .round().astype(int))
+        return [np.asarray(pattern[int(i)]) for i in indices], pattern
+    iterator = iter(pattern)
+    head = [np.asarray(frame) for frame in itertools.islice(iterator, count)]
+    return head, itertools.chain(head, iterator)
+
+
+def get_gif_palette(frames):
+    """ Make a gif palette for a set of RGB frames
+
+    :param frames: List of arrays of shape (height, width, 3) (or 4 with alpha).
+    :return: Flat list of 256 RGB palette entries, with black at GIF_BLACK_INDEX.
+    """
+    pixels = np.concatenate([np.reshape(frame, (-1, np.shape(frame)[-1]))[:, :3]
+                             for frame in frames])
+    image = Image.fromarray(np.ascontiguousarray(pixels.reshape(-1, 1, 3), dtype=np.uint8),
+                            mode='RGB')
+    palette = image.quantize(colors=GIF_BLACK_INDEX).getpalette()[:GIF_BLACK_INDEX * 3]
+    return palette + [0] * (GIF_BLACK_INDEX * 3 - len(palette)) + [0, 0, 0]
+
+
+def get_gif_index_map(size, scale, padding=0):
+    """ Map each row (or column) of a padded and scaled gif frame to a row (or column) of the
+        original frame
+
+    :param int size: Number of rows (or columns) in the original frame.
+    :param int scale: Scaling factor.
+    :param int padding: Number of rows (or columns) of black inserted between each row (or
+                        column) of the original frame.
+    :return: Array of original indices, with `size` in place of the padding.
+    """
+    padded = np.arange((size - 1) * (padding + 1) + 1).repeat(scale)
+    return np.where(padded % (padding + 1) == 0, padded // (padding + 1), size)
+
 
-    def add_padding(frames: np.ndarray, n: int = 1) -> np.ndarray:
-        """ Mock the appearance of patterns on the board by inserting black pixels
-            (zeros) between each row and each column of each frame
-
-        :param frames: Array of pattern frames.
-        :param n: Number of rows/columns of zeros to insert between each existing
-                  row and column.
-        :return: Input frames with zeroes added.
-        """
-        # Initialize array of zeros
-        zeros_shape = [frames.shape[0],
-                       ((n + 1) * frames.shape[1] - n),
-                       ((n + 1) * frames.shape[2] - n)]
-        if len(frames.shape) == 4:  # if this is an RGB array we need an extra dimension
-            zeros_shape.append(frames.shape[3])
-        new_frames = np.zeros(tuple(zeros_shape), dtype=frames.dtype)
-        # Splice in the original data
-        for i, f in enumerate(frames):
-            new_frames[i][::n + 1, ::n + 1] = f
-        return new_frames
-
-    rgb_array = np.array(rgb_array)
-    if padding:
-        rgb_array = add_padding(rgb_array, padding)
-    # Convert each frame of the pattern to a PIL image and scale.
-    images = [Image.fromarray(np.uint8(frame), mode=colour_mode)
-              .resize((frame.shape[1] * scale, frame.shape[0] * scale))
-              for frame in rgb_array]
-    # For RGB patterns, need to map the images to a palette otherwise the gif looks whack.
-    if colour_mode == 'RGB':
-        images = [image.convert('P', palette=Image.ADAPTIVE)
-                  for image in images]
-
-    images[0].save(outfile, save_all=True, append_images=images[1:], duration=1/fps*100)
+def write_gif_frame(fout, indices, previous, fps, start, end):
+    """ Write one frame of palette indices to a gif file
+
+    Only the rectangle that changed since the previous frame is stored.
+
+    :param fout: Gif file opened for binary writing, after the header.
+    :param indices: uint8 array of palette indices.
+    :param previous: Palette indices of the previous frame written, or None for the first.
+    :param fps: Frame rate of the gif.
+    :param int start: Index in the pattern of the first frame the gif frame shows.
+    :param int end: Index of the first frame after it. Gif frame times are in hundredths of a
+                    second, so they are rounded from the pattern's frame times rather than
+                    frame by frame, to keep in time with the pattern.
+    """
+    top, left = 0, 0
+    bottom, right = indices.shape
+    if previous is not None:
+        changed = indices != previous
+        changed_rows = np.flatnonzero(changed.any(axis=1))
+        changed_columns = np.flatnonzero(changed.any(axis=0))
+        top, bottom = changed_rows[0], changed_rows[-1] + 1
+        left, right = changed_columns[0], changed_columns[-1] + 1
+    region = np.ascontiguousarray(indices[top:bottom, left:right])
+    image = Image.frombytes('P', (right - left, bottom - top), region.tobytes())
+    duration = (round(end * 100 / fps) - round(start * 100 / fps)) * 10
+    fout.write(b''.join(GifImagePlugin.getdata(image, offset=(int(left), int(top)),
+                                               duration=duration)))
@@ -0,0 +1,579 @@
+""" formats.py
+
+This module contains readers and writers for the binary Nightlight file format (.nl v2),
+the compressed Nightlight file format, and a streaming writer for the original JSON format.
+
+A v2 file is a small fixed-size header followed by every frame of the pattern packed as uint8
+RGB values, so the player can memory-map the file and hand out NumPy views of each frame
+without parsing or copying anything. The legacy JSON format is still recognised by
+is_binary_file() so both can share the .nl extension.
+
+Header layout (little-endian, 16 bytes):
+
+    magic        4s   b'NLV2'
+    version      B    2
+    layout       B    Pixel layout of the frame data (see LAYOUT_RGB24).
+    width        H    Frame width in pixels.
+    height       H    Frame height in pixels.
+    fps          H    Frame rate the pattern was converted at.
+    frame_count  I    Number of frames following the header.
+
+A compressed file stores the same frames as a sequence of zlib-compressed records. Every
+`keyframe_interval` frames a keyframe holds the whole frame; the frames in between are stored
+as the bytewise difference (mod 256) from the previous frame, which is mostly zeros for smooth
+animations and so compresses far better than the frames themselves. Runs of unchanged frames
+are stored as a single hold record, which readers turn into the same frame object repeated,
+so the player can skip them without comparing any pixels. The file ends with an index of
+keyframe positions, so a frame can be reached by decoding at most one keyframe interval of
+records, and frames are decoded one at a time during playback.
+
+Compressed header layout (little-endian, 26 bytes):
+
+    magic              4s   b'NLZ1'
+    version            B    1
+    layout             B    Pixel layout of the frame data (see LAYOUT_RGB24).
+    width              H    Frame width in pixels.
+    height             H    Frame height in pixels.
+    fps                H    Frame rate the pattern was converted at.
+    frame_count        I    Number of frames in the file.
+    keyframe_interval  H    Number of frames from one keyframe to the next.
+    index_offset       Q    File offset of the keyframe index.
+
+Each record is a kind (B, see KEYFRAME and DELTA) and payload length (I) followed by the
+zlib-compressed payload, or a HOLD kind and the number of frames the previous frame is held
+for (I) with no payload. Hold records never run past the next keyframe. The index is a count
+(I) followed by (frame number (I), record offset (Q)) for each keyframe.
+
+"""
+import abc
+import bisect
+import json
+import mmap
+import os
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b'NLV2'
+VERSION = 2
+HEADER = struct.Struct('<4sBBHHHI')
+
+COMPRESSED_MAGIC = b'NLZ1'
+COMPRESSED_VERSION = 1
+COMPRESSED_HEADER = struct.Struct('<4sBBHHHIHQ')
+RECORD_HEADER = struct.Struct('<BI')
+INDEX_COUNT = struct.Struct('<I')
+INDEX_ENTRY = struct.Struct('<IQ')
+KEYFRAME = 0
+DELTA = 1
+HOLD = 2
+DEFAULT_KEYFRAME_INTERVAL = 60
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Row-major frames (top-left pixel first), three bytes per pixel in R, G, B order.
+LAYOUT_RGB24 = 0
+CHANNELS = {LAYOUT_RGB24: 3}
+
+
+def is_binary_file(path):
+    """ Check whether a file is a binary Nightlight file
+
+    :param path: Path to a Nightlight file.
+    :return: True if the file starts with the binary format's magic bytes.
+    """
+    with open(path, 'rb') as fin:
+        return fin.read(len(MAGIC)) == MAGIC
+
+
+def is_compressed_file(path):
+    """ Check whether a file is a compressed Nightlight file
+
+    :param path: Path to a Nightlight file.
+    :return: True if the file starts with the compressed format's magic bytes.
+    """
+    with open(path, 'rb') as fin:
+        return fin.read(len(COMPRESSED_MAGIC)) == COMPRESSED_MAGIC
+
+
+def read_header(fin):
+    """ Read and validate the header of a binary Nightlight file
+
+    :param fin: Binary file object positioned at the start of the file.
+    :return: Dict with the version, layout, width, height, fps and frame_count of the file.
+    """
+    data = fin.read(HEADER.size)
+    if len(data) < HEADER.size:
+        raise ValueError('File is too short to be a binary Nightlight file')
+    magic, version, layout, width, height, fps, frame_count = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError('File is not a binary Nightlight file (bad magic {!r})'.format(magic))
+    if version != VERSION:
+        raise ValueError('Unsupported Nightlight file version {}'.format(version))
+    if layout not in CHANNELS:
+        raise ValueError('Unsupported pixel layout {}'.format(layout))
+    return {'version': version, 'layout': layout, 'width': width, 'height': height, 'fps': fps,
+            'frame_count': frame_count}
+
+
+def read_compressed_header(fin):
+    """ Read and validate the header of a compressed Nightlight file
+
+    :param fin: Binary file object positioned at the start of the file.
+    :return: Dict with the version, layout, width, height, fps, frame_count,
+             keyframe_interval and index_offset of the file.
+    """
+    data = fin.read(COMPRESSED_HEADER.size)
+    if len(data) < COMPRESSED_HEADER.size:
+        raise ValueError('File is too short to be a compressed Nightlight file')
+    (magic, version, layout, width, height, fps, frame_count, keyframe_interval,
+     index_offset) = COMPRESSED_HEADER.unpack(data)
+    if magic != COMPRESSED_MAGIC:
+        raise ValueError('File is not a compressed Nightlight file (bad magic {!r})'
+                         .format(magic))
+    if version != COMPRESSED_VERSION:
+        raise ValueError('Unsupported compressed Nightlight file version {}'.format(version))
+    if layout not in CHANNELS:
+        raise ValueError('Unsupported pixel layout {}'.format(layout))
+    return {'version': version, 'layout': layout, 'width': width, 'height': height, 'fps': fps,
+            'frame_count': frame_count, 'keyframe_interval': keyframe_interval,
+            'index_offset': index_offset}
+
+
+def read_keyframe_index(fin, header):
+    """ Read the keyframe index of a compressed Nightlight file
+
+    :param fin: Binary file object of a compressed Nightlight file.
+    :param dict header: The file's header, from read_compressed_header().
+    :return: Tuple of (list of keyframe frame numbers, list of their record offsets), both in
+             frame order.
+    """
+    fin.seek(header['index_offset'])
+    data = fin.read(INDEX_COUNT.size)
+    if len(data) < INDEX_COUNT.size:
+        raise ValueError('Compressed Nightlight file is truncated')
+    count, = INDEX_COUNT.unpack(data)
+    data = fin.read(INDEX_ENTRY.size * count)
+    if len(data) < INDEX_ENTRY.size * count:
+        raise ValueError('Compressed Nightlight file is truncated')
+    entries = list(INDEX_ENTRY.iter_unpack(data))
+    if header['frame_count'] and (not entries or entries[0][0] != 0):
+        raise ValueError('Compressed Nightlight file does not start with a keyframe')
+    return [frame for frame, _ in entries], [offset for _, offset in entries]
+
+
+def decode_record(kind, payload, previous, shape):
+    """ Decode one record of a compressed Nightlight file into a frame
+
+    :param int kind: KEYFRAME or DELTA.
+    :param payload: Compressed record payload.
+    :param previous: The previous frame, which a DELTA record applies to.
+    :param tuple shape: Frame shape (height, width, channels).
+    :return: Read-only uint8 array of the given shape.
+    """
+    data = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+    if data.size != int(np.prod(shape)):
+        raise ValueError('Compressed Nightlight record has {} bytes, expected {}'
+                         .format(data.size, int(np.prod(shape))))
+    data = data.reshape(shape)
+    if kind == KEYFRAME:
+        return data
+    if kind == DELTA:
+        if previous is None:
+            raise ValueError('Compressed Nightlight delta record has no frame to apply to')
+        # uint8 addition wraps around, undoing the writer's wrapped subtraction.
+        frame = previous + data
+        # Held frames are handed out more than once, so none may be changed in place.
+        frame.flags.writeable = False
+        return frame
+    raise ValueError('Unknown compressed Nightlight record kind {}'.format(kind))
+
+
+class BinaryPattern:
+    """ A memory-mapped binary Nightlight file
+
+    Frames are exposed as zero-copy NumPy views of shape (height, width, 3) into the mapped
+    file, so only the pages that are actually played are ever read from disk.
+
+    :param str path: Path to a binary Nightlight file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fin:
+            header = read_header(fin)
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self.width = header['width']
+        self.height = header['height']
+        self.fps = header['fps']
+        self.layout = header['layout']
+        shape = (header['frame_count'], self.height, self.width, CHANNELS[self.layout])
+        if HEADER.size + int(np.prod(shape)) > len(self._mmap):
+            self._mmap.close()
+            raise ValueError('Binary Nightlight file {} is truncated'.format(path))
+        self.frames = np.frombuffer(self._mmap, dtype=np.uint8, count=int(np.prod(shape)),
+                                    offset=HEADER.size).reshape(shape)
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def close(self):
+        """ Release the memory map. Frames previously handed out must no longer be used. """
+        self.frames = None
+        self._mmap.close()
+
+
+class CompressedPattern:
+    """ A memory-mapped compressed Nightlight file
+
+    Frames are decoded one at a time as they are played, so memory use doesn't depend on the
+    length of the pattern. Indexing seeks to the nearest keyframe before the frame, and
+    carries on from the last frame indexed if that is closer, so both random access and
+    stepping through frames in order are cheap.
+
+    :param str path: Path to a compressed Nightlight file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fin:
+            header = read_compressed_header(fin)
+            self.keyframes, self._offsets = read_keyframe_index(fin, header)
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        self.width = header['width']
+        self.height = header['height']
+        self.fps = header['fps']
+        self.layout = header['layout']
+        self.keyframe_interval = header['keyframe_interval']
+        self.frame_shape = (self.height, self.width, CHANNELS[self.layout])
+        self._frame_count = header['frame_count']
+        # (first frame number, end frame number, frame, offset of the next record) of the last
+        # record decoded by indexing.
+        self._last = None
+
+    def __len__(self):
+        return self._frame_count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._frame_count
+        if not 0 <= index < self._frame_count:
+            raise IndexError('Frame index out of range')
+        keyframe = bisect.bisect_right(self.keyframes, index) - 1
+        if self._last is not None and self._last[0] <= index < self._last[1]:
+            return self._last[2]
+        if self._last is not None and self.keyframes[keyframe] <= self._last[0] < index:
+            first, end, frame, offset = self._last
+        else:
+            end, frame, offset = self.keyframes[keyframe], None, self._offsets[keyframe]
+        while end <= index:
+            count, frame, offset = self._decode(offset, frame)
+            first, end = end, end + count
+        self._last = (first, end, frame, offset)
+        return frame
+
+    def __iter__(self):
+        return self.iter_frames()
+
+    def iter_frames(self, start=0):
+        """ Decode the frames of the pattern in order
+
+        Frames in a hold are yielded as the same (read-only) array object.
+
+        :param int start: Frame number to start from.
+        :return: Generator of (height, width, 3) uint8 arrays.
+        """
+        if start >= self._frame_count:
+            return
+        keyframe = bisect.bisect_right(self.keyframes, start) - 1
+        frame_number = self.keyframes[keyframe]
+        offset = self._offsets[keyframe]
+        frame = None
+        while frame_number < self._frame_count:
+            count, frame, offset = self._decode(offset, frame)
+            for _ in range(max(0, frame_number + count - max(frame_number, start))):
+                yield frame
+            frame_number += count
+
+    def _decode(self, offset, previous):
+        """ Decode the record at an offset
+
+        :return: Tuple of (number of frames the record covers, frame, offset of the next
+                 record).
+        """
+        kind, length = RECORD_HEADER.unpack_from(self._mmap, offset)
+        start = offset + RECORD_HEADER.size
+        if kind == HOLD:
+            return length, previous, start
+        frame = decode_record(kind, self._mmap[start:start + length], previous,
+                              self.frame_shape)
+        return 1, frame, start + length
+
+    def close(self):
+        """ Release the memory map. """
+        self._last = None
+        self._mmap.close()
+
+
+class FrameWriter(abc.ABC):
+    """ Base class for writing Nightlight files one frame at a time
+
+    Frames are written to a temporary file next to the output file, which only replaces the
+    output file once the writer is closed successfully. A failed or interrupted conversion
+    therefore never leaves a partially written .nl file behind.
+
+    :param str outfile: Output file path.
+    :param int fps: Frame rate to record in the file, if the format supports it.
+    """
+    mode = 'wb'
+
+    def __init__(self, outfile, fps=30):
+        self.outfile = outfile
+        self.fps = fps
+        self.frame_count = 0
+        self._tmp_path = '{}.{}.tmp'.format(outfile, os.getpid())
+        self._fout = open(self._tmp_path, self.mode)
+        self._start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _start(self):
+        """ Write anything that comes before the first frame. """
+
+    def _finish(self):
+        """ Write anything that comes after the last frame. """
+
+    @abc.abstractmethod
+    def write_frame(self, frame):
+        """ Append a single frame to the file
+
+        :param frame: Array-like of shape (height, width, 3) with values from 0-255.
+        """
+
+    def close(self):
+        """ Finish the file and move it into place. """
+        if self._fout.closed:
+            return
+        self._finish()
+        self._fout.close()
+        os.replace(self._tmp_path, self.outfile)
+
+    def abort(self):
+        """ Discard everything written so far, leaving any existing output file untouched. """
+        if self._fout.closed:
+            return
+        self._fout.close()
+        os.remove(self._tmp_path)
+
+
+class BinaryWriter(FrameWriter):
+    """ Write frames to a binary Nightlight file one at a time
+
+    The frame size is taken from the first frame written and the frame count is filled in
+    when the writer is closed, so frames can be streamed in without knowing the pattern
+    length up front.
+
+    :param str outfile: Output file path.
+    :param int fps: Frame rate to record in the header.
+    """
+
+    def __init__(self, outfile, fps=30):
+        self.width = 0
+        self.height = 0
+        super().__init__(outfile, fps=fps)
+
+    def _start(self):
+        self._write_header()
+
+    def _finish(self):
+        self._fout.seek(0)
+        self._write_header()
+
+    def _write_header(self):
+        self._fout.write(HEADER.pack(MAGIC, VERSION, LAYOUT_RGB24, self.width, self.height,
+                                     self.fps, self.frame_count))
+
+    def write_frame(self, frame):
+        """ Append a single frame to the file
+
+        :param frame: Array-like of shape (height, width, 3) with values from 0-255. An alpha
+                      channel (height, width, 4), as produced by colour maps, is dropped.
+        """
+        self._fout.write(self._check_frame(frame).tobytes())
+        self.frame_count += 1
+
+    def _check_frame(self, frame):
+        """ Validate a frame's shape and convert it to packed RGB
+
+        :param frame: Array-like of shape (height, width, 3) or (height, width, 4).
+        :return: C-contiguous uint8 array of shape (height, width, 3).
+        """
+        frame = np.asarray(frame, dtype=np.uint8)
+        if frame.ndim != 3 or frame.shape[2] not in (3, 4):
+            raise ValueError('Frames must have shape (height, width, 3), got {}'
+                             .format(frame.shape))
+        frame = frame[:, :, :3]
+        if self.frame_count == 0:
+            self.height, self.width = frame.shape[:2]
+        elif frame.shape[:2] != (self.height, self.width):
+            raise ValueError('Frame size {}x{} does not match the first frame ({}x{})'
+                             .format(frame.shape[1], frame.shape[0], self.width, self.height))
+        return np.ascontiguousarray(frame)
+
+
+def write_binary(rgb_array, outfile, fps=30):
+    """ Write an array of RGB values to a binary Nightlight file
+
+    :param rgb_array: RGB array - array or nested list where 1st level = frames of a video,
+                      2nd level = rows of a frame, 3rd level = RGB values of a row.
+    :param str outfile: Output file path.
+    :param int fps: Frame rate to record in the header.
+    """
+    with BinaryWriter(outfile, fps=fps) as writer:
+        for frame in rgb_array:
+            writer.write_frame(frame)
+
+
+class CompressedWriter(BinaryWriter):
+    """ Write frames to a compressed Nightlight file one at a time
+
+    Only the previous frame is kept in memory, and the keyframe index is written when the
+    writer is closed. Frames identical to the previous frame are written as holds.
+
+    :param str outfile: Output file path.
+    :param int fps: Frame rate to record in the header.
+    :param int keyframe_interval: Number of frames from one keyframe to the next. Shorter
+                                  intervals make seeking faster and files bigger.
+    :param int level: zlib compression level, from 1 (fastest) to 9 (smallest).
+    """
+
+    def __init__(self, outfile, fps=30, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL,
+                 level=DEFAULT_COMPRESSION_LEVEL):
+        if not 1 <= keyframe_interval <= 0xffff:
+            raise ValueError('keyframe_interval must be between 1 and 65535')
+        self.keyframe_interval = keyframe_interval
+        self.level = level
+        self._previous = None
+        self._held = 0
+        self._index = []
+        self._index_offset = 0
+        super().__init__(outfile, fps=fps)
+
+    def _finish(self):
+        self._write_hold()
+        self._index_offset = self._fout.tell()
+        self._fout.write(INDEX_COUNT.pack(len(self._index)))
+        for entry in self._index:
+            self._fout.write(INDEX_ENTRY.pack(*entry))
+        self._fout.seek(0)
+        self._write_header()
+
+    def _write_header(self):
+        self._fout.write(COMPRESSED_HEADER.pack(
+            COMPRESSED_MAGIC, COMPRESSED_VERSION, LAYOUT_RGB24, self.width, self.height,
+            self.fps, self.frame_count, self.keyframe_interval, self._index_offset))
+
+    def write_frame(self, frame):
+        """ Append a single frame to the file
+
+        :param frame: Array-like of shape (height, width, 3) with values from 0-255. An alpha
+                      channel (height, width, 4), as produced by colour maps, is dropped.
+        """
+        frame = self._check_frame(frame)
+        if self.frame_count % self.keyframe_interval == 0:
+            self._write_hold()
+            self._index.append((self.frame_count, self._fout.tell()))
+            self._write_record(KEYFRAME, frame)
+        elif np.array_equal(frame, self._previous):
+            self._held += 1
+        else:
+            self._write_hold()
+            # uint8 subtraction wraps around, so the delta is always the same size as a frame.
+            self._write_record(DELTA, frame - self._previous)
+        if not self._held:
+            self._previous = frame.copy()
+        self.frame_count += 1
+
+    def _write_hold(self):
+        if self._held:
+            self._fout.write(RECORD_HEADER.pack(HOLD, self._held))
+            self._held = 0
+
+    def _write_record(self, kind, data):
+        payload = zlib.compress(data.tobytes(), self.level)
+        self._fout.write(RECORD_HEADER.pack(kind, len(payload)))
+        self._fout.write(payload)
+
+
+def write_compressed(rgb_array, outfile, fps=30, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+    """ Write an array of RGB values to a compressed Nightlight file
+
+    :param rgb_array: RGB array - array or nested list where 1st level = frames of a video,
+                      2nd level = rows of a frame, 3rd level = RGB values of a row.
+    :param str outfile: Output file path.
+    :param int fps: Frame rate to record in the header.
+    :param int keyframe_interval: Number of frames from one keyframe to the next.
+    """
+    with CompressedWriter(outfile, fps=fps, keyframe_interval=keyframe_interval) as writer:
+        for frame in rgb_array:
+            writer.write_frame(frame)
+
+
+class JsonWriter(FrameWriter):
+    """ Write frames to a JSON Nightlight file one at a time
+
+    Produces the same output as json.dump() of the full frame list, without holding the
+    whole pattern in memory.
+
+    :param str outfile: Output file path.
+    :param int fps: Unused; accepted for compatibility with BinaryWriter.
+    """
+    mode = 'w'
+
+    def _start(self):
+        self._fout.write('[')
+
+    def _finish(self):
+        self._fout.write(']')
+
+    def write_frame(self, frame):
+        """ Append a single frame to the file
+
+        :param frame: Nested list or array of shape (height, width, 3) with values from 0-255.
+        """
+        if self.frame_count:
+            self._fout.write(', ')
+        if hasattr(frame, 'tolist'):
+            frame = frame.tolist()
+        json.dump(frame, self._fout)
+        self.frame_count += 1
+
+
+WRITERS = {'json': JsonWriter, 'binary': BinaryWriter, 'compressed': CompressedWriter}
+
+
+def open_writer(outfile, file_format='json', fps=30):
+    """ Open a streaming writer for a Nightlight file
+
+    :param str outfile: Output file path.
+    :param str file_format: 'json', 'binary' or 'compressed'.
+    :param int fps: Frame rate recorded in binary and compressed files.
+    :return: JsonWriter, BinaryWriter or CompressedWriter.
+    """
+    if file_format not in WRITERS:
+        raise ValueError('Unknown Nightlight file format {!r} (expected one of {})'
+                         .format(file_format, tuple(WRITERS)))
+    return WRITERS[file_format](outfile, fps=fps)
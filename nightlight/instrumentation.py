@@ -0,0 +1,128 @@
+""" instrumentation.py
+
+This module contains the FrameTimings class, which collects per-frame timings of each stage of
+the playback hot path so stutters can be traced to their cause:
+
+    compose  Converting the frame to pixels (Nightlight._write_pixel / _write_frame), or
+             to a wire frame on the producer thread when playback is pipelined.
+    stall    Waiting for the producer to finish the next frame (pipelined playback only).
+    scale    Applying global brightness to the output buffer (DotStar.show).
+    spi      Writing the buffer to the strip.
+    sleep    Waiting for the frame's deadline.
+    frame    The whole frame, from the start of one frame to the start of the next.
+
+Timing is off unless a FrameTimings object is attached to the Nightlight (and its DotStar);
+when it is off, each hook costs a single `is not None` check.
+
+"""
+import json
+import os
+import time
+from collections import deque
+
+STAGES = ('compose', 'stall', 'scale', 'spi', 'sleep', 'frame')
+PERCENTILES = (50, 95, 99)
+DEFAULT_WINDOW = 600
+
+
+def percentile(sorted_values, pct):
+    """ Get a percentile of a sorted list using the nearest-rank method
+
+    :param sorted_values: Sorted list of numbers.
+    :param pct: Percentile to get (0-100).
+    :return: The value at that percentile, or 0 for an empty list.
+    """
+    if not sorted_values:
+        return 0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+class FrameTimings:
+    """ Rolling per-stage timings of recent frames
+
+    :param int window: Number of recent samples to keep per stage.
+    :param clock: Function returning the current time in nanoseconds.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, clock=time.perf_counter_ns):
+        self.clock = clock
+        self.samples = {stage: deque(maxlen=window) for stage in STAGES}
+        self.frames = 0
+        self._frame_start = None
+
+    def record(self, stage, duration_ns):
+        """ Record how long a stage took
+
+        Safe to call from another thread, eg the producer of a render pipeline.
+
+        :param str stage: One of STAGES.
+        :param int duration_ns: Duration in nanoseconds.
+        """
+        self.samples[stage].append(duration_ns)
+
+    def frame_started(self):
+        """ Mark the start of a frame, recording the length of the previous one """
+        now = self.clock()
+        if self._frame_start is not None:
+            self.samples['frame'].append(now - self._frame_start)
+        self._frame_start = now
+        self.frames += 1
+
+    def interrupt(self):
+        """ Don't count the time until the next frame starts, eg while playback is paused """
+        self._frame_start = None
+
+    def summary(self):
+        """ Summarise the recorded timings
+
+        Must be called from the thread that records timings (eg through the 'stats' command).
+
+        :return: Dict with the achieved frame rate, the number of frames, and for each stage the
+                 mean, p50, p95, p99 and maximum duration in milliseconds.
+        """
+        result = {'frames': self.frames, 'fps': 0.0, 'stages': {}}
+        for stage, samples in self.samples.items():
+            values = sorted(samples)
+            stage_summary = {'count': len(values), 'mean_ms': 0.0, 'max_ms': 0.0}
+            if values:
+                stage_summary['mean_ms'] = sum(values) / len(values) / 1e6
+                stage_summary['max_ms'] = values[-1] / 1e6
+            for pct in PERCENTILES:
+                stage_summary['p{}_ms'.format(pct)] = percentile(values, pct) / 1e6
+            result['stages'][stage] = stage_summary
+        frame_times = self.samples['frame']
+        if frame_times:
+            result['fps'] = len(frame_times) / (sum(frame_times) / 1e9)
+        return result
+
+
+def format_stats(stats):
+    """ Format playback statistics as a human-readable table
+
+    :param stats: Dict returned by Nightlight.stats().
+    :return: Multi-line string.
+    """
+    timings = stats.get('timings', {})
+    lines = ['fps {:.1f}  frames {}  dropped {}  lateness p95 {:.2f} ms'.format(
+        timings.get('fps', 0.0), stats.get('frames_shown', 0), stats.get('frames_dropped', 0),
+        stats.get('p95_lateness_ms', 0.0))]
+    if timings:
+        lines.append('{:<8} {:>9} {:>9} {:>9} {:>9}'.format('stage', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                          'max ms'))
+        for stage, values in timings['stages'].items():
+            lines.append('{:<8} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+                stage, values['p50_ms'], values['p95_ms'], values['p99_ms'], values['max_ms']))
+    return '\n'.join(lines)
+
+
+def dump_stats(stats, path):
+    """ Write playback statistics to a JSON file atomically
+
+    :param stats: Dict returned by Nightlight.stats().
+    :param str path: Output file path.
+    """
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as fout:
+        json.dump(dict(stats, timestamp=time.time()), fout, indent=2)
+    os.replace(tmp_path, path)
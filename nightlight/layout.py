@@ -0,0 +1,255 @@
+""" layout.py
+
+This module contains the Layout class, which describes a board made of several DotStar chains,
+and ChainTransport, which writes each frame to all of the chains at once.
+
+SPI wire time grows with the number of pixels in a chain, so a large board refreshes faster when
+it is split into shorter chains on separate SPI buses. Each chain covers a rectangle of the
+frame and is wired in its own "S" pattern, starting at the rectangle's top left corner.
+
+Nightlight treats the chains as one long chain whose pixel numbers run through each chain in
+turn, so frames are composed, compiled and compared with the last frame written exactly as for
+a single chain. ChainTransport then splits each of these frames into one wire frame per chain
+and writes them concurrently, so a frame takes as long as the longest chain rather than all of
+them together. Chains on different chip selects of the same bus (eg /dev/spidev0.0 and
+/dev/spidev0.1) share the bus, so the kernel still sends their transfers one after the other.
+
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+from nightlight import adafruit_dotstar, transports
+from nightlight.compiler import frame_size
+
+
+class Chain:
+    """ A rectangle of the frame wired as one DotStar chain
+
+    :param int x: Column of the rectangle's top left pixel in the frame.
+    :param int y: Row of the rectangle's top left pixel in the frame.
+    :param int width: Width of the rectangle in pixels.
+    :param int height: Height of the rectangle in pixels.
+    :param transport: How to write to the chain, one of transports.TRANSPORTS, or a transport
+                      object.
+    :param str device: spidev device for the spidev transport (eg /dev/spidev1.0), or the file
+                       or pipe to write to for the file transport. Required for both.
+    :param clock_pin: Clock pin for the busio and bitbang transports, or the name of a pin in
+                      the board module (eg 'SCK_1'). Defaults to board.SCK.
+    :param data_pin: Data pin for the busio and bitbang transports, or the name of a pin in the
+                     board module (eg 'MOSI_1'). Defaults to board.MOSI.
+    """
+
+    def __init__(self, x, y, width, height, transport='spidev', device=None, clock_pin=None,
+                 data_pin=None):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.transport = transport
+        self.device = device
+        self.clock_pin = clock_pin
+        self.data_pin = data_pin
+
+    def __len__(self):
+        return self.width * self.height
+
+    def __repr__(self):
+        return 'Chain({}, {}, {}, {})'.format(self.x, self.y, self.width, self.height)
+
+    def order(self, frame_width):
+        """ Map each pixel number of the chain to its position in the frame
+
+        :param int frame_width: Width of the whole frame in pixels.
+        :return: Array where element i is the flat (y * frame_width + x) index of pixel i.
+        """
+        order = adafruit_dotstar.serpentine_order(self.width, self.height)
+        return (order // self.width + self.y) * frame_width + order % self.width + self.x
+
+    def output(self):
+        """ Identify what the chain writes to, so chains can't share a strip by mistake
+
+        :return: Hashable identifier: the transport object, the device's real path, or the
+                 pins.
+        :raises ValueError: If the chain's spidev or file transport has no device.
+        """
+        if not isinstance(self.transport, str):
+            return self.transport
+        if self.needs_pins():
+            return 'pins', self.clock_pin, self.data_pin
+        if self.device is None:
+            # The spidev transport would otherwise default to the same device for every chain.
+            raise ValueError('{} needs a device for the {} transport'.format(
+                self, self.transport))
+        return 'device', os.path.realpath(self.device)
+
+    def needs_pins(self):
+        """ Check whether the chain's transport drives pins through blinka
+
+        :return: True if the board module is needed to open the transport.
+        """
+        return isinstance(self.transport, str) and transports.needs_pins(self.transport)
+
+    def open(self, baudrate=transports.DEFAULT_BAUDRATE, board=None):
+        """ Open the chain's transport
+
+        :param int baudrate: SPI clock rate in Hz.
+        :param board: The blinka board module, to look the pins up in. Only needed if
+                      needs_pins() is True.
+        :return: Transport, or the transport object the chain was created with.
+        """
+        if not isinstance(self.transport, str):
+            return self.transport
+        clock, data = self.clock_pin, self.data_pin
+        if self.needs_pins():
+            clock = board.SCK if clock is None else clock
+            data = board.MOSI if data is None else data
+            clock = getattr(board, clock) if isinstance(clock, str) else clock
+            data = getattr(board, data) if isinstance(data, str) else data
+        return transports.open_transport(self.transport, clock, data, baudrate, self.device)
+
+
+class Layout:
+    """ A board made of several DotStar chains, each covering a rectangle of the frame
+
+    :param chains: List of Chain objects. Together they must cover every pixel of the frame
+                   exactly once, and each must write to its own device, pins or transport.
+    :param int width: Frame width in pixels. Defaults to the right edge of the chains.
+    :param int height: Frame height in pixels. Defaults to the bottom edge of the chains.
+    """
+
+    def __init__(self, chains, width=None, height=None):
+        self.chains = list(chains)
+        if not self.chains:
+            raise ValueError('A layout needs at least one chain')
+        self.width = max(c.x + c.width for c in self.chains) if width is None else width
+        self.height = max(c.y + c.height for c in self.chains) if height is None else height
+        outputs = set()
+        for chain in self.chains:
+            output = chain.output()
+            if output in outputs:
+                raise ValueError('{} writes to the same output as another chain'.format(chain))
+            outputs.add(output)
+        covered = np.zeros(self.width * self.height, dtype=np.int64)
+        orders = []
+        for chain in self.chains:
+            if chain.x < 0 or chain.y < 0 or chain.x + chain.width > self.width or \
+                    chain.y + chain.height > self.height:
+                raise ValueError('{} does not fit in the {}x{} frame'.format(
+                    chain, self.width, self.height))
+            orders.append(chain.order(self.width))
+            covered[orders[-1]] += 1
+        if (covered != 1).any():
+            raise ValueError('The chains must cover every pixel of the {}x{} frame exactly '
+                             'once'.format(self.width, self.height))
+        # Pixel numbers of the whole board run through each chain in turn.
+        self.order = np.concatenate(orders)
+        self.sizes = [len(chain) for chain in self.chains]
+
+    @property
+    def regions(self):
+        """ The rectangle covered by each chain, as (x, y, width, height) tuples """
+        return tuple((c.x, c.y, c.width, c.height) for c in self.chains)
+
+    def needs_pins(self):
+        """ Check whether any chain's transport drives pins through blinka
+
+        :return: True if the board module is needed to open the transports.
+        """
+        return any(chain.needs_pins() for chain in self.chains)
+
+    def open_transport(self, baudrate=transports.DEFAULT_BAUDRATE, board=None):
+        """ Open every chain's transport
+
+        :param int baudrate: SPI clock rate in Hz.
+        :param board: The blinka board module, to look pins up in. Only needed if needs_pins()
+                      is True.
+        :return: ChainTransport that writes to all of the chains.
+        """
+        opened = []
+        try:
+            for chain in self.chains:
+                opened.append(chain.open(baudrate, board))
+        except Exception:
+            for transport in opened:
+                transport.close()
+            raise
+        return ChainTransport(opened, self.sizes)
+
+
+class ChainTransport:
+    """ Write frames to several chains at once
+
+    Frames are written as if to one long chain: a start header, the pixels of each chain in
+    turn, then an end header. Each chain's pixels are copied into a wire frame of its own, with
+    its own headers, and the chains are written at the same time - the first on the calling
+    thread and the rest on worker threads. write() returns once every chain has been written.
+
+    :param chain_transports: Transport to write each chain with.
+    :param sizes: Number of pixels in each chain.
+    """
+
+    def __init__(self, chain_transports, sizes):
+        if len(chain_transports) != len(sizes):
+            raise ValueError('Expected a transport for each of the {} chains, got {}'.format(
+                len(sizes), len(chain_transports)))
+        self.transports = list(chain_transports)
+        self.sizes = list(sizes)
+        self.size = frame_size(sum(self.sizes))
+        header = adafruit_dotstar.START_HEADER_SIZE
+        self._buffers = []
+        self._slices = []
+        start = header
+        for n in self.sizes:
+            buf = bytearray(frame_size(n))
+            buf[header + n * 4:] = b'\xff' * (len(buf) - header - n * 4)
+            self._buffers.append(buf)
+            self._slices.append((start, start + n * 4))
+            start += n * 4
+        self._executor = None
+        if len(self.transports) > 1:
+            self._executor = ThreadPoolExecutor(max_workers=len(self.transports) - 1,
+                                                thread_name_prefix='nightlight-chain')
+
+    def write(self, buf):
+        if len(buf) != self.size:
+            raise ValueError('Buffer must be {} bytes, got {}'.format(self.size, len(buf)))
+        view = memoryview(buf).cast('B')
+        header = adafruit_dotstar.START_HEADER_SIZE
+        for out, (start, end) in zip(self._buffers, self._slices):
+            out[header:header + end - start] = view[start:end]
+        futures = [self._executor.submit(transport.write, out)
+                   for transport, out in zip(self.transports[1:], self._buffers[1:])]
+        try:
+            self.transports[0].write(self._buffers[0])
+        finally:
+            # The chain buffers are reused, so every write has to finish before returning.
+            wait(futures)
+        for future in futures:
+            future.result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        for transport in self.transports:
+            transport.close()
+
+
+def load_layout(path):
+    """ Read a layout from a JSON file
+
+    The file holds a list of chains, each with the arguments of Chain, and optionally the
+    frame's width and height, eg two 30x18 chains side by side on separate SPI buses:
+
+        {"chains": [{"x": 0, "y": 0, "width": 30, "height": 18, "device": "/dev/spidev0.0"},
+                    {"x": 30, "y": 0, "width": 30, "height": 18, "device": "/dev/spidev1.0"}]}
+
+    :param str path: Path to the layout file.
+    :return: Layout.
+    """
+    with open(path) as fin:
+        spec = json.load(fin)
+    return Layout([Chain(**chain) for chain in spec['chains']], spec.get('width'),
+                  spec.get('height'))
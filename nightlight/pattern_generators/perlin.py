@@ -3,69 +3,251 @@
 This module contains functions for generating pattern arrays using Perlin noise.
 
 Once a base noise pattern has been generated using simplex_noise4d(), masks such
-as quantize() and colourize() can be applied on top of it.
+as quantize() and colourize() can be applied on top of it. For endless patterns, noise_source()
+generates coloured frames in real time as they are played instead.
 
 See https://github.com/LoicGoulefert/perlin-gif for more info.
 
 """
+import functools
+import itertools
 import math
-from typing import Tuple
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional, Tuple
 
 import matplotlib.pyplot as plt
 import numpy as np
 from noise import snoise4
 
+from nightlight.cache import NOISE_CACHE_DIR, DiskCache, make_key
+from nightlight.pattern_generators import simplex
+from nightlight.sources import GeneratorSource
+
+NOISE_BACKENDS = ('numpy', 'snoise4')
+# Number of points to evaluate at once with the numpy backend. Small enough that the working
+# arrays stay in the CPU cache, and bounds memory use for large patterns.
+NOISE_CHUNK_POINTS = 1 << 15
+# Each worker process is given about this many chunks of frames, to balance the load.
+CHUNKS_PER_WORKER = 4
+NOISE_VERSION = 1
+NOISE_CACHE_SIZE = 512 * 1024 ** 2
+
 
 def _simplex_noise4d(shape: Tuple[int, int, int], scale: Tuple[int, int, int],
-                     octaves: int = 1, radius: float = 0.5, random: bool = False) -> np.ndarray:
+                     octaves: int = 1, radius: float = 0.5, random: bool = False,
+                     backend: str = 'numpy', seed: Optional[int] = None,
+                     workers: Optional[int] = None,
+                     cache_dir: Optional[str] = NOISE_CACHE_DIR) -> np.ndarray:
     """ Return a sequence of images representing 4D (looping) simplex noise as an array
 
+    Frames are independent of each other, so they are generated in chunks across a pool of
+    worker processes. Finished patterns are cached on disk, keyed by their parameters, so
+    generating the same pattern again (eg to try another colour map) just loads it.
+
     :param shape:
     :param scale:
     :param octaves:
     :param radius:
     :param random:
+    :param backend: 'numpy' to evaluate the noise a batch of frames at a time with the
+                    vectorized engine in simplex.py, or 'snoise4' to call noise.snoise4() once
+                    per point. Both give the same result.
+    :param seed: If random is True, seed for the random offset, so the same random pattern
+                 can be generated (and found in the cache) again.
+    :param workers: Number of processes to generate frames in. Defaults to the number of CPUs.
+    :param cache_dir: Directory to cache generated patterns in, or None to disable the cache.
+                      Random patterns without a seed are never cached.
     :return:
     """
-    frames = np.zeros(shape)
-    offset = np.random.rand() * 100 if random else 0
-
-    for i in range(shape[2]):
-        cos_value = radius * math.cos(2 * math.pi * (i / shape[2]))
-        sin_value = radius * math.sin(2 * math.pi * (i / shape[2]))
-        for x in range(shape[0]):
-            for y in range(shape[1]):
-                frames[x, y, i] = snoise4(x * scale[0] + offset, y * scale[1] + offset,
-                                          cos_value, sin_value, octaves=octaves)
+    if backend not in NOISE_BACKENDS:
+        raise ValueError('Unknown noise backend {!r} (expected one of {})'
+                         .format(backend, NOISE_BACKENDS))
+    if not random:
+        offset = 0
+    elif seed is None:
+        offset = np.random.rand() * 100
+    else:
+        offset = np.random.RandomState(seed).rand() * 100
+
+    cache = key = None
+    # An unseeded random pattern can never be asked for again, so caching it would only push
+    # useful entries out of the cache.
+    if cache_dir is not None and not (random and seed is None):
+        cache = DiskCache(cache_dir, suffix='.npy', max_size=NOISE_CACHE_SIZE)
+        key = make_key(NOISE_VERSION, tuple(shape), tuple(float(x) for x in scale), octaves,
+                       float(radius), float(offset))
+        path = cache.get(key)
+        if path is not None:
+            return np.load(path)
+
+    frames = np.empty(shape)
+    workers = workers or os.cpu_count() or 1
+    frames_per_chunk = max(-(-shape[2] // (workers * CHUNKS_PER_WORKER)),
+                           -(-NOISE_CHUNK_POINTS // (shape[0] * shape[1])))
+    chunks = [(start, min(start + frames_per_chunk, shape[2]))
+              for start in range(0, shape[2], frames_per_chunk)]
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            futures = {executor.submit(_noise_frames, shape, scale, octaves, radius, offset,
+                                       start, stop, backend): (start, stop)
+                       for start, stop in chunks}
+            for future in as_completed(futures):
+                start, stop = futures[future]
+                frames[:, :, start:stop] = future.result()
+    else:
+        for start, stop in chunks:
+            frames[:, :, start:stop] = _noise_frames(shape, scale, octaves, radius, offset,
+                                                     start, stop, backend)
     frames = ((frames - frames.min()) * (1 / (frames.max() - frames.min()) * 255)).astype('uint8')
+    frames = frames.transpose(2, 0, 1)
+
+    if cache is not None:
+        cache.put(key, lambda tmp_path: _save_array(frames, tmp_path))
+    return frames
+
+
+def _noise_frames(shape, scale, octaves, radius, offset, start, stop, backend='numpy'):
+    """ Evaluate frames start to stop of a looping noise pattern
 
-    return frames.transpose(2, 0, 1)
+    The pattern loops by moving each frame around a circle in the z and w dimensions.
+
+    :return: Array of shape (shape[0], shape[1], stop - start).
+    """
+    if backend == 'snoise4':
+        frames = np.empty((shape[0], shape[1], stop - start))
+        for i in range(start, stop):
+            cos_value = radius * math.cos(2 * math.pi * (i / shape[2]))
+            sin_value = radius * math.sin(2 * math.pi * (i / shape[2]))
+            for x in range(shape[0]):
+                for y in range(shape[1]):
+                    frames[x, y, i - start] = snoise4(x * scale[0] + offset,
+                                                      y * scale[1] + offset,
+                                                      cos_value, sin_value, octaves=octaves)
+        return frames
+
+    frames = np.empty((shape[0], shape[1], stop - start), dtype=np.float32)
+    x = np.arange(shape[0])[:, None, None] * scale[0] + offset
+    y = np.arange(shape[1])[None, :, None] * scale[1] + offset
+    step = max(1, NOISE_CHUNK_POINTS // (shape[0] * shape[1]))
+    for i in range(start, stop, step):
+        angles = 2 * np.pi * (np.arange(i, min(i + step, stop)) / shape[2])
+        z = (radius * np.cos(angles))[None, None, :]
+        w = (radius * np.sin(angles))[None, None, :]
+        frames[:, :, i - start:i - start + len(angles)] = simplex.snoise4(x, y, z, w,
+                                                                          octaves=octaves)
+    return frames
+
+
+def iter_noise_frames(width: int, height: int, period: int, scale: Tuple[float, float],
+                      octaves: int = 1, radius: float = 0.5, offset: float = 0,
+                      colourmap: str = 'gist_rainbow'):
+    """ Generate coloured looping noise frames one at a time, as they are needed
+
+    Unlike _simplex_noise4d(), nothing is precomputed, so this can feed an endless pattern in
+    constant memory (see noise_source()). Each frame takes a millisecond or so to compute on a
+    30x18 board. As the whole pattern is never seen at once, noise values are mapped to colours
+    over the full range of simplex noise rather than stretched to the pattern's minimum and
+    maximum, so the colours are a little less saturated than _colourize(_simplex_noise4d()).
+
+    :param width: Board width in pixels.
+    :param height: Board height in pixels.
+    :param period: Number of frames before the noise loops.
+    :param scale: Noise coordinates per pixel down and across the board.
+    :param octaves: Number of octaves of noise.
+    :param radius: Radius of the circle the pattern loops around in the z and w dimensions.
+                   Larger values change faster.
+    :param offset: Offset added to the x and y coordinates, to start from another part of
+                   the noise.
+    :param colourmap: Matplotlib colour map to use.
+    :return: Endless generator of (height, width, 3) uint8 arrays.
+    """
+    lut = _colourmap_lut(colourmap, 255)
+    shape = (height, width, period)
+    for i in itertools.cycle(range(period)):
+        noise = _noise_frames(shape, scale, octaves, radius, offset, i, i + 1)[:, :, 0]
+        yield lut[np.clip((noise + 1) * 127.5, 0, 255).astype(np.uint8)]
+
+
+def noise_source(width: int = 30, height: int = 18, frames: Optional[int] = None,
+                 period: int = 600, scale: Tuple[float, float] = (0.1, 0.1), **kwargs):
+    """ Create a pattern source that plays looping noise generated in real time
+
+    :param width: Board width in pixels.
+    :param height: Board height in pixels.
+    :param frames: Number of frames to play each time the pattern comes up in a playlist, or
+                   None to play forever.
+    :param period: Number of frames before the noise loops.
+    :param scale: Noise coordinates per pixel down and across the board.
+    :param kwargs: Any other arguments to iter_noise_frames().
+    :return: sources.GeneratorSource to pass to Nightlight.play_patterns().
+    """
+    return GeneratorSource(iter_noise_frames, width, height, period, scale, frames=frames,
+                           **kwargs)
+
+
+def _save_array(array, path):
+    """ Save an array in .npy format to an exact path (np.save() would add a .npy suffix)
+
+    :param array: Array to save.
+    :param str path: Output file path.
+    """
+    with open(path, 'wb') as fout:
+        np.save(fout, array)
 
 
 def _quantize(frames: np.ndarray, bins: int = 2) -> np.ndarray:
     """ Apply quantization to a noise pattern
 
+    uint8 patterns are quantized in place through a 256-entry lookup table, in one vectorized
+    step with no floating point temporaries.
+
     :param frames: Input noise pattern array.
     :param bins: Number of bins to quantize to.
     :return: Input pattern quantized to `bins`.
     """
     w = frames.max() / bins
-    for i in range(frames.shape[0]):
-        frames[i, :, :] -= (frames[i, :, :] - (frames[i, :, :] // w) * w).astype('uint8')
+    if frames.dtype == np.uint8:
+        values = np.arange(256, dtype=np.uint8)
+        lut = values - (values - (values // w) * w).astype('uint8')
+        frames[...] = lut[frames]
+    else:
+        frames -= (frames - (frames // w) * w).astype('uint8')
     return frames
 
 
+@functools.lru_cache(maxsize=32)
+def _colourmap_lut(colourmap: str, max_value: int) -> np.ndarray:
+    """ Tabulate a colour map for uint8 values from 0 to max_value
+
+    :param colourmap: Matplotlib colour map to use.
+    :param max_value: Value that maps to the top of the colour map.
+    :return: Read-only (256, 3) uint8 array of the RGB colour of each value.
+    """
+    cm = plt.get_cmap(colourmap)
+    # An all-zero pattern can't be normalized. As with float patterns, its values become NaN
+    # and take the colour map's 'bad' colour.
+    scale = 1 / max_value if max_value else np.nan
+    lut = np.uint8(cm(np.arange(256, dtype='float64') * scale)[:, :3] * 255)
+    lut.flags.writeable = False
+    return lut
+
+
 def _colourize(frames: np.ndarray, colourmap: str = 'gist_rainbow') -> np.ndarray:
     """ Colour a greyscale noise pattern using a colour map
 
+    Values are normalized so the pattern's maximum maps to the top of the colour map. uint8
+    patterns are coloured in one step through a lookup table of the colour map.
+
     :param frames: Input noise pattern array.
     :param colourmap: Matplotlib colour map to use.
-    :return: Colourized input frames.
+    :return: Colourized input frames, with an extra last dimension of RGB uint8 values.
     """
+    if frames.dtype == np.uint8:
+        return _colourmap_lut(colourmap, int(frames.max()))[frames]
     cm = plt.get_cmap(colourmap)
     frames = frames.astype('float64')
     # Normalize all values to be between 0 and 1
     frames *= 1/frames.max()
-    # Apply the colour map to each frame and reset values to 0-255
-    coloured_frames = np.stack([np.uint8(cm(frame) * 255) for frame in frames])
-    return coloured_frames
+    # Apply the colour map and reset values to 0-255
+    return np.uint8(cm(frames)[..., :3] * 255)
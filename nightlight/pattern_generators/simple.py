@@ -1,5 +1,9 @@
 import copy
+
+import numpy as np
+
 from nightlight.converter import write_rgb_array_to_file
+from nightlight.sources import GeneratorSource
 
 DEFAULT_RESOLUTION = (30, 18)
 
@@ -17,6 +21,29 @@ def generate_test_pattern():
     return frames
 
 
+def iter_test_pattern(resolution=DEFAULT_RESOLUTION):
+    """ Generate the test pattern one frame at a time
+
+    :param resolution: Board resolution (width, height).
+    :return: Generator of (height, width, 3) uint8 arrays, lighting each pixel in turn.
+    """
+    width, height = resolution
+    for i in range(height):
+        for j in range(width):
+            frame = np.zeros((height, width, 3), dtype=np.uint8)
+            frame[i, j] = lit_pixel
+            yield frame
+
+
+def test_pattern_source(resolution=DEFAULT_RESOLUTION):
+    """ Create a pattern source that generates the test pattern as it is played
+
+    :param resolution: Board resolution (width, height).
+    :return: sources.GeneratorSource to pass to Nightlight.play_patterns().
+    """
+    return GeneratorSource(iter_test_pattern, resolution)
+
+
 def create_test_pattern_file(path):
     pattern = generate_test_pattern()
     write_rgb_array_to_file(pattern, path)
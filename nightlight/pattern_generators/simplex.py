@@ -0,0 +1,138 @@
+""" simplex.py
+
+This module contains a vectorized 4D simplex noise engine, which evaluates noise over whole
+arrays of coordinates at once instead of one point per Python call.
+
+It is a NumPy port of noise4() and fbm_noise4() from the C extension of the `noise` library
+(Copyright (c) 2008 Casey Duncan, MIT license), using the same permutation table, gradients
+and single-precision arithmetic, so snoise4() returns the same values as noise.snoise4() for
+the same coordinates.
+
+"""
+import numpy as np
+
+F4 = np.float32(0.30901699437494745)  # (sqrt(5.0) - 1.0) / 4.0
+G4 = np.float32(0.1381966011250105)  # (5.0 - sqrt(5.0)) / 20.0
+
+PERM = np.array([
+    151, 160, 137, 91, 90, 15, 131, 13, 201, 95, 96, 53, 194, 233, 7, 225, 140, 36, 103, 30,
+    69, 142, 8, 99, 37, 240, 21, 10, 23, 190, 6, 148, 247, 120, 234, 75, 0, 26, 197, 62, 94,
+    252, 219, 203, 117, 35, 11, 32, 57, 177, 33, 88, 237, 149, 56, 87, 174, 20, 125, 136, 171,
+    168, 68, 175, 74, 165, 71, 134, 139, 48, 27, 166, 77, 146, 158, 231, 83, 111, 229, 122, 60,
+    211, 133, 230, 220, 105, 92, 41, 55, 46, 245, 40, 244, 102, 143, 54, 65, 25, 63, 161, 1,
+    216, 80, 73, 209, 76, 132, 187, 208, 89, 18, 169, 200, 196, 135, 130, 116, 188, 159, 86,
+    164, 100, 109, 198, 173, 186, 3, 64, 52, 217, 226, 250, 124, 123, 5, 202, 38, 147, 118,
+    126, 255, 82, 85, 212, 207, 206, 59, 227, 47, 16, 58, 17, 182, 189, 28, 42, 223, 183, 170,
+    213, 119, 248, 152, 2, 44, 154, 163, 70, 221, 153, 101, 155, 167, 43, 172, 9, 129, 22, 39,
+    253, 19, 98, 108, 110, 79, 113, 224, 232, 178, 185, 112, 104, 218, 246, 97, 228, 251, 34,
+    242, 193, 238, 210, 144, 12, 191, 179, 162, 241, 81, 51, 145, 235, 249, 14, 239, 107, 49,
+    192, 214, 31, 181, 199, 106, 157, 184, 84, 204, 176, 115, 121, 50, 45, 127, 4, 150, 254,
+    138, 236, 205, 93, 222, 114, 67, 29, 24, 72, 243, 141, 128, 195, 78, 66, 215, 61, 156, 180,
+] * 2, dtype=np.intp)
+
+GRAD4 = np.array([
+    [0, 1, 1, 1], [0, 1, 1, -1], [0, 1, -1, 1], [0, 1, -1, -1],
+    [0, -1, 1, 1], [0, -1, 1, -1], [0, -1, -1, 1], [0, -1, -1, -1],
+    [1, 0, 1, 1], [1, 0, 1, -1], [1, 0, -1, 1], [1, 0, -1, -1],
+    [-1, 0, 1, 1], [-1, 0, 1, -1], [-1, 0, -1, 1], [-1, 0, -1, -1],
+    [1, 1, 0, 1], [1, 1, 0, -1], [1, -1, 0, 1], [1, -1, 0, -1],
+    [-1, 1, 0, 1], [-1, 1, 0, -1], [-1, -1, 0, 1], [-1, -1, 0, -1],
+    [1, 1, 1, 0], [1, 1, -1, 0], [1, -1, 1, 0], [1, -1, -1, 0],
+    [-1, 1, 1, 0], [-1, 1, -1, 0], [-1, -1, 1, 0], [-1, -1, -1, 0],
+], dtype=np.float32).T.copy()
+
+
+def _noise4(x, y, z, w):
+    """ Single octave 4D simplex noise
+
+    :param x, y, z, w: float32 arrays of the same shape.
+    :return: float32 array of noise values in about [-1, 1].
+    """
+    s = (x + y + z + w) * F4
+    i = np.floor(x + s)
+    j = np.floor(y + s)
+    k = np.floor(z + s)
+    l = np.floor(w + s)  # noqa: E741
+    t = (i + j + k + l) * G4
+    x0 = x - (i - t)
+    y0 = y - (j - t)
+    z0 = z - (k - t)
+    w0 = w - (l - t)
+
+    # Rank each axis by how many of the others it is greater than. This is what the lookup in
+    # the C version's SIMPLEX table gives, and determines which simplex the point is in.
+    xy = x0 > y0
+    xz = x0 > z0
+    yz = y0 > z0
+    xw = x0 > w0
+    yw = y0 > w0
+    zw = z0 > w0
+    rank_x = xy.astype(np.int8) + xz + xw
+    rank_y = (~xy).astype(np.int8) + yz + yw
+    rank_z = (~xz).astype(np.int8) + ~yz + zw
+    rank_w = (~xw).astype(np.int8) + ~yw + ~zw
+
+    big_i = i.astype(np.intp) & 255
+    big_j = j.astype(np.intp) & 255
+    big_k = k.astype(np.intp) & 255
+    big_l = l.astype(np.intp) & 255
+
+    total = np.zeros_like(x)
+    for corner in range(5):
+        if corner == 0:
+            offsets = (0, 0, 0, 0)
+        elif corner == 4:
+            offsets = (1, 1, 1, 1)
+        else:
+            threshold = 4 - corner
+            offsets = (rank_x >= threshold, rank_y >= threshold, rank_z >= threshold,
+                       rank_w >= threshold)
+        if corner:
+            bias = np.float32(corner) * G4
+            xc = x0 - offsets[0] + bias
+            yc = y0 - offsets[1] + bias
+            zc = z0 - offsets[2] + bias
+            wc = w0 - offsets[3] + bias
+        else:
+            xc, yc, zc, wc = x0, y0, z0, w0
+
+        gi = PERM[big_i + offsets[0] + PERM[big_j + offsets[1] + PERM[
+            big_k + offsets[2] + PERM[big_l + offsets[3]]]]] & 0x1f
+        t = np.float32(0.6) - xc * xc - yc * yc - zc * zc - wc * wc
+        # Corners further than sqrt(0.6) away don't contribute.
+        np.maximum(t, 0, out=t)
+        t *= t
+        dot = GRAD4[0][gi] * xc + GRAD4[1][gi] * yc + GRAD4[2][gi] * zc + GRAD4[3][gi] * wc
+        total += t * t * dot
+    # The C version scales the sum in double precision and returns it as a float.
+    return (total.astype(np.float64) * 27.0).astype(np.float32)
+
+
+def snoise4(x, y, z, w, octaves=1, persistence=0.5, lacunarity=2.0):
+    """ Evaluate 4D simplex noise at arrays of coordinates
+
+    Equivalent to calling noise.snoise4() at each point. Temporary arrays are several times the
+    size of the coordinate arrays, and evaluation is fastest when they fit in the CPU cache, so
+    for large grids call this on chunks of a few tens of thousands of points.
+
+    :param x, y, z, w: Coordinates - arrays (or scalars) that broadcast together.
+    :param int octaves: Number of octaves of noise to sum. Each octave doubles the frequency
+                        (see lacunarity) and halves the amplitude (see persistence).
+    :param float persistence: Amplitude of each octave relative to the previous one.
+    :param float lacunarity: Frequency of each octave relative to the previous one.
+    :return: float32 array of noise values in about [-1, 1], in the broadcast shape of the
+             coordinates.
+    """
+    if octaves < 1:
+        raise ValueError('Expected octaves value > 0')
+    x, y, z, w = (np.asarray(v, dtype=np.float32) for v in np.broadcast_arrays(x, y, z, w))
+    total = _noise4(x, y, z, w)
+    if octaves == 1:
+        return total
+    freq = amp = max_amp = np.float32(1)
+    for _ in range(1, octaves):
+        freq *= np.float32(lacunarity)
+        amp *= np.float32(persistence)
+        max_amp += amp
+        total += _noise4(x * freq, y * freq, z * freq, w * freq) * amp
+    return total / max_amp
@@ -0,0 +1,132 @@
+""" pipeline.py
+
+This module contains the RenderPipeline class, which decodes and composes the frames of a
+pattern on a producer thread, ahead of the render loop, into a ring of preallocated wire frame
+buffers. The render loop only takes the next finished buffer and writes it at the frame's
+deadline, so a slow decode or compose delays nothing as long as the producer keeps up on
+average.
+
+The ring holds `depth` buffers, so the producer runs at most `depth` frames ahead. The buffers
+are allocated once per pipeline and reused for every frame, and handing one over is a
+semaphore release, so the render loop itself allocates nothing per frame.
+
+"""
+import threading
+
+import numpy as np
+
+DEFAULT_DEPTH = 3
+
+
+class RenderPipeline:
+    """ Compose the frames of a pattern into a ring of buffers on a producer thread
+
+    Iterating starts the producer and yields each finished buffer in turn. A buffer stays
+    valid until the next one is requested, when it goes back to the producer to be reused.
+    Frames are composed ahead of time, so settings that compose reads (eg brightness) take up
+    to `depth` frames to show.
+
+    A frame that is the same object as the previous frame (a hold, see sources.py) is copied
+    from the previous buffer instead of being composed again.
+
+    :param pattern: Iterable of frames.
+    :param compose: Function that composes a frame into a buffer, called as
+                    compose(frame, out) on the producer thread.
+    :param int size: Size of each buffer in bytes.
+    :param int depth: Number of buffers in the ring.
+    :param timings: Optional instrumentation.FrameTimings to record the producer's 'compose'
+                    times and the render loop's 'stall' times in.
+    """
+
+    def __init__(self, pattern, compose, size, depth=DEFAULT_DEPTH, timings=None):
+        if depth < 1:
+            raise ValueError('Pipeline depth must be at least 1')
+        self.pattern = pattern
+        self.compose = compose
+        self.depth = depth
+        self.timings = timings
+        self._buffers = np.zeros((depth, size), dtype=np.uint8)
+        self._slots = list(self._buffers)
+        self._free = threading.Semaphore(depth)
+        self._ready = threading.Semaphore(0)
+        self._produced = 0
+        self._consumed = 0
+        self._stopping = False
+        self._error = None
+        self._thread = None
+
+    def __iter__(self):
+        self.start()
+        try:
+            while True:
+                buf = self.get()
+                if buf is None:
+                    return
+                yield buf
+                self.release()
+        finally:
+            self.close()
+
+    def start(self):
+        """ Start the producer thread """
+        self._thread = threading.Thread(target=self._produce, name='nightlight-producer',
+                                        daemon=True)
+        self._thread.start()
+
+    def get(self):
+        """ Wait for the next finished buffer
+
+        Raises any exception the producer hit while decoding or composing.
+
+        :return: uint8 array holding the next frame, or None at the end of the pattern.
+        """
+        timings = self.timings
+        if timings is not None:
+            start = timings.clock()
+        self._ready.acquire()
+        if timings is not None:
+            timings.record('stall', timings.clock() - start)
+        if self._consumed < self._produced:
+            return self._slots[self._consumed % self.depth]
+        if self._error is not None:
+            raise self._error
+        return None
+
+    def release(self):
+        """ Hand the buffer returned by get() back to the producer """
+        self._consumed += 1
+        self._free.release()
+
+    def close(self):
+        """ Stop the producer and wait for it to finish the frame it is composing """
+        self._stopping = True
+        self._free.release()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _produce(self):
+        timings = self.timings
+        previous = None
+        try:
+            for frame in self.pattern:
+                self._free.acquire()
+                if self._stopping:
+                    return
+                if timings is not None:
+                    start = timings.clock()
+                slot = self._produced % self.depth
+                if frame is previous:
+                    # With a depth of one this copies the buffer onto itself, which still
+                    # holds the previous frame.
+                    self._slots[slot][:] = self._slots[slot - 1]
+                else:
+                    self.compose(frame, self._slots[slot])
+                    previous = frame
+                if timings is not None:
+                    timings.record('compose', timings.clock() - start)
+                self._produced += 1
+                self._ready.release()
+        except Exception as err:
+            self._error = err
+        finally:
+            self._ready.release()
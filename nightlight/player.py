@@ -1,9 +1,11 @@
 import json
 import logging
 import os
-from multiprocessing import Process, Queue
+import select
+import sys
+from threading import Event, Thread
 
-from nightlight import base
+from nightlight import base, control, formats, instrumentation, pipeline, sources
 
 
 def get_file_paths(path, valid_extensions=None):
@@ -31,46 +33,181 @@ def get_file_paths(path, valid_extensions=None):
     return files
 
 
+def load_nightlight_file(path):
+    """ Read a single Nightlight file in the JSON, binary or compressed format
+
+    :param path: Path to a Nightlight file.
+    :return: Nightlight pattern object - a nested list for JSON files, or a memory-mapped
+             formats.BinaryPattern or formats.CompressedPattern for binary or compressed files.
+    """
+    if formats.is_binary_file(path):
+        return formats.BinaryPattern(path)
+    if formats.is_compressed_file(path):
+        return formats.CompressedPattern(path)
+    with open(path, 'r') as file_handler:
+        return json.load(file_handler)
+
+
 def load_nightlight_files(path):
     """ Read one or more Nightlight files into a list
 
     :param path: Path to a Nightlight file or directory of Nightlight files.
-    :return: List of Nightlight pattern objects (nested list).
+    :return: List of Nightlight pattern objects (nested list, formats.BinaryPattern or
+             formats.CompressedPattern).
     """
     paths = get_file_paths(path, valid_extensions=['.nl'])
     result = []
     for file_path in paths:
         try:
-            with open(file_path, 'r') as file_handler:
-                result.append(json.load(file_handler))
+            result.append(load_nightlight_file(file_path))
         except:
             logging.error('Error loading Nightlight file {}'.format(file_path))
     return result
 
 
-def play_nightlight_files(path, max_brightness=1.0, frame_rate=30):
+def open_nightlight_files(path, readahead=sources.DEFAULT_READAHEAD):
+    """ Open one or more Nightlight files as lazily-streamed pattern sources
+
+    Unlike load_nightlight_files(), no frame data is read until a pattern is played, so
+    memory use and time to first frame do not depend on the size of the playlist.
+
+    :param path: Path to a Nightlight file or directory of Nightlight files.
+    :param readahead: Number of frames to read from disk at a time during playback.
+    :return: List of sources.FileFrameSource objects.
+    """
+    paths = get_file_paths(path, valid_extensions=['.nl'])
+    return [sources.FileFrameSource(file_path, readahead=readahead) for file_path in paths]
+
+
+def play_nightlight_files(path, max_brightness=1.0, frame_rate=30, precompile=False,
+                          late_policy='drop', socket_path=control.DEFAULT_SOCKET_PATH,
+                          stats=False, stats_file=None, stats_interval=5.0,
+                          keep_alive=base.DEFAULT_KEEP_ALIVE,
+                          pipeline_depth=pipeline.DEFAULT_DEPTH, blank=True, transport='auto',
+                          device=None, layout=None):
     """ Play a Nightlight file or directory of Nightlight files
 
+    Playback can be controlled by typing commands (eg 'brightness 0.3', 'next', 'exit') or by
+    sending them to the control socket, eg with `nightlight control`.
+
     :param path: Path to a Nightlight file or directory of Nightlight files.
     :param max_brightness: The maximum global brightness during playback.
     :param frame_rate: The frame rate to use in frames per second.
+    :param precompile: If True, compile patterns to SPI wire frames (cached on disk) before
+                       playing them.
+    :param late_policy: What to do when frames are late - 'drop', 'catch_up' or 'stretch'
+                        (see scheduler.py).
+    :param socket_path: Path of the Unix domain socket to serve control commands on, or None
+                        to disable the control server.
+    :param stats: If True, time each stage of playback and print a summary every
+                  stats_interval seconds.
+    :param stats_file: If supplied, time each stage of playback and write the statistics to
+                       this file as JSON every stats_interval seconds.
+    :param stats_interval: Seconds between statistics reports.
+    :param keep_alive: Seconds after which a frame the strip is already showing is written
+                       again. Unchanged frames are not written more often than this. 0 writes
+                       every frame.
+    :param pipeline_depth: Number of frames to decode and compose ahead of the frame being
+                           shown, on a separate thread (see pipeline.py). 0 composes each
+                           frame just before it is shown.
+    :param blank: If True, turn the board off between patterns. If False, patterns follow
+                  each other without a gap.
+    :param transport: How to write to the strip, one of transports.TRANSPORTS.
+    :param device: spidev device for the spidev transport, or the file or pipe to write to
+                   for the file transport.
+    :param layout: layout.Layout to split frames across several chains with, each written with
+                   its own transport. transport and device are ignored.
     """
-    patterns = load_nightlight_files(path)
-    queue = Queue()
+    patterns = open_nightlight_files(path)
     board = base.Nightlight(
         max_brightness=max_brightness,
         default_frame_rate=frame_rate,
-        queue=queue)
-    p = Process(target=board.play_patterns, args=(patterns,), daemon=True)
-    p.start()
+        late_policy=late_policy,
+        keep_alive=keep_alive,
+        pipeline_depth=pipeline_depth,
+        transport=transport,
+        device=device,
+        layout=layout)
+    server = None
+    if socket_path is not None:
+        server = control.ControlServer(board, socket_path, open_patterns=open_nightlight_files)
+        server.start()
+    stop_reading = Event()
+    reader = Thread(target=read_commands, args=(board, stop_reading), daemon=True)
+    reader.start()
+    reporter = None
+    if stats or stats_file:
+        board.enable_timings()
+        reporter = Thread(target=report_stats,
+                          args=(board, stop_reading, stats, stats_file, stats_interval),
+                          daemon=True)
+        reporter.start()
     try:
-        while True:
-            command = input("Enter command: ")
-            queue.put(command)
-            if command == "exit":
-                break
+        board.play_patterns(patterns, precompile, blank=blank)
     except KeyboardInterrupt as err:
         pass
     finally:
-        p.terminate()
+        stop_reading.set()
+        reader.join()
+        if reporter is not None:
+            reporter.join()
+            # Playback has stopped, so it is safe to read the final statistics directly.
+            final_stats = board.stats()
+            if stats:
+                print(instrumentation.format_stats(final_stats))
+            if stats_file:
+                instrumentation.dump_stats(final_stats, stats_file)
+        if server is not None:
+            server.stop()
         board.write_colour((0, 0, 0))
+
+
+def read_commands(board, stop):
+    """ Read commands typed at the terminal and send them to a playing Nightlight
+
+    :param board: The base.Nightlight to send commands to.
+    :param stop: threading.Event that is set when playback has finished.
+    """
+    print("Enter command: ", end='', flush=True)
+    while not stop.is_set():
+        # Poll rather than block in input(), so this thread can finish when playback stops.
+        readable, _, _ = select.select([sys.stdin], [], [], 0.2)
+        if not readable:
+            continue
+        line = sys.stdin.readline()
+        if not line:
+            return
+        try:
+            command, kwargs = control.parse_request(line)
+            if command == 'load':
+                kwargs = {'patterns': open_nightlight_files(kwargs['path'])}
+            result = board.send_command(command, **kwargs).result(control.COMMAND_TIMEOUT)
+            if result is not None:
+                print(result)
+        except Exception as err:
+            logging.error('Command failed: {}'.format(err))
+        print("Enter command: ", end='', flush=True)
+
+
+def report_stats(board, stop, show=True, stats_file=None, interval=5.0):
+    """ Periodically print and/or save the statistics of a playing Nightlight
+
+    Statistics are requested through the 'stats' command, so they are gathered on the render
+    thread at a frame boundary.
+
+    :param board: The base.Nightlight to report on.
+    :param stop: threading.Event that is set when playback has finished.
+    :param show: If True, print a summary.
+    :param stats_file: If supplied, write the statistics to this file as JSON.
+    :param interval: Seconds between reports.
+    """
+    while not stop.wait(interval):
+        try:
+            stats = board.send_command('stats').result(control.COMMAND_TIMEOUT)
+        except Exception as err:
+            logging.error('Could not get playback statistics: {}'.format(err))
+            continue
+        if show:
+            print(instrumentation.format_stats(stats))
+        if stats_file:
+            instrumentation.dump_stats(stats, stats_file)
@@ -0,0 +1,132 @@
+""" scheduler.py
+
+This module contains the FrameScheduler class, which paces playback against absolute frame
+deadlines on the monotonic clock so that frame timing never drifts, however long a show runs.
+
+Frame i is due at start + i / frame_rate. When a frame cannot be shown on time, the late frame
+policy decides what happens:
+
+    drop      Skip frames whose deadline has already passed by a whole frame period, so
+              playback stays locked to the clock (eg to keep in sync with audio).
+    catch_up  Show every frame, without sleeping, until playback is back on schedule.
+    stretch   Show every frame and push all later deadlines back by however late this frame
+              was, so the show runs long instead of skipping or speeding up.
+
+"""
+import time
+from collections import deque
+
+LATE_POLICIES = ('drop', 'catch_up', 'stretch')
+NS_PER_SECOND = 1000000000
+
+
+class FrameScheduler:
+    """ Schedule frames against absolute deadlines
+
+    Typical use in a render loop:
+
+        scheduler.start()
+        for frame in pattern:
+            if not scheduler.next_frame():
+                continue  # dropped
+            ... compose the frame ...
+            scheduler.wait()
+            ... show the frame ...
+
+    :param float frame_rate: Frame rate in frames per second.
+    :param str late_policy: What to do with late frames - 'drop', 'catch_up' or 'stretch'.
+    :param int history: Number of recent frames to keep lateness measurements for.
+    :param clock: Function returning the current time in nanoseconds.
+    :param sleep: Function that sleeps for a number of seconds.
+    """
+
+    def __init__(self, frame_rate, late_policy='drop', history=1000, clock=time.monotonic_ns,
+                 sleep=time.sleep):
+        if late_policy not in LATE_POLICIES:
+            raise ValueError('Unknown late frame policy {!r} (expected one of {})'
+                             .format(late_policy, LATE_POLICIES))
+        self.late_policy = late_policy
+        self._clock = clock
+        self._sleep = sleep
+        self._period_ns = 0
+        self._origin_ns = None
+        self._index = -1
+        self.frame_rate = frame_rate
+        self.lateness_ns = deque(maxlen=history)
+        self.frames_shown = 0
+        self.frames_dropped = 0
+
+    @property
+    def frame_rate(self):
+        """ Frame rate in frames per second """
+        return NS_PER_SECOND / self._period_ns
+
+    @frame_rate.setter
+    def frame_rate(self, frame_rate):
+        period_ns = round(NS_PER_SECOND / frame_rate)
+        if period_ns == self._period_ns:
+            return
+        if self._origin_ns is not None and self._index >= 0:
+            # Rebase the timeline on the current frame so earlier deadlines don't move.
+            self._origin_ns = self.deadline()
+            self._index = 0
+        self._period_ns = period_ns
+
+    def start(self, origin_ns=None):
+        """ Start (or restart) the timeline
+
+        :param int origin_ns: Clock time the first frame is due at. Defaults to now. Passing
+                              a shared origin keeps several players on the same timeline.
+        """
+        self._origin_ns = self._clock() if origin_ns is None else origin_ns
+        self._index = -1
+
+    def deadline(self, index=None):
+        """ Get the clock time a frame is due at
+
+        :param int index: Frame number on the current timeline. Defaults to the current frame.
+        :return: Deadline in nanoseconds.
+        """
+        if index is None:
+            index = self._index
+        return self._origin_ns + index * self._period_ns
+
+    def next_frame(self):
+        """ Advance to the next frame
+
+        :return: False if the frame is late and should be dropped, True otherwise.
+        """
+        if self._origin_ns is None:
+            self.start()
+        self._index += 1
+        if self.late_policy == 'drop' and self._clock() >= self.deadline(self._index + 1):
+            self.frames_dropped += 1
+            return False
+        return True
+
+    def wait(self):
+        """ Sleep until the current frame is due and record how late it is """
+        deadline = self.deadline()
+        remaining = deadline - self._clock()
+        if remaining > 0:
+            self._sleep(remaining / NS_PER_SECOND)
+        lateness = self._clock() - deadline
+        if self.late_policy == 'stretch' and lateness > 0:
+            self._origin_ns += lateness
+        self.lateness_ns.append(lateness)
+        self.frames_shown += 1
+
+    def stats(self):
+        """ Summarise the timing of recent frames
+
+        :return: Dict with the number of frames shown and dropped, and the mean, 95th percentile
+                 and maximum lateness of recent frames in milliseconds.
+        """
+        lateness = sorted(self.lateness_ns)
+        result = {'frames_shown': self.frames_shown, 'frames_dropped': self.frames_dropped,
+                  'mean_lateness_ms': 0.0, 'p95_lateness_ms': 0.0, 'max_lateness_ms': 0.0}
+        if lateness:
+            result['mean_lateness_ms'] = sum(lateness) / len(lateness) / 1e6
+            result['p95_lateness_ms'] = lateness[int(0.95 * (len(lateness) - 1))] / 1e6
+            result['max_lateness_ms'] = lateness[-1] / 1e6
+        return result
@@ -0,0 +1,222 @@
+""" sources.py
+
+This module contains pattern sources that stream frames from Nightlight files, or generate
+them, on demand, so that playback memory stays flat regardless of how many patterns are in a
+playlist or how long they are.
+
+A pattern source is any re-iterable object that yields frames; Nightlight.play_patterns()
+iterates each source once per loop of the playlist. Yielding the same frame object again means
+the frame is unchanged (a hold), and the player skips redrawing it, so a source must yield a
+new object for every frame that changes rather than updating one in place.
+
+"""
+import bisect
+import itertools
+import json
+import logging
+
+import numpy as np
+
+from nightlight import formats
+
+DEFAULT_READAHEAD = 8
+JSON_CHUNK_SIZE = 64 * 1024
+
+
+class FileFrameSource:
+    """ Stream the frames of a Nightlight file from disk
+
+    Nothing is read until the source is iterated. Each iteration opens the file and reads
+    `readahead` frames at a time, so at most that many frames are held in memory.
+
+    :param str path: Path to a Nightlight file (JSON, binary or compressed).
+    :param int readahead: Number of frames to read from disk in each read. Compressed files
+                          are always decoded one frame at a time.
+    """
+
+    def __init__(self, path, readahead=DEFAULT_READAHEAD):
+        self.path = path
+        self.readahead = max(1, readahead)
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.path)
+
+    def __iter__(self):
+        try:
+            with open(self.path, 'rb') as fin:
+                magic = fin.read(len(formats.MAGIC))
+                fin.seek(0)
+                if magic == formats.MAGIC:
+                    yield from iter_binary_frames(fin, self.readahead)
+                elif magic == formats.COMPRESSED_MAGIC:
+                    yield from iter_compressed_frames(fin)
+                else:
+                    yield from iter_json_frames(fin)
+        except (OSError, ValueError):
+            logging.error('Error reading Nightlight file {}'.format(self.path))
+
+
+class GeneratorSource:
+    """ Generate the frames of a pattern just in time, as they are played
+
+    Each iteration calls `function` for a fresh iterator of frames, so a generator function
+    works, and only the frame being shown is held in memory. Generated patterns can run
+    forever, so `frames` sets a budget of frames to play before moving on to the next pattern
+    in the playlist.
+
+    :param function: Function that returns an iterator of frames, eg a generator function.
+    :param args: Positional arguments for function.
+    :param int frames: Maximum number of frames to play each time the pattern comes up in the
+                       playlist, or None to play until the iterator is exhausted. Keyword only,
+                       so it is never mistaken for an argument of function.
+    :param kwargs: Keyword arguments for function.
+    """
+
+    def __init__(self, function, *args, frames=None, **kwargs):
+        self.function = function
+        self.frames = frames
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return '{}({}, frames={!r})'.format(type(self).__name__,
+                                            getattr(self.function, '__name__', self.function),
+                                            self.frames)
+
+    def __iter__(self):
+        frames = self.function(*self.args, **self.kwargs)
+        if self.frames is not None:
+            frames = itertools.islice(frames, self.frames)
+        return iter(frames)
+
+
+class PrefetchedSource:
+    """ A pattern whose first frames have already been read
+
+    Creating one starts iterating the pattern and reads `frames` frames ahead, eg on a
+    background thread while another pattern plays, so the first frames can be played straight
+    away. Iterating yields those frames and then carries on with the rest of the pattern. It
+    can only be iterated once.
+
+    :param pattern: Any iterable of frames.
+    :param int frames: Number of frames to read ahead.
+    """
+
+    def __init__(self, pattern, frames=DEFAULT_READAHEAD):
+        self.pattern = pattern
+        self._iterator = iter(pattern)
+        self._head = list(itertools.islice(self._iterator, frames))
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.pattern)
+
+    def __iter__(self):
+        head, self._head = self._head, []
+        yield from head
+        yield from self._iterator
+
+
+def iter_binary_frames(fin, readahead=DEFAULT_READAHEAD):
+    """ Yield the frames of a binary Nightlight file, reading several frames per read
+
+    :param fin: Binary file object positioned at the start of a binary Nightlight file.
+    :param int readahead: Number of frames to read from disk in each read.
+    :return: Generator of (height, width, 3) uint8 arrays.
+    """
+    header = formats.read_header(fin)
+    frame_shape = (header['height'], header['width'], formats.CHANNELS[header['layout']])
+    frame_size = int(np.prod(frame_shape))
+    remaining = header['frame_count']
+    while remaining:
+        count = min(readahead, remaining)
+        data = fin.read(frame_size * count)
+        if len(data) < frame_size * count:
+            raise ValueError('Binary Nightlight file is truncated')
+        yield from np.frombuffer(data, dtype=np.uint8).reshape((count,) + frame_shape)
+        remaining -= count
+
+
+def iter_compressed_frames(fin, start=0):
+    """ Yield the frames of a compressed Nightlight file, decoding one frame at a time
+
+    :param fin: Binary file object positioned at the start of a compressed Nightlight file.
+    :param int start: Frame number to start from. Decoding starts at the nearest keyframe
+                      before it, found in the file's keyframe index.
+    :return: Generator of read-only (height, width, 3) uint8 arrays. Frames in a hold are
+             yielded as the same array object.
+    """
+    header = formats.read_compressed_header(fin)
+    frame_shape = (header['height'], header['width'], formats.CHANNELS[header['layout']])
+    frame_number = 0
+    if start:
+        keyframes, offsets = formats.read_keyframe_index(fin, header)
+        if start >= header['frame_count']:
+            return
+        keyframe = bisect.bisect_right(keyframes, start) - 1
+        frame_number = keyframes[keyframe]
+        fin.seek(offsets[keyframe])
+    frame = None
+    while frame_number < header['frame_count']:
+        data = fin.read(formats.RECORD_HEADER.size)
+        if len(data) < formats.RECORD_HEADER.size:
+            raise ValueError('Compressed Nightlight file is truncated')
+        kind, length = formats.RECORD_HEADER.unpack(data)
+        count = 1
+        if kind == formats.HOLD:
+            count = length
+        else:
+            payload = fin.read(length)
+            if len(payload) < length:
+                raise ValueError('Compressed Nightlight file is truncated')
+            frame = formats.decode_record(kind, payload, frame, frame_shape)
+        for _ in range(max(0, frame_number + count - max(frame_number, start))):
+            yield frame
+        frame_number += count
+
+
+def iter_json_frames(fin, chunk_size=JSON_CHUNK_SIZE):
+    """ Yield the frames of a JSON Nightlight file without parsing the whole file
+
+    The file is read in chunks and each top-level element of the frame list is decoded as
+    soon as it is complete.
+
+    :param fin: File object positioned at the start of a JSON Nightlight file.
+    :param int chunk_size: Number of bytes to read at a time.
+    :return: Generator of frames (nested lists).
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def read_more(buf, pos):
+        data = fin.read(max(chunk_size, len(buf) - pos))
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return buf[pos:] + data, 0, not data
+
+    in_list = False
+    while True:
+        while pos < len(buf) and (buf[pos].isspace() or (in_list and buf[pos] == ',')):
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                raise ValueError('Unexpected end of JSON Nightlight file')
+            buf, pos, eof = read_more(buf, pos)
+            continue
+        if not in_list:
+            if buf[pos] != '[':
+                raise ValueError('JSON Nightlight file must contain a list of frames')
+            in_list = True
+            pos += 1
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            frame, pos = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            buf, pos, eof = read_more(buf, pos)
+            continue
+        yield frame
@@ -0,0 +1,194 @@
+""" transports.py
+
+This module contains the transports that DotStar writes finished frame buffers to the strip
+with:
+
+    busio    Hardware SPI through blinka's busio.SPI.
+    bitbang  Toggles the clock and data pins one bit at a time through blinka's digitalio.
+             Only a few kHz, so it is the last resort.
+    spidev   Writes straight to a Linux spidev device (eg /dev/spidev0.0), without blinka, in
+             chunks no bigger than the kernel's spidev buffer.
+    file     Writes the bytes to a file or named pipe, so playback can be recorded or tested
+             with no hardware attached.
+
+A transport is any object with write(buf) and close() methods. open_transport() creates one
+by name.
+
+"""
+import os
+import struct
+
+TRANSPORTS = ('auto', 'busio', 'bitbang', 'spidev', 'file')
+DEFAULT_BAUDRATE = 4000000
+DEFAULT_SPIDEV = '/dev/spidev0.0'
+SPIDEV_BUFSIZ_PATH = '/sys/module/spidev/parameters/bufsiz'
+# The kernel's default if the spidev module parameter can't be read.
+DEFAULT_SPIDEV_BUFSIZ = 4096
+
+# ioctl requests from linux/spi/spidev.h: _IOW('k', nr, size).
+SPI_IOC_WR_MODE = 0x40016b01
+SPI_IOC_WR_BITS_PER_WORD = 0x40016b03
+SPI_IOC_WR_MAX_SPEED_HZ = 0x40046b04
+
+
+class BusioTransport:
+    """ Write to the strip with hardware SPI through blinka's busio.SPI
+
+    :param clock: Clock pin, eg board.SCK.
+    :param data: Data pin, eg board.MOSI.
+    :param int baudrate: SPI clock rate in Hz.
+    """
+
+    def __init__(self, clock, data, baudrate=DEFAULT_BAUDRATE):
+        import busio
+        self._spi = busio.SPI(clock, MOSI=data)
+        while not self._spi.try_lock():
+            pass
+        self._spi.configure(baudrate=baudrate)
+
+    def write(self, buf):
+        # Compiled and pipelined frames are NumPy arrays, which blinka's SPI.write() can't
+        # take: it starts by testing the buffer's truth value.
+        self._spi.write(memoryview(buf).cast('B'))
+
+    def close(self):
+        self._spi.deinit()
+
+
+class BitbangTransport:
+    """ Write to the strip by toggling the clock and data pins through blinka's digitalio
+
+    :param clock: Clock pin, eg board.SCK.
+    :param data: Data pin, eg board.MOSI.
+    """
+
+    def __init__(self, clock, data):
+        import digitalio
+        self.dpin = digitalio.DigitalInOut(data)
+        self.cpin = digitalio.DigitalInOut(clock)
+        self.dpin.direction = digitalio.Direction.OUTPUT
+        self.cpin.direction = digitalio.Direction.OUTPUT
+        self.cpin.value = False
+
+    def write(self, buf):
+        for b in buf:
+            for _ in range(8):
+                self.cpin.value = True
+                self.dpin.value = (b & 0x80)
+                self.cpin.value = False
+                b = b << 1
+        self.cpin.value = False
+
+    def close(self):
+        self.dpin.deinit()
+        self.cpin.deinit()
+
+
+class FileTransport:
+    """ Write the bytes sent to the strip to a file or named pipe
+
+    Every frame is appended to the file, so a recording holds the frames back to back. Frames
+    are written with os.write() in chunks of at most chunk_size bytes, without copying.
+
+    :param str path: Path of the file or pipe to write to. Files are created or truncated.
+    :param int chunk_size: Largest number of bytes to write in one call, or None for no limit.
+    """
+    open_flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+
+    def __init__(self, path, chunk_size=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._fd = os.open(path, self.open_flags, 0o644)
+
+    def write(self, buf):
+        view = memoryview(buf).cast('B')
+        chunk_size = self.chunk_size or len(view)
+        while view:
+            written = os.write(self._fd, view[:chunk_size])
+            view = view[written:]
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class SpidevTransport(FileTransport):
+    """ Write to the strip through a Linux spidev device, without blinka
+
+    Each write() to a spidev device is a separate SPI transfer, which the kernel rejects if it
+    is bigger than the spidev module's bufsiz. Frames are therefore written in chunks of
+    bufsiz bytes. APA102 strips have no chip select, so splitting a frame across transfers
+    doesn't affect it.
+
+    :param str path: spidev device path.
+    :param int baudrate: SPI clock rate in Hz.
+    :param int bufsiz: Largest transfer size, in bytes. Read from the spidev module's
+                       parameters by default.
+    """
+    # Never create the device: if SPI isn't enabled, opening it should fail, not leave a
+    # regular file in its place.
+    open_flags = os.O_WRONLY
+
+    def __init__(self, path=DEFAULT_SPIDEV, baudrate=DEFAULT_BAUDRATE, bufsiz=None):
+        super().__init__(path, chunk_size=bufsiz or spidev_bufsiz())
+        import fcntl
+        try:
+            fcntl.ioctl(self._fd, SPI_IOC_WR_MODE, struct.pack('B', 0))
+            fcntl.ioctl(self._fd, SPI_IOC_WR_BITS_PER_WORD, struct.pack('B', 8))
+            fcntl.ioctl(self._fd, SPI_IOC_WR_MAX_SPEED_HZ, struct.pack('I', baudrate))
+        except OSError:
+            self.close()
+            raise
+
+
+def spidev_bufsiz(path=SPIDEV_BUFSIZ_PATH):
+    """ Get the largest transfer the spidev driver accepts
+
+    :param str path: Path of the spidev module's bufsiz parameter.
+    :return: Size in bytes.
+    """
+    try:
+        with open(path) as fin:
+            return int(fin.read())
+    except (OSError, ValueError):
+        return DEFAULT_SPIDEV_BUFSIZ
+
+
+def open_transport(name='auto', clock=None, data=None, baudrate=DEFAULT_BAUDRATE, device=None):
+    """ Create a transport by name
+
+    :param str name: One of TRANSPORTS. 'auto' uses hardware SPI through busio, falling back
+                     to bit-banging the pins if it isn't available.
+    :param clock: Clock pin, for busio and bitbang.
+    :param data: Data pin, for busio and bitbang.
+    :param int baudrate: SPI clock rate in Hz, for busio and spidev.
+    :param str device: Device path for spidev (default DEFAULT_SPIDEV), or the file or pipe
+                       to write to for file.
+    :return: Transport.
+    """
+    if name == 'auto':
+        try:
+            return BusioTransport(clock, data, baudrate)
+        except (NotImplementedError, ValueError):
+            return BitbangTransport(clock, data)
+    if name == 'busio':
+        return BusioTransport(clock, data, baudrate)
+    if name == 'bitbang':
+        return BitbangTransport(clock, data)
+    if name == 'spidev':
+        return SpidevTransport(device or DEFAULT_SPIDEV, baudrate)
+    if name == 'file':
+        if device is None:
+            raise ValueError('The file transport needs a device path to write to')
+        return FileTransport(device)
+    raise ValueError('Unknown transport {!r} (expected one of {})'.format(name, TRANSPORTS))
+
+
+def needs_pins(name):
+    """ Check whether a transport drives the board's pins through blinka
+
+    :param str name: One of TRANSPORTS.
+    :return: True if the transport needs clock and data pins.
+    """
+    return name in ('auto', 'busio', 'bitbang')
@@ -0,0 +1,120 @@
+""" test_cache.py
+
+Tests for the on-disk LRU cache in nightlight/cache.py.
+
+"""
+import os
+
+import pytest
+
+from nightlight.cache import DiskCache, make_key
+
+
+def write_bytes(size):
+    def write(path):
+        with open(path, 'wb') as fout:
+            fout.write(b'x' * size)
+    return write
+
+
+def set_last_used(cache, key, seconds):
+    os.utime(cache.path(key), (seconds, seconds))
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return DiskCache(str(tmp_path / 'cache'), suffix='.bin')
+
+
+def test_put_and_get(cache):
+    assert cache.get('a') is None
+    assert cache.keys() == []
+    path = cache.put('a', write_bytes(10))
+    assert path == cache.path('a') and path.endswith('a.bin')
+    assert cache.get('a') == path
+    assert cache.size() == 10
+
+
+def test_put_with_key_from_write(cache):
+    def write(path):
+        write_bytes(3)(path)
+        return 'written'
+
+    assert cache.put(None, write) == cache.path('written')
+    assert cache.keys() == ['written']
+
+
+def test_failed_put_leaves_nothing(cache):
+    def write(path):
+        write_bytes(5)(path)
+        raise RuntimeError('Write failed')
+
+    with pytest.raises(RuntimeError):
+        cache.put('a', write)
+    assert os.listdir(cache.directory) == []
+
+
+def test_keys_by_prefix(cache):
+    for key in ('abc-1', 'abc-2', 'abd-1'):
+        cache.put(key, write_bytes(1))
+    assert sorted(cache.keys(prefix='abc')) == ['abc-1', 'abc-2']
+    cache.remove('abc-1')
+    cache.remove('missing')
+    assert sorted(cache.keys()) == ['abc-2', 'abd-1']
+
+
+def test_entries_are_least_recently_used_first(cache):
+    for key, seconds in (('a', 300), ('b', 100), ('c', 200)):
+        cache.put(key, write_bytes(1))
+        set_last_used(cache, key, seconds)
+    assert [entry.key for entry in cache.entries()] == ['b', 'c', 'a']
+    # get() marks an entry as the most recently used.
+    cache.get('b')
+    assert [entry.key for entry in cache.entries()] == ['c', 'a', 'b']
+
+
+def test_prune_evicts_least_recently_used(cache):
+    for key, seconds in (('a', 100), ('b', 200), ('c', 300)):
+        cache.put(key, write_bytes(10))
+        set_last_used(cache, key, seconds)
+    evicted = cache.prune(15)
+    assert [entry.key for entry in evicted] == ['a', 'b']
+    assert cache.keys() == ['c']
+    assert cache.prune(15) == []
+
+
+def test_prune_keeps_protected_keys(cache):
+    for key, seconds in (('a', 100), ('b', 200), ('c', 300)):
+        cache.put(key, write_bytes(10))
+        set_last_used(cache, key, seconds)
+    cache.prune(20, keep=('a',))
+    assert sorted(cache.keys()) == ['a', 'c']
+    # Kept entries still count towards the size, so others are evicted to make up for them.
+    cache.prune(10, keep=('a',))
+    assert cache.keys() == ['a']
+
+
+def test_size_limit_evicts_on_put(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_size=25)
+    for key, seconds in (('a', 100), ('b', 200)):
+        cache.put(key, write_bytes(10))
+        set_last_used(cache, key, seconds)
+    cache.get('a')
+    # The new entry takes the cache over the limit, so the least recently used entry (b) goes.
+    cache.put('c', write_bytes(10))
+    assert sorted(cache.keys()) == ['a', 'c']
+    # An entry bigger than the limit is still kept, but everything else is evicted.
+    cache.put('d', write_bytes(30))
+    assert cache.keys() == ['d']
+
+
+def test_clear(cache):
+    cache.put('a', write_bytes(1))
+    cache.put('b', write_bytes(1))
+    assert len(cache.clear()) == 2
+    assert cache.keys() == []
+
+
+def test_make_key():
+    assert make_key(1, 'a', (2.0,)) == make_key(1, 'a', (2.0,))
+    assert make_key(1, 'a') != make_key('1', 'a')
@@ -0,0 +1,82 @@
+""" test_compiler.py
+
+Tests for the compile cache in nightlight/compiler.py.
+
+"""
+import os
+import threading
+
+import numpy as np
+import pytest
+
+from nightlight import compiler, formats
+
+WIDTH = 5
+HEIGHT = 3
+
+
+@pytest.fixture
+def frames():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, size=(6, HEIGHT, WIDTH, 3), dtype=np.uint8)
+
+
+def compile_pattern(pattern, cache_dir, **kwargs):
+    return compiler.compile_pattern(pattern, WIDTH, HEIGHT, cache_dir=str(cache_dir), **kwargs)
+
+
+def test_frames_match_compile_frame(tmp_path, frames):
+    compiled = compile_pattern(frames, tmp_path, brightness=0.5)
+    order = compiler.serpentine_order(WIDTH, HEIGHT)
+    assert len(compiled) == len(frames)
+    for frame, buf in zip(frames, compiled):
+        np.testing.assert_array_equal(buf, compiler.compile_frame(frame, order, brightness=0.5))
+
+
+@pytest.mark.parametrize('as_pattern', [lambda x: x, lambda x: x.tolist(), tuple])
+def test_in_memory_patterns_are_compiled_once(tmp_path, frames, as_pattern):
+    first = compile_pattern(as_pattern(frames), tmp_path)
+    inode = os.stat(first.path).st_ino
+    second = compile_pattern(as_pattern(frames), tmp_path)
+    assert second.path == first.path
+    # The cached file is reused rather than written again.
+    assert os.stat(second.path).st_ino == inode
+
+
+def test_streamed_patterns_share_the_cache(tmp_path, frames):
+    cached = compile_pattern(frames, tmp_path)
+    streamed = compile_pattern(iter(frames), tmp_path)
+    assert streamed.path == cached.path
+    np.testing.assert_array_equal(streamed.frames, cached.frames)
+
+
+def test_changed_pattern_replaces_stale_entries(tmp_path, frames):
+    compile_pattern(frames, tmp_path)
+    compile_pattern(frames, tmp_path, brightness=0.5)
+    assert len(os.listdir(tmp_path)) == 1
+    frames[0] = 0
+    compile_pattern(frames, tmp_path)
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_file_patterns_are_keyed_on_their_version(tmp_path, frames):
+    path = str(tmp_path / 'pattern.nl')
+    cache_dir = tmp_path / 'cache'
+    formats.write_binary(frames, path)
+    first = compile_pattern(formats.BinaryPattern(path), cache_dir)
+    assert compile_pattern(formats.BinaryPattern(path), cache_dir).path == first.path
+    formats.write_binary(frames[::-1], path)
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 1))
+    changed = compile_pattern(formats.BinaryPattern(path), cache_dir)
+    assert changed.path != first.path
+    np.testing.assert_array_equal(changed[0], compile_pattern(frames[::-1], cache_dir)[0])
+    # The entry for the old version of the file is pruned.
+    assert not os.path.exists(first.path)
+
+
+def test_stopped_compile_caches_nothing(tmp_path, frames):
+    stop = threading.Event()
+    stop.set()
+    with pytest.raises(compiler.CompileCancelled):
+        compile_pattern(frames, tmp_path, stop=stop)
+    assert os.listdir(tmp_path) == []
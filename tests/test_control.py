@@ -0,0 +1,147 @@
+""" test_control.py
+
+Tests for the control server in nightlight/control.py.
+
+"""
+import os
+import socket
+from concurrent.futures import Future
+
+import pytest
+
+from nightlight import control
+
+
+class FakeBoard:
+    """ Stand-in for base.Nightlight that answers every command straight away """
+
+    def __init__(self):
+        self.commands = []
+
+    def send_command(self, command, **kwargs):
+        self.commands.append((command, kwargs))
+        future = Future()
+        if command == 'fail':
+            future.set_exception(ValueError('Unknown command fail'))
+        else:
+            future.set_result({'command': command})
+        return future
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('pause', ('pause', {})),
+    ('  next \n', ('next', {})),
+    ('brightness 0.3', ('brightness', {'value': '0.3'})),
+    ('load /patterns/with spaces', ('load', {'path': '/patterns/with spaces'})),
+    ('{"command": "brightness", "value": 0.3}', ('brightness', {'value': 0.3})),
+    ('{"command": "load", "path": "a.nl"}\n', ('load', {'path': 'a.nl'})),
+])
+def test_parse_request(line, expected):
+    assert control.parse_request(line) == expected
+
+
+@pytest.mark.parametrize('line, error', [
+    ('', ValueError),
+    ('   \n', ValueError),
+    ('{"value": 0.3}', KeyError),
+    ('{"command": ', ValueError),
+])
+def test_parse_request_errors(line, error):
+    with pytest.raises(error):
+        control.parse_request(line)
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    return str(tmp_path / 'nightlight.sock')
+
+
+@pytest.fixture
+def server(socket_path):
+    board = FakeBoard()
+    server = control.ControlServer(board, socket_path, open_patterns=lambda path: [path])
+    server.start()
+    yield server
+    server.stop()
+
+
+def send_lines(path, *lines):
+    """ Send request lines over one connection and read a response line for each """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(5)
+        sock.connect(path)
+        with sock.makefile('rw', encoding='utf-8') as stream:
+            responses = []
+            for line in lines:
+                stream.write(line + '\n')
+                stream.flush()
+                responses.append(stream.readline())
+    return responses
+
+
+def test_commands_reach_the_board(server, socket_path):
+    assert control.send_command('brightness', socket_path, value=0.3) == {
+        'ok': True, 'result': {'command': 'brightness'}}
+    assert send_lines(socket_path, 'pause', 'brightness 0.5') == [
+        '{"ok": true, "result": {"command": "pause"}}\n',
+        '{"ok": true, "result": {"command": "brightness"}}\n']
+    assert server.board.commands == [('brightness', {'value': 0.3}), ('pause', {}),
+                                     ('brightness', {'value': '0.5'})]
+
+
+def test_load_opens_patterns(server, socket_path):
+    assert control.send_command('load', socket_path, path='a.nl')['ok']
+    assert server.board.commands == [('load', {'patterns': ['a.nl']})]
+
+
+def test_errors_are_reported(server, socket_path):
+    assert control.send_command('fail', socket_path) == {
+        'ok': False, 'error': 'Unknown command fail'}
+    response = send_lines(socket_path, '', '{"value": 1}', 'next')
+    assert response[0] == '{"ok": false, "error": "Empty command"}\n'
+    assert response[1].startswith('{"ok": false')
+    # The connection stays usable after a bad request.
+    assert response[2] == '{"ok": true, "result": {"command": "next"}}\n'
+
+
+def test_load_without_open_patterns(socket_path):
+    server = control.ControlServer(FakeBoard(), socket_path)
+    server.start()
+    try:
+        response = control.send_command('load', socket_path, path='a.nl')
+    finally:
+        server.stop()
+    assert response == {'ok': False, 'error': 'This server cannot load playlists'}
+
+
+def test_stop_removes_the_socket(socket_path):
+    server = control.ControlServer(FakeBoard(), socket_path)
+    server.start()
+    assert os.path.exists(socket_path)
+    server.stop()
+    assert not os.path.exists(socket_path)
+
+
+def test_stale_socket_is_replaced(socket_path):
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    server = control.ControlServer(FakeBoard(), socket_path)
+    server.start()
+    try:
+        assert control.send_command('pause', socket_path)['ok']
+    finally:
+        server.stop()
+
+
+def test_live_socket_is_not_taken_over(server, socket_path):
+    with pytest.raises(RuntimeError):
+        control.ControlServer(FakeBoard(), socket_path).start()
+    # The first server is still serving.
+    assert control.send_command('pause', socket_path)['ok']
+
+
+def test_start_fails_fast_without_a_directory(tmp_path):
+    server = control.ControlServer(FakeBoard(), str(tmp_path / 'missing' / 'nightlight.sock'))
+    with pytest.raises(OSError):
+        server.start()
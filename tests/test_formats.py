@@ -0,0 +1,122 @@
+""" test_formats.py
+
+Tests for the compressed Nightlight file format (NLZ1) in nightlight/formats.py.
+
+"""
+import numpy as np
+import pytest
+
+from nightlight import formats
+
+WIDTH = 5
+HEIGHT = 3
+
+
+def make_frames(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(count, HEIGHT, WIDTH, 3), dtype=np.uint8)
+
+
+def read_record_kinds(path):
+    """ List the kind of every record in a compressed file, in order """
+    with open(path, 'rb') as fin:
+        header = formats.read_compressed_header(fin)
+        data = fin.read(header['index_offset'] - fin.tell())
+    kinds = []
+    offset = 0
+    while offset < len(data):
+        kind, length = formats.RECORD_HEADER.unpack_from(data, offset)
+        kinds.append(kind)
+        offset += formats.RECORD_HEADER.size + (0 if kind == formats.HOLD else length)
+    return kinds
+
+
+@pytest.fixture
+def held_frames():
+    # Frames 2-5 and 9-11 repeat the frame before them. With a keyframe every 5 frames, both
+    # runs cross a keyframe.
+    frames = make_frames(14)
+    frames[2:6] = frames[1]
+    frames[9:12] = frames[8]
+    return frames
+
+
+def write(path, frames, keyframe_interval=5):
+    formats.write_compressed(frames, str(path), fps=24, keyframe_interval=keyframe_interval)
+    return formats.CompressedPattern(str(path))
+
+
+def test_round_trip(tmp_path):
+    frames = make_frames(12)
+    pattern = write(tmp_path / 'pattern.nl', frames)
+    assert formats.is_compressed_file(str(tmp_path / 'pattern.nl'))
+    assert (len(pattern), pattern.width, pattern.height, pattern.fps) == (12, WIDTH, HEIGHT, 24)
+    assert pattern.keyframes == [0, 5, 10]
+    np.testing.assert_array_equal(np.stack(list(pattern)), frames)
+    pattern.close()
+
+
+def test_random_access(tmp_path, held_frames):
+    pattern = write(tmp_path / 'pattern.nl', held_frames)
+    order = np.random.default_rng(1).permutation(len(held_frames))
+    # Backwards, forwards within a keyframe interval, across keyframes and at random.
+    for index in [13, 0, 3, 4, 7, 6, 12, 1, 10, 9] + order.tolist():
+        np.testing.assert_array_equal(pattern[index], held_frames[index])
+    np.testing.assert_array_equal(pattern[-1], held_frames[-1])
+    with pytest.raises(IndexError):
+        pattern[len(held_frames)]
+    with pytest.raises(IndexError):
+        pattern[-len(held_frames) - 1]
+    pattern.close()
+
+
+def test_holds(tmp_path, held_frames):
+    path = tmp_path / 'pattern.nl'
+    pattern = write(path, held_frames)
+    k, d, h = formats.KEYFRAME, formats.DELTA, formats.HOLD
+    # Holds stop at the keyframes at frames 5 and 10, and start again after them.
+    assert read_record_kinds(path) == [k, d, h, k, d, d, d, h, k, h, d, d]
+    decoded = list(pattern)
+    np.testing.assert_array_equal(np.stack(decoded), held_frames)
+    # Held frames are the same object, so the player can skip them without comparing pixels.
+    assert all(decoded[i] is decoded[1] for i in range(2, 5))
+    assert decoded[9] is decoded[8]
+    assert decoded[11] is decoded[10]
+    assert decoded[12] is not decoded[11]
+    pattern.close()
+
+
+def test_iter_frames_from_inside_a_hold(tmp_path, held_frames):
+    pattern = write(tmp_path / 'pattern.nl', held_frames)
+    for start in (0, 3, 5, 9, 11, 13):
+        np.testing.assert_array_equal(np.stack(list(pattern.iter_frames(start))),
+                                      held_frames[start:])
+    assert list(pattern.iter_frames(len(held_frames))) == []
+    pattern.close()
+
+
+def test_all_frames_held(tmp_path):
+    frames = np.repeat(make_frames(1), 9, axis=0)
+    path = tmp_path / 'pattern.nl'
+    pattern = write(path, frames, keyframe_interval=4)
+    assert read_record_kinds(path) == [formats.KEYFRAME, formats.HOLD] * 2 + [formats.KEYFRAME]
+    np.testing.assert_array_equal(pattern[6], frames[6])
+    np.testing.assert_array_equal(np.stack(list(pattern)), frames)
+    pattern.close()
+
+
+def test_alpha_channel_is_dropped(tmp_path):
+    frames = make_frames(3)
+    rgba = np.concatenate([frames, np.full(frames.shape[:-1] + (1,), 255, np.uint8)], axis=-1)
+    pattern = write(tmp_path / 'pattern.nl', rgba)
+    np.testing.assert_array_equal(np.stack(list(pattern)), frames)
+    pattern.close()
+
+
+def test_failed_write_leaves_no_file(tmp_path):
+    path = tmp_path / 'pattern.nl'
+    with pytest.raises(RuntimeError):
+        with formats.CompressedWriter(str(path)) as writer:
+            writer.write_frame(make_frames(1)[0])
+            raise RuntimeError('Conversion failed')
+    assert list(tmp_path.iterdir()) == []